@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+"""
+Compare the OpenCV augmentation (aid_img.affine_augm_crop,
+aid_img.photometric_augm) with the TensorFlow graph backend
+(aid_dl.TFAugmenter) for batches of 1k to 100k images.
+
+Usage: python benchmarks/benchmark_augmentation_backends.py
+"""
+import time
+
+import numpy as np
+
+from napari_aideveloper import aid_dl, aid_img
+
+affine_paras = {"v_flip":True,"h_flip":False,"rotation":3,"width_shift":0.001,
+                "height_shift":0.001,"zoom":0.001,"shear":0.005}
+photometric_paras = {"contrast_on":True,"contrast_lower":0.7,"contrast_higher":1.3,
+                     "saturation_on":False,"saturation_lower":0.7,"saturation_higher":1.3,
+                     "hue_on":False,"hue_delta":0.08,
+                     "avgBlur_on":True,"avgBlur_min":0,"avgBlur_max":5,
+                     "gaussBlur_on":False,"gaussBlur_min":0,"gaussBlur_max":5,
+                     "motionBlur_on":False,"motionBlur_kernel":(0,5),"motionBlur_angle":(-10,10),
+                     "brightness_add_lower":-15,"brightness_add_upper":15,
+                     "brightness_mult_lower":0.7,"brightness_mult_upper":1.3,
+                     "gaussnoise_mean":0,"gaussnoise_scale":3.0}
+crop = 32
+
+def augment_cv2(images,rng):
+    images = aid_img.affine_augm_paras(images,dict(affine_paras,crop=crop),rng=rng)
+    return aid_img.photometric_augm(images,photometric_paras,rng=rng)
+
+if __name__ == "__main__":
+    rng = aid_img.RngContext(42)
+    tf_augm = aid_dl.TFAugmenter(affine_paras,photometric_paras,crop)
+    tf_augm.augment(np.zeros((10,46,46,1),dtype=np.uint8)) #warm-up (tracing)
+    for nr_images in [1000,10000,100000]:
+        images = rng.integers(0,255,size=(nr_images,46,46,1)).astype(np.uint8)
+        t1 = time.time()
+        augment_cv2(images,rng)
+        t_cv2 = time.time()-t1
+        t1 = time.time()
+        tf_augm.augment(images,rng=rng)
+        t_tf = time.time()-t1
+        print(str(nr_images)+" images: cv2 "+str(np.round(t_cv2,3))+"s, tf "+str(np.round(t_tf,3))+"s ("+str(np.round(t_cv2/t_tf,1))+"x)")
@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+"""
+Compare affine and photometric augmentation in a single thread
+(aid_img.affine_augm, aid_img.photometric_augm) with the process pool
+(aid_img.AugmentationPool) for an increasing nr. of processes.
+
+Usage: python benchmarks/benchmark_augmentation_pool.py
+"""
+import os
+import time
+
+import numpy as np
+
+from napari_aideveloper import aid_img
+
+affine_paras = {"v_flip":True,"h_flip":False,"rotation":3,"width_shift":0.001,
+                "height_shift":0.001,"zoom":0.001,"shear":0.005}
+photometric_paras = {"contrast_on":True,"contrast_lower":0.7,"contrast_higher":1.3,
+                     "saturation_on":False,"saturation_lower":0.7,"saturation_higher":1.3,
+                     "hue_on":False,"hue_delta":0.08,
+                     "avgBlur_on":True,"avgBlur_min":0,"avgBlur_max":5,
+                     "gaussBlur_on":False,"gaussBlur_min":0,"gaussBlur_max":5,
+                     "motionBlur_on":False,"motionBlur_kernel":(0,5),"motionBlur_angle":(-10,10),
+                     "brightness_add_lower":-15,"brightness_add_upper":15,
+                     "brightness_mult_lower":0.7,"brightness_mult_upper":1.3,
+                     "gaussnoise_mean":0,"gaussnoise_scale":3.0}
+
+def augment_serial(images):
+    p = affine_paras
+    images = aid_img.affine_augm(images,p["v_flip"],p["h_flip"],p["rotation"],p["width_shift"],p["height_shift"],p["zoom"],p["shear"])
+    return aid_img.photometric_augm(images,photometric_paras)
+
+if __name__ == "__main__":
+    images = np.random.randint(0,255,size=(50000,46,46,1)).astype(np.uint8)
+    print("Images: "+str(images.shape))
+    t1 = time.time()
+    augment_serial(images)
+    t_serial = time.time()-t1
+    print("serial: "+str(np.round(t_serial,3))+"s")
+
+    nr_processes = 2
+    while nr_processes<=os.cpu_count():
+        aug_pool = aid_img.AugmentationPool(nr_processes)
+        aug_pool.augment(images[:100],affine_paras,photometric_paras) #warm-up
+        t1 = time.time()
+        aug_pool.augment(images,affine_paras,photometric_paras)
+        t_pool = time.time()-t1
+        aug_pool.close()
+        print(str(nr_processes)+" processes: "+str(np.round(t_pool,3))+"s, speedup "+str(np.round(t_serial/t_pool,1))+"x")
+        nr_processes *= 2
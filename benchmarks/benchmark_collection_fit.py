@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+"""
+Training a collection of small models: one model after another versus
+all models at the same time (aid_dl.CollectionFitter), on the same
+training data of each epoch. As in the fitting routine, the models live in
+a tf.compat.v1.Session (graph mode).
+
+Usage: python benchmarks/benchmark_collection_fit.py
+"""
+import os
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from napari_aideveloper import aid_dl, aid_img
+
+nr_models = 6
+nr_epochs = 3
+batch_size = 32
+
+def get_model():
+    model = tf.keras.Sequential([tf.keras.layers.Conv2D(8,3,activation="relu",input_shape=(32,32,1)),
+                                 tf.keras.layers.MaxPool2D(),
+                                 tf.keras.layers.Flatten(),
+                                 tf.keras.layers.Dense(16,activation="relu"),
+                                 tf.keras.layers.Dense(2,activation="softmax")])
+    model.compile(loss="categorical_crossentropy",optimizer="adam",metrics=["accuracy"])
+    return model
+
+if __name__ == "__main__":
+    rng = aid_img.RngContext(42)
+    X = rng.random((2000,32,32,1)).astype(np.float32)
+    Y = tf.keras.utils.to_categorical(rng.integers(0,2,2000),2)
+    print(str(os.cpu_count())+" CPU cores")
+
+    for threads in [1,2,0,nr_models]:
+        with tf.compat.v1.Session(graph=tf.Graph()) as sess:
+            models = [get_model() for i in range(nr_models)]
+            fitter = aid_dl.CollectionFitter(nr_models,threads=threads,sess=sess)
+            #build the train functions (one after another)
+            fitter.map(lambda i: models[i].fit(X[:batch_size],Y[:batch_size],batch_size=batch_size,epochs=1,verbose=0))
+            t1 = time.time()
+            for epoch in range(nr_epochs):
+                fitter.map(lambda i: models[i].fit(X,Y,batch_size=batch_size,epochs=1,verbose=0))
+            t_epoch = (time.time()-t1)/nr_epochs
+            fitter.close()
+        print(str(fitter.threads)+" models at the same time (threads="+str(threads)+"): "+
+              str(round(t_epoch,3))+"s/epoch")
@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+"""
+Compare the per-image crop/pad loop (aid_img.image_crop_pad_cv2) with the
+batch crop/pad engine (aid_img.image_crop_pad_batch) on the Tutorial data.
+
+Usage: python benchmarks/benchmark_crop_pad.py
+"""
+import os
+import timeit
+
+import numpy as np
+
+from napari_aideveloper import aid_bin, aid_img
+
+dir_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+dir_data = os.path.join(dir_root,"Tutorial","Data","train")
+
+def load_images(repeats=20):
+    Images,Pos_x,Pos_y = [],[],[]
+    for fname in sorted(os.listdir(dir_data)):
+        failed,rtdc_ds = aid_bin.load_rtdc(os.path.join(dir_data,fname))
+        if failed:
+            raise rtdc_ds
+        pix = rtdc_ds.attrs["imaging:pixel size"]
+        Images.append(rtdc_ds["events"]["image"][:])
+        Pos_x.append(rtdc_ds["events"]["pos_x"][:]/pix)
+        Pos_y.append(rtdc_ds["events"]["pos_y"][:]/pix)
+    #repeat the data to get a dataset size as used with crop_imgs_to_ram
+    images = np.concatenate(Images*repeats)
+    pos_x,pos_y = np.concatenate(Pos_x*repeats),np.concatenate(Pos_y*repeats)
+    return images,pos_x,pos_y
+
+if __name__ == "__main__":
+    images,pos_x,pos_y = load_images()
+    print("Images: "+str(images.shape))
+    for crop in [24,32,40]:#crop inside, exactly at and beyond the image border
+        for padding_mode in ["cv2.BORDER_CONSTANT","cv2.BORDER_REFLECT","delete"]:
+            t_loop = min(timeit.repeat(lambda: aid_img.image_crop_pad_cv2(list(images),pos_x,pos_y,1,crop,crop,padding_mode),number=1,repeat=3))
+            t_batch = min(timeit.repeat(lambda: aid_img.image_crop_pad_batch(images,pos_x,pos_y,crop,crop,padding_mode),number=1,repeat=3))
+            print("crop="+str(crop)+", "+padding_mode+": loop "+str(np.round(t_loop,3))+"s, batch "+str(np.round(t_batch,3))+"s, speedup "+str(np.round(t_loop/t_batch,1))+"x")
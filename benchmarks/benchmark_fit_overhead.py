@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+"""
+Per-epoch overhead of the fitting loop: one call of .fit() per epoch
+(arrays of the epoch) versus a single call of .fit() over all epochs
+(aid_dl.EpochFeeder, validation by aid_dl.ValidationSchedule in a callback),
+for a small model and small epochs. As in the fitting routine, everything
+runs inside a tf.compat.v1.Session (graph mode) and uses class weights.
+
+Usage: python benchmarks/benchmark_fit_overhead.py
+"""
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from napari_aideveloper import aid_dl, aid_img
+
+nr_epochs = 30
+batch_size = 32
+
+def get_model():
+    model = tf.keras.Sequential([tf.keras.layers.Flatten(input_shape=(32,32,1)),
+                                 tf.keras.layers.Dense(2,activation="softmax")])
+    model.compile(loss="categorical_crossentropy",optimizer="adam",metrics=["accuracy"])
+    return model
+
+def graph_size():
+    return len(tf.compat.v1.get_default_graph().get_operations())
+
+if __name__ == "__main__":
+    rng = aid_img.RngContext(42)
+    X_valid = rng.random((200,32,32,1)).astype(np.float32)
+    Y_valid = tf.keras.utils.to_categorical(rng.integers(0,2,200),2)
+    class_weight = {0:1.0,1:2.0}
+    for nr_events in [100,1000,10000]:
+        X = rng.random((nr_events,32,32,1)).astype(np.float32)
+        Y = tf.keras.utils.to_categorical(rng.integers(0,2,nr_events),2)
+
+        with tf.compat.v1.Session(graph=tf.Graph()):
+            model = get_model()
+            t1 = time.time()
+            for epoch in range(nr_epochs):
+                model.fit(X,Y,batch_size=batch_size,epochs=1,verbose=0,class_weight=class_weight,
+                          validation_data=(X_valid,Y_valid))
+            t_loop = (time.time()-t1)/nr_epochs
+            ops_loop = graph_size()
+
+        with tf.compat.v1.Session(graph=tf.Graph()):
+            model = get_model()
+            feeder = aid_dl.EpochFeeder(lambda: (X,Y,[]),batch_size,rng=rng)
+            validation = aid_dl.ValidationSchedule(X_valid,Y_valid,batch_size=batch_size)
+            callback = tf.keras.callbacks.LambdaCallback(on_epoch_end=lambda epoch,logs: validation.evaluate(model,epoch))
+            t1 = time.time()
+            model.fit(feeder.dataset(),steps_per_epoch=len(feeder),epochs=nr_epochs,verbose=0,
+                      class_weight=class_weight,callbacks=[callback])
+            t_single = (time.time()-t1)/nr_epochs
+            ops_single = graph_size()
+
+        print(str(nr_events)+" events/epoch: .fit() per epoch "+str(round(t_loop,4))+
+              "s/epoch ("+str(ops_loop)+" graph ops), single .fit() "+str(round(t_single,4))+
+              "s/epoch ("+str(ops_single)+" graph ops)")
@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+"""
+Compare the previous per-image normalization loop with the vectorized
+aid_img.image_normalization (with and without reusing the output buffer).
+
+Usage: python benchmarks/benchmark_normalization.py
+"""
+import timeit
+
+import numpy as np
+
+from napari_aideveloper import aid_img
+
+def image_normalization_loop(images,normalization_method,mean_trainingdata=None,std_trainingdata=None):
+    #previous implementation of aid_img.image_normalization
+    if len(images.shape)==3:
+        images = np.expand_dims(images,3)
+    images = images.astype(np.float32)
+    for k in range(images.shape[0]):
+        line = images[k,:,:,:]
+        if normalization_method == "Div. by 255":
+            line = line/255.0
+        elif normalization_method == "StdScaling using mean and std of each image individually":
+            mean = np.mean(line)
+            std = np.std(line)
+            if np.allclose(std,0):
+                std = 0.0001
+            line = (line-mean)/std
+        elif normalization_method == "StdScaling using mean and std of all training data":
+            line = (line-mean_trainingdata)/std_trainingdata
+        ind = np.isnan(line)
+        line[ind] = np.random.random()
+        images[k,:,:,:] = line
+    return images
+
+if __name__ == "__main__":
+    rng = np.random.RandomState(42)
+    for shape in [(20000,32,32,1),(5000,64,64,3)]:
+        images = rng.randint(0,255,size=shape).astype(np.uint8)
+        out = aid_img.image_normalization(images,"None")
+        for norm in ["Div. by 255","StdScaling using mean and std of each image individually",
+                     "StdScaling using mean and std of all training data"]:
+            t_loop = min(timeit.repeat(lambda: image_normalization_loop(images,norm,120.0,60.0),number=1,repeat=3))
+            t_vec = min(timeit.repeat(lambda: aid_img.image_normalization(images,norm,120.0,60.0),number=1,repeat=3))
+            t_out = min(timeit.repeat(lambda: aid_img.image_normalization(images,norm,120.0,60.0,out=out),number=1,repeat=3))
+            print(str(shape)+", "+norm+": loop "+str(np.round(t_loop,3))+"s, vectorized "+str(np.round(t_vec,3))+"s ("+str(np.round(t_loop/t_vec,1))+"x), reused buffer "+str(np.round(t_out,3))+"s ("+str(np.round(t_loop/t_out,1))+"x)")
@@ -0,0 +1,148 @@
+import h5py
+import numpy as np
+from napari_aideveloper import aid_bin
+
+
+def test_read_events(tmp_path):
+    # chunk-wise reading has to return the events in the requested order
+    images = np.random.randint(0, 255, size=(550, 8, 10)).astype(np.uint8)
+    with h5py.File(tmp_path / "test.rtdc", "w") as h5:
+        h5.create_dataset("events/image", data=images, chunks=(100, 8, 10),
+                          compression="gzip")
+    indices = np.random.randint(0, len(images), size=300)
+    with h5py.File(tmp_path / "test.rtdc", "r") as h5:
+        result = aid_bin.read_events(h5["events/image"], indices, max_chunks=2)
+    np.testing.assert_array_equal(result, images[indices])
+
+
+def test_rtdc_handle_pool(tmp_path):
+    # handles are reused, pinned handles stay open, others are closed (LRU)
+    paths = []
+    for i in range(4):
+        paths.append(str(tmp_path / ("test" + str(i) + ".rtdc")))
+        with h5py.File(paths[-1], "w") as h5:
+            h5.create_dataset("events/pos_x", data=np.arange(10))
+    pool = aid_bin.RtdcHandlePool(max_open=1)
+    try:
+        first = pool.get(paths[0])
+        assert pool.get(paths[0]) is first
+        pinned = pool.get(paths[1], pin=True)
+        for path in paths[2:]:
+            pool.get(path)
+        assert not first.id.valid
+        assert pinned.id.valid
+        pool.release(pinned)
+        assert not pinned.id.valid
+    finally:
+        pool.close_all()
+
+
+def test_scan_rtdc(tmp_path):
+    # metadata is cached until the file changes
+    path = str(tmp_path / "test.rtdc")
+    with h5py.File(path, "w") as h5:
+        h5.create_dataset("events/image", data=np.zeros((5, 8, 10), np.uint8))
+        h5.create_dataset("events/pos_x", data=np.arange(5))
+        h5.attrs["imaging:pixel size"] = 0.34
+    fileinfo = aid_bin.scan_rtdc(path)
+    assert fileinfo["features"] == ["image", "pos_x"]
+    # the handle is pinned only during the scan
+    assert all(entry[1] == 0 for entry in aid_bin.rtdc_handles.handles.values())
+    assert "nr_images" not in fileinfo
+    aid_bin.rtdc_handles.close_path(path)
+    with h5py.File(path, "a") as h5:
+        h5.create_dataset("events/pos_y", data=np.arange(5))
+    fileinfo = aid_bin.scan_rtdc(path)
+    assert fileinfo["nr_images"] == 5
+    assert fileinfo["pix"] == 0.34
+    assert not fileinfo["xtra_in"]
+    aid_bin.rtdc_handles.close_path(path)
+    assert aid_bin.scan_rtdc(path) == fileinfo
+
+
+def test_scan_rtdc_repeated_selection(tmp_path, monkeypatch):
+    # selecting the files of the table again and again (items_clicked) uses the
+    # cached metadata; the files are not opened again, even if there are more
+    # files than handles in the pool
+    paths = []
+    for i in range(20):
+        paths.append(str(tmp_path / ("test" + str(i) + ".rtdc")))
+        with h5py.File(paths[-1], "w") as h5:
+            h5.create_dataset("events/image", data=np.zeros((3, 8, 10), np.uint8))
+            h5.create_dataset("events/pos_x", data=np.arange(3))
+            h5.create_dataset("events/pos_y", data=np.arange(3))
+            h5.attrs["imaging:pixel size"] = 0.34
+    opened = []
+    h5py_file = h5py.File
+
+    def count_open(*args, **kwargs):
+        opened.append(args[0])
+        return h5py_file(*args, **kwargs)
+    monkeypatch.setattr(aid_bin.h5py, "File", count_open)
+    monkeypatch.setattr(aid_bin, "rtdc_handles", aid_bin.RtdcHandlePool(max_open=4))
+    try:
+        for selection in range(3):
+            assert [aid_bin.scan_rtdc(path)["nr_images"] for path in paths] == [3] * len(paths)
+        assert sorted(opened) == sorted(paths)
+    finally:
+        aid_bin.rtdc_handles.close_all()
+
+
+def test_ram_cache_plan():
+    # files with the highest sampling rate are kept in RAM first
+    SelectedFiles = [
+        {"rtdc_path": "a.rtdc", "nr_images": 1000, "nr_events_epoch": 100, "shuffle": True},
+        {"rtdc_path": "b.rtdc", "nr_images": 1000, "nr_events_epoch": 900, "shuffle": True},
+        {"rtdc_path": "c.rtdc", "nr_images": 500, "nr_events_epoch": 10, "shuffle": False},
+    ]
+    in_ram, from_disk = aid_bin.ram_cache_plan(SelectedFiles, 10, "Grayscale", 160000)
+    assert in_ram == ["c.rtdc", "b.rtdc"]
+    assert from_disk == ["a.rtdc"]
+    in_ram, from_disk = aid_bin.ram_cache_plan(SelectedFiles, 10, "RGB", None)
+    assert len(in_ram) == 3 and from_disk == []
+
+
+def test_memory_plan():
+    # stages scale with the nr. of events, scale factor makes the plan fit
+    SelectedFiles = [
+        {"rtdc_path": "a.rtdc", "nr_images": 1000, "nr_events_epoch": 500, "shuffle": True, "TrainOrValid": "Train"},
+        {"rtdc_path": "b.rtdc", "nr_images": 200, "nr_events_epoch": 100, "shuffle": False, "TrainOrValid": "Train"},
+        {"rtdc_path": "c.rtdc", "nr_images": 300, "nr_events_epoch": 50, "shuffle": True, "TrainOrValid": "Valid"},
+    ]
+    plan = aid_bin.memory_plan(SelectedFiles, 32, "Grayscale", 2, max_bytes=0)
+    assert plan["RAM cache"] == 0
+    assert plan["Validation set"] == 50 * 32 * 32 * 5 + 50 * 2 * 4
+    assert plan["Loading and cropping"] == 2 * 700 * 46 * 46
+    plan_ram = aid_bin.memory_plan(SelectedFiles, 32, "RGB", 2, prefetch_depth=2)
+    assert plan_ram["RAM cache"] == 1500 * 32 * 32 * 3
+    assert plan_ram["Peak"] > plan["Peak"]
+    streaming = aid_bin.memory_plan(SelectedFiles, 32, "Grayscale", 2, max_bytes=0, streaming=True)
+    assert streaming["Peak"] < plan["Peak"]
+    assert aid_bin.memory_plan_scale(plan, plan["Peak"]) == 1.0
+    scale = aid_bin.memory_plan_scale(plan, plan["Peak"] / 2)
+    assert 0 < scale < 0.5
+
+
+def test_history_log(tmp_path):
+    # rows are appended in the column order of the first row, also when resuming
+    fname = str(tmp_path / "test_history.csv")
+    log = aid_bin.HistoryLog(fname)
+    log.append(0, {"loss": 0.5, "val_loss": np.nan, "Saved": 0})
+    log.append(1, {"val_loss": 0.4, "loss": 0.3, "Saved": 1}, sync=True)
+    log.close()
+    log = aid_bin.HistoryLog(fname, resume=True)
+    log.append(2, {"loss": 0.2, "Saved": 0})
+    df = log.read()
+    log.close()
+    assert list(df.columns) == ["loss", "val_loss", "Saved"]
+    assert list(df.index) == [0, 1, 2]
+    np.testing.assert_allclose(df["loss"], [0.5, 0.3, 0.2])
+    assert np.isnan(df["val_loss"][0]) and np.isnan(df["val_loss"][2])
+    assert list(df["Saved"]) == [0, 1, 0]
+    # a new training overwrites the history of an old one
+    log = aid_bin.HistoryLog(fname)
+    log.append(0, {"accuracy": 0.9})
+    df = log.read()
+    log.close()
+    assert list(df.columns) == ["accuracy"]
+    assert list(df.index) == [0]
@@ -0,0 +1,206 @@
+import threading
+
+import numpy as np
+import pytest
+
+tf = pytest.importorskip("tensorflow")
+pytest.importorskip("keras_metrics")
+from napari_aideveloper import aid_dl  # noqa: E402
+
+
+@pytest.fixture
+def sess():
+    # the fitting routine runs inside a tf.compat.v1.Session (graph mode)
+    with tf.compat.v1.Session(graph=tf.Graph()) as sess:
+        yield sess
+
+
+def get_model():
+    model = tf.keras.Sequential([tf.keras.layers.Flatten(input_shape=(8, 8, 1)),
+                                 tf.keras.layers.Dense(2, activation="softmax")])
+    model.compile(loss="categorical_crossentropy", optimizer="adam",
+                  metrics=["accuracy"])
+    return model
+
+
+def get_data(nr_events):
+    X = np.random.rand(nr_events, 8, 8, 1).astype(np.float32)
+    Y = tf.keras.utils.to_categorical(np.arange(nr_events) % 2, 2)
+    return X, Y
+
+
+def test_validation_schedule(sess):
+    # metrics of scheduled epochs, NaN otherwise; data is not put into the graph
+    X, Y = get_data(400)
+    model = get_model()
+    validation = aid_dl.ValidationSchedule(X, Y, batch_size=16, every=2,
+                                           subsample=0.5, full_every=4)
+    logs, which = validation.evaluate(model, 0)
+    assert which == "full"
+    assert sorted(logs) == ["val_accuracy", "val_loss"]
+    assert logs["val_loss"] > 0
+    logs, which = validation.evaluate(model, 1)
+    assert which is None and np.isnan(logs["val_loss"])
+    assert validation.evaluate(model, 2)[1] == "subsample"
+    assert validation.evaluate(model, 4)[1] == "full"
+    for op in sess.graph.get_operations():
+        if op.type == "Const":
+            assert op.outputs[0].shape.num_elements() < X.size
+
+
+def test_checkpoint_writer(sess, tmp_path):
+    # snapshots are written on the writer thread using the session of the model
+    model = get_model()
+    writer = aid_dl.CheckpointWriter(model, save_format='h5', sess=sess)
+    path = str(tmp_path / "test_0.model")
+    writer.save(model, path)
+    weights = model.get_weights()
+    model.set_weights([np.zeros_like(w) for w in weights])#changes after save() are not saved
+    writer.close()
+    assert writer.pop_messages() == ["Saved model: " + path]
+    with tf.compat.v1.Session(graph=tf.Graph()):
+        saved = tf.keras.models.load_model(path, compile=False)
+        for w, w_saved in zip(weights, saved.get_weights()):
+            np.testing.assert_array_equal(w, w_saved)
+
+
+@pytest.mark.parametrize("save_format", ["h5", None])
+def test_checkpoint_writers_collection(sess, tmp_path, save_format):
+    # one writer per model of a collection, all saving at the same time
+    models = [get_model() for i in range(4)]
+    writers = [aid_dl.CheckpointWriter(m, save_format=save_format, sess=sess) for m in models]
+    nr_ops = len(sess.graph.get_operations())
+    paths = [str(tmp_path / ("test_" + str(i) + "_0.model")) for i in range(len(models))]
+    for model, writer, path in zip(models, writers, paths):
+        writer.save(model, path)
+    for writer, path in zip(writers, paths):
+        writer.close()
+        assert writer.pop_messages() == ["Saved model: " + path]
+    if save_format == "h5":  # the assign operations were created in __init__
+        assert len(sess.graph.get_operations()) == nr_ops
+    weights = [model.get_weights() for model in models]
+    with tf.compat.v1.Session(graph=tf.Graph()):
+        for weights_model, path in zip(weights, paths):
+            saved = tf.keras.models.load_model(path, compile=False)
+            for w, w_saved in zip(weights_model, saved.get_weights()):
+                np.testing.assert_array_equal(w, w_saved)
+
+
+def test_tf_augmenter_graph_mode(sess):
+    # same result as in eager mode; the graph is built only once
+    affine_paras = {"v_flip": True, "h_flip": True, "rotation": 30, "width_shift": 0.1,
+                    "height_shift": 0.1, "zoom": 0.1, "shear": 0.1}
+    photometric_paras = {"contrast_on": True, "contrast_lower": 0.8, "contrast_higher": 1.2,
+                         "saturation_on": False, "hue_on": False,
+                         "avgBlur_on": False, "gaussBlur_on": True, "gaussBlur_min": 0,
+                         "gaussBlur_max": 5, "motionBlur_on": False,
+                         "brightness_add_lower": -10, "brightness_add_upper": 10,
+                         "brightness_mult_lower": 0.9, "brightness_mult_upper": 1.1,
+                         "gaussnoise_mean": 0, "gaussnoise_scale": 3}
+    images = np.random.randint(0, 255, size=(10, 40, 40, 1)).astype(np.uint8)
+    augm = aid_dl.TFAugmenter(affine_paras, photometric_paras, crop=32)
+    result = augm.augment(images, rng=aid_dl.aid_img.RngContext(1))
+    nr_ops = len(sess.graph.get_operations())
+    assert result.shape == (10, 32, 32, 1) and result.dtype == np.uint8
+    np.testing.assert_array_equal(result, augm.augment(images, rng=aid_dl.aid_img.RngContext(1)))
+    assert len(sess.graph.get_operations()) == nr_ops
+    # threads without the session (e.g. the prefetcher) run eagerly
+    expected = {}
+
+    def eager():
+        expected["result"] = aid_dl.TFAugmenter(affine_paras, photometric_paras, crop=32).augment(
+            images, rng=aid_dl.aid_img.RngContext(1))
+    thread = threading.Thread(target=eager)
+    thread.start()
+    thread.join()
+    np.testing.assert_array_equal(result, expected["result"])
+
+
+def test_epoch_feeder_fit(sess):
+    # single .fit() over the epochs as in the fitting routine: class weights,
+    # validation in a callback, stopped after an epoch and continued
+    epochs = []
+
+    def get_epoch():
+        epochs.append(get_data(100))
+        return epochs[-1] + ([],)
+    feeder = aid_dl.EpochFeeder(get_epoch, batch_size=16, rng=aid_dl.aid_img.RngContext(1))
+    dataset = feeder.dataset()
+    X_valid, Y_valid = get_data(50)
+    validation = aid_dl.ValidationSchedule(X_valid, Y_valid, batch_size=16, every=2)
+    model = get_model()
+    history = []
+
+    def epoch_end(epoch, logs):
+        val_logs, validated = validation.evaluate(model, epoch)
+        history.append((epoch, dict(logs, **val_logs), validated))
+        if epoch == 1:
+            model.stop_training = True
+    callback = tf.keras.callbacks.LambdaCallback(on_epoch_end=epoch_end)
+    for initial_epoch in [0, 2]:
+        model.fit(dataset, steps_per_epoch=len(feeder), initial_epoch=initial_epoch, epochs=4,
+                  verbose=0, class_weight={0: 1.0, 1: 2.0}, callbacks=[callback])
+    assert len(feeder) == 7
+    assert [h[0] for h in history] == [0, 1, 2, 3]
+    assert [h[2] for h in history] == ["full", None, "full", None]
+    assert all(h[1]["loss"] > 0 for h in history)
+    assert history[2][1]["val_loss"] > 0 and np.isnan(history[3][1]["val_loss"])
+
+
+def test_collection_fitter(sess):
+    # models are fitted on the threads of the pool, inside the session; the
+    # first call builds the graph on the calling thread
+    X, Y = get_data(64)
+    models = [get_model() for i in range(3)]
+    fitter = aid_dl.CollectionFitter(len(models), threads=2, sess=sess)
+    threads = {}
+
+    def fit_member(i):
+        threads[i] = threading.current_thread()
+        history = models[i].fit(X, Y, batch_size=16, epochs=1, verbose=0)
+        return history.history["loss"][-1], models[i].evaluate(X, Y, verbose=0)
+    fitter.map(fit_member)
+    assert all(thread is threading.main_thread() for thread in threads.values())
+    nr_ops = len(sess.graph.get_operations())
+    results = fitter.map(fit_member)
+    fitter.close()
+    assert len(sess.graph.get_operations()) == nr_ops
+    assert len(results) == 3 and all(loss > 0 for loss, evaluation in results)
+    assert threading.main_thread() not in threads.values()
+
+
+def test_shared_epoch(sess):
+    # the models of a collection are fitted on the same events and augmentation
+    images = np.random.randint(0, 255, size=(40, 12, 12)).astype(np.uint8)
+    affine_paras = {"v_flip": True, "h_flip": True, "rotation": 20, "width_shift": 0.1,
+                    "height_shift": 0.1, "zoom": 0.1, "shear": 0.1}
+    seq = aid_dl.EpochSequence(["test.rtdc"], [1], [30], [True], [1.0], 2, 12, 8, batch_size=8,
+                               ram={"test.rtdc": {"images": images}}, affine_paras=affine_paras,
+                               rng=aid_dl.aid_img.RngContext(1))
+    shared = aid_dl.SharedEpoch(seq)
+    X_batches = [shared[i][0] for i in range(len(shared))]
+    for model in [get_model(), get_model()]:
+        model.fit(shared, epochs=1, verbose=0, shuffle=False, workers=1, use_multiprocessing=False)
+        for i in range(len(shared)):  # keras did not draw a new epoch
+            np.testing.assert_array_equal(shared[i][0], X_batches[i])
+    seq.sample_epoch()
+    assert not np.array_equal(shared[0][0], X_batches[0])
+
+
+def test_epoch_sequence_restart(sess):
+    # .fit() stopped after an epoch: the events are drawn once before restarting
+    images = np.random.randint(0, 255, size=(40, 12, 12)).astype(np.uint8)
+    seq = aid_dl.EpochSequence(["test.rtdc"], [1], [30], [True], [1.0], 2, 12, 8, batch_size=8,
+                               ram={"test.rtdc": {"images": images}}, rng=aid_dl.aid_img.RngContext(1))
+    stop = tf.keras.callbacks.LambdaCallback(
+        on_epoch_end=lambda epoch, logs: setattr(model, "stop_training", True))
+    model = get_model()
+    for epoch in range(3):
+        seq.next_epoch()
+        event_ind = seq.event_ind.copy()
+        seq.next_epoch()  # events not used yet
+        np.testing.assert_array_equal(seq.event_ind, event_ind)
+        model.fit(seq, initial_epoch=epoch, epochs=3, verbose=0, shuffle=False, workers=1,
+                  use_multiprocessing=False, callbacks=[stop])
+        seq.next_epoch()
+        assert not np.array_equal(seq.event_ind, event_ind)
@@ -0,0 +1,241 @@
+import cv2
+import h5py
+import numpy as np
+from napari_aideveloper import aid_img
+
+
+def test_image_crop_pad_batch():
+    # batch crop/pad engine has to give the same result as the per-image loop
+    rng = np.random.RandomState(42)
+    for shape in [(20, 80, 250), (20, 32, 32, 3)]:
+        images = rng.randint(0, 255, size=shape).astype(np.uint8)
+        pos_x = rng.uniform(-5, shape[2] + 5, size=shape[0])
+        pos_y = rng.uniform(-5, shape[1] + 5, size=shape[0])
+        for padding_mode in ["cv2.BORDER_CONSTANT", "cv2.BORDER_REFLECT",
+                             "cv2.BORDER_REFLECT_101", "cv2.BORDER_REPLICATE",
+                             "cv2.BORDER_WRAP"]:
+            expected = aid_img.image_crop_pad_cv2(list(images), pos_x, pos_y, 1,
+                                                  24, 24, padding_mode)
+            result = aid_img.image_crop_pad_batch(images, pos_x, pos_y, 24, 24,
+                                                  padding_mode)
+            assert result.shape == (shape[0], 24, 24) + shape[3:]
+            np.testing.assert_array_equal(result, np.array(expected))
+
+
+def test_read_crop_windows(tmp_path):
+    # reading only the windows around the events gives the same result as
+    # reading full frames and cropping afterwards
+    rng = np.random.RandomState(42)
+    images = rng.randint(0, 255, size=(300, 80, 250)).astype(np.uint8)
+    pos_x = rng.uniform(-2, 252, size=300)
+    pos_y = rng.uniform(20, 60, size=300)
+    with h5py.File(tmp_path / "test.rtdc", "w") as h5:
+        h5.create_dataset("events/image", data=images, chunks=(100, 80, 250),
+                          compression="gzip")
+    indices = np.unique(rng.randint(0, 300, size=150))
+    with h5py.File(tmp_path / "test.rtdc", "r") as h5:
+        result = aid_img.read_crop_windows(h5["events/image"], indices,
+                                           pos_x[indices], pos_y[indices],
+                                           48, 48, "cv2.BORDER_REFLECT")
+    expected = aid_img.image_crop_pad_batch(images[indices], pos_x[indices],
+                                            pos_y[indices], 48, 48,
+                                            "cv2.BORDER_REFLECT")
+    np.testing.assert_array_equal(result, expected)
+
+
+def test_augmentation_pool():
+    # the shards of the batch have to be written back to the right position
+    rng = np.random.RandomState(42)
+    images = rng.randint(0, 255, size=(50, 32, 32, 1)).astype(np.uint8)
+    affine_paras = {"v_flip": False, "h_flip": False, "rotation": 0,
+                    "width_shift": 0, "height_shift": 0, "zoom": 0, "shear": 0}
+    aug_pool = aid_img.AugmentationPool(3)
+    try:
+        result = aug_pool.augment(images, affine_paras=affine_paras)
+        np.testing.assert_array_equal(result, images)
+        result = aug_pool.augment(images[:, :24, :24])
+        np.testing.assert_array_equal(result, images[:, :24, :24])
+        result = aug_pool.augment(images, affine_paras=dict(affine_paras, crop=20))
+        np.testing.assert_array_equal(result, images[:, 6:26, 6:26])
+    finally:
+        aug_pool.close()
+
+
+def test_affine_augm_crop():
+    # single warp to the final size gives the same as affine_augm + center crop
+    rng = np.random.RandomState(42)
+    images = rng.randint(0, 255, size=(20, 46, 46, 1)).astype(np.uint8)
+    images = np.stack([np.atleast_3d(cv2.GaussianBlur(img, (9, 9), 3)) for img in images])
+    for paras in [(False, False, 0, 0, 0, 0, 0), (True, True, 20, 0.1, 0.1, 0, 5)]:
+        expected = aid_img.affine_augm(images, *paras, rng=aid_img.RngContext(1))[:, 7:39, 7:39]
+        result = aid_img.affine_augm_crop(images, *paras, 32, 32, rng=aid_img.RngContext(1))
+        assert result.shape == (20, 32, 32, 1)
+        assert np.abs(result.astype(int) - expected).max() <= 1
+    # zooming: images are interpolated only once
+    paras = {"v_flip": True, "h_flip": False, "rotation": 0, "width_shift": 0,
+             "height_shift": 0, "zoom": 0.2, "shear": 0}
+    expected = aid_img.affine_augm_paras(images, paras, rng=aid_img.RngContext(1))[:, 7:39, 7:39]
+    result = aid_img.affine_augm_paras(images, dict(paras, crop=32), rng=aid_img.RngContext(1))
+    assert np.abs(result.astype(int) - expected).mean() < 1
+
+
+def test_rng_context():
+    # a run is reproduced from its seed, spawned streams are independent
+    rng = np.random.RandomState(42)
+    images = rng.randint(0, 255, size=(40, 32, 32, 1)).astype(np.uint8)
+    affine_paras = {"v_flip": True, "h_flip": True, "rotation": 20, "width_shift": 0.1,
+                    "height_shift": 0.1, "zoom": 0.1, "shear": 5, "crop": 24}
+    results = []
+    for seed in [7, 7, 8]:
+        ram = aid_img.RamCache()
+        ram.add("file.rtdc", images, np.arange(40), np.zeros(40))
+        rng_valid, rng_train = aid_img.RngContext(seed).spawn(2)
+        X = next(aid_img.gen_crop_img_ram(ram, "file.rtdc", nr_events=30, rng=rng_train))[0]
+        results.append(aid_img.affine_augm_paras(X, affine_paras, rng=rng_train))
+    np.testing.assert_array_equal(results[0], results[1])
+    assert not np.array_equal(results[0], results[2])
+    assert aid_img.RngContext(7).seed == 7 and aid_img.RngContext().seed is not None
+    rng_a, rng_b = aid_img.RngContext(7).spawn(2)
+    assert rng_a.random() != rng_b.random()
+    # parallel augmentation: each shard has its own stream
+    aug_pool = aid_img.AugmentationPool(3)
+    try:
+        result = aug_pool.augment(images, affine_paras=affine_paras, rng=aid_img.RngContext(7))
+        np.testing.assert_array_equal(result, aug_pool.augment(images, affine_paras=affine_paras,
+                                                                 rng=aid_img.RngContext(7)))
+    finally:
+        aug_pool.close()
+
+
+def test_ram_cache():
+    # entries are returned without copying, sampling draws from the right file
+    ram = aid_img.RamCache()
+    for i in range(3):
+        images = np.full((10 + i, 8, 8), i, dtype=np.uint8)
+        ram.add("file" + str(i) + ".rtdc", images, np.arange(10 + i), np.zeros(10 + i))
+    assert len(ram) == 3 and "file1.rtdc" in ram and "file3.rtdc" not in ram
+    images, indices, xtra_data = next(aid_img.gen_crop_img_ram(ram, "file1.rtdc", random_images=False))
+    assert np.shares_memory(images, ram["file1.rtdc"]["images"])
+    images, indices, xtra_data = next(aid_img.gen_crop_img_ram(ram, "file2.rtdc", nr_events=50))
+    assert images.shape == (50, 8, 8) and np.all(images == 2)
+    assert indices.max() < 12
+    ram.remove("file2.rtdc")
+    assert ram.rtdc_paths == ["file0.rtdc", "file1.rtdc"]
+    assert ram.nbytes == (10 + 11) * 64
+
+
+def test_crop_imgs_to_ram_incremental(tmp_path):
+    # only new or changed files are loaded again, deselected files are removed
+    rng = np.random.RandomState(42)
+    SelectedFiles = []
+    for i in range(3):
+        path = str(tmp_path / ("test" + str(i) + ".rtdc"))
+        with h5py.File(path, "w") as h5:
+            h5.create_dataset("events/image", data=rng.randint(0, 255, size=(20, 40, 60)).astype(np.uint8))
+            h5.create_dataset("events/pos_x", data=rng.uniform(10, 50, size=20))
+            h5.create_dataset("events/pos_y", data=rng.uniform(10, 30, size=20))
+            h5.attrs["imaging:pixel size"] = 1.0
+        SelectedFiles.append({"rtdc_path": path, "nr_images": 20, "nr_events_epoch": 10,
+                              "shuffle": True, "xtra_in": False})
+    ram = aid_img.crop_imgs_to_ram(SelectedFiles[:2], 16, zoom_factors=[1, 1])
+    assert ram.last_refresh["loaded"] == [f["rtdc_path"] for f in SelectedFiles[:2]]
+    images = ram[SelectedFiles[0]["rtdc_path"]]["images"]
+    ram = aid_img.crop_imgs_to_ram(SelectedFiles[1:], 16, zoom_factors=[1.5, 1], ram=ram)
+    assert ram.last_refresh["kept"] == []
+    assert ram.last_refresh["loaded"] == [f["rtdc_path"] for f in SelectedFiles[1:]]
+    assert ram.last_refresh["removed"] == [SelectedFiles[0]["rtdc_path"]]
+    ram = aid_img.crop_imgs_to_ram(SelectedFiles, 16, zoom_factors=[1, 1.5, 1], ram=ram)
+    assert len(ram.last_refresh["kept"]) == 2
+    np.testing.assert_array_equal(ram[SelectedFiles[0]["rtdc_path"]]["images"], images)
+    params = aid_img.ram_params(16, 1.5, 0, "Grayscale", "constant", False)
+    assert ram.status(SelectedFiles[1]["rtdc_path"], params) == "RAM"
+    assert ram.status(SelectedFiles[2]["rtdc_path"], params) == "outdated"
+
+
+def test_image_stats(tmp_path):
+    # chunk-wise statistics are the pooled mean and std of all cropped images
+    rng = np.random.RandomState(42)
+    paths, images = [], []
+    for i in range(2):
+        path = str(tmp_path / ("test" + str(i) + ".rtdc"))
+        with h5py.File(path, "w") as h5:
+            h5.create_dataset("events/image", data=rng.randint(0, 255, size=(25 + i * 10, 40, 60)).astype(np.uint8))
+            h5.create_dataset("events/pos_x", data=rng.uniform(5, 55, size=25 + i * 10))
+            h5.create_dataset("events/pos_y", data=rng.uniform(5, 35, size=25 + i * 10))
+            h5.attrs["imaging:pixel size"] = 1.0
+        paths.append(path)
+        images.append(next(aid_img.gen_crop_img(16, path, random_images=False, zoom_factor=1.2))[0])
+    stats = [aid_img.image_stats(path, 16, zoom_factor=1.2, chunk_size=7) for path in paths]
+    assert stats[0][0] == images[0].size
+    mean, std = aid_img.pooled_mean_std(stats)
+    images = np.concatenate(images)
+    np.testing.assert_allclose([mean, std], [np.mean(images), np.std(images)])
+    assert aid_img.image_stats(paths[0], 16, zoom_factor=1.2) is stats[0]
+    np.testing.assert_allclose(aid_img.pooled_mean_std([aid_img.array_stats(images, 10)]), [mean, std])
+
+
+def image_normalization_loop(images, normalization_method, mean_trainingdata, std_trainingdata, rng):
+    # previous per-image implementation of aid_img.image_normalization
+    if len(images.shape) == 3:
+        images = np.expand_dims(images, 3)
+    images = images.astype(np.float32)
+    for k in range(images.shape[0]):
+        line = images[k, :, :, :]
+        if normalization_method == "Div. by 255":
+            line = line / 255.0
+        elif normalization_method == "StdScaling using mean and std of each image individually":
+            mean = np.mean(line)
+            std = np.std(line)
+            if np.allclose(std, 0):
+                std = 0.0001
+            line = (line - mean) / std
+        elif normalization_method == "StdScaling using mean and std of all training data":
+            line = (line - mean_trainingdata) / std_trainingdata
+        ind = np.isnan(line)
+        line[ind] = rng.random()
+        images[k, :, :, :] = line
+    return images
+
+
+def test_image_normalization():
+    # vectorized normalization gives the same result as the per-image loop
+    rng = np.random.RandomState(42)
+    for shape in [(300, 32, 32), (40, 24, 24, 3)]:
+        images = rng.randint(0, 255, size=shape).astype(np.uint8)
+        images[3] = 7  # std of zero
+        for norm in ["None", "Div. by 255", "StdScaling using mean and std of each image individually",
+                     "StdScaling using mean and std of all training data"]:
+            rng_loop, rng_vec = aid_img.RngContext(1), aid_img.RngContext(1)
+            expected = image_normalization_loop(images, norm, np.float64(120.3), np.float64(60.7), rng_loop)
+            result = aid_img.image_normalization(images, norm, np.float64(120.3), np.float64(60.7), chunk_size=64, rng=rng_vec)
+            assert result.dtype == np.float32
+            np.testing.assert_array_equal(result, expected)
+            assert rng_vec.random() == rng_loop.random()
+    # nan values are replaced, the output buffer is reused
+    images = rng.uniform(0, 255, size=(10, 8, 8, 1)).astype(np.float32)
+    images[2, 3, 4] = np.nan
+    out = aid_img.image_normalization(images, "Div. by 255")
+    assert not np.any(np.isnan(out))
+    assert aid_img.image_normalization(images, "None", out=out) is out
+    out16 = aid_img.image_normalization(images, "Div. by 255", out=out, dtype=np.float16)
+    assert out16.dtype == np.float16 and out16 is not out
+
+
+def test_contrast_brightn_noise_augm():
+    # fused kernel uses the same random numbers as the separate functions
+    rng = np.random.RandomState(42)
+    images = rng.randint(100, 156, size=(30, 24, 24, 1)).astype(np.uint8)
+    paras = (0.7, 1.3, -10, 10, 0.8, 1.2, 0, 0)
+    rng = aid_img.RngContext(1)
+    expected = aid_img.contrast_augm_cv2(images, *paras[:2], rng=rng)
+    expected = aid_img.brightn_noise_augm_cv2(expected, *paras[2:], rng=rng)
+    out = np.zeros_like(images)
+    result = aid_img.contrast_brightn_noise_augm_cv2(images, True, *paras, out=out, rng=aid_img.RngContext(1))
+    assert result is out
+    assert np.abs(result.astype(int) - expected).max() <= 1
+    # brightness and noise only, in place
+    expected = aid_img.brightn_noise_augm_cv2(images, -10, 10, 0.8, 1.2, 0, 3, rng=aid_img.RngContext(1))
+    result = aid_img.contrast_brightn_noise_augm_cv2(images, False, None, None, -10, 10, 0.8, 1.2, 0, 3, out=images,
+                                                     rng=aid_img.RngContext(1))
+    assert result is images
+    np.testing.assert_array_equal(result, expected)
@@ -45,6 +45,7 @@ dir_root = os.path.dirname(__file__)#ask the module for its origin
 sys.path.append(os.path.join(dir_root,"UI")) # For finding CustomWidget
 dir_settings = os.path.join(dir_root,"aid_settings.json")#dir to settings
 Default_dict = aid_start.get_default_dict(dir_settings)
+aid_bin.rtdc_handles.configure(max_open=Default_dict["rtdc max. open files"],rdcc_nbytes=Default_dict["rtdc chunk cache (MB)"]*1024**2)
 
 devices = device_lib.list_local_devices()
 device_types = [devices[i].device_type for i in range(len(devices))]
@@ -277,6 +278,11 @@ class AIDeveloper(QtWidgets.QWidget):
         self.table_dragdrop.resizeRowsToContents()
         
         self.btn_show.clicked.connect(self.action_show_example_imgs)
+        #Augmentation backend (saved in aid_settings.json)
+        index = self.comboBox_augBackend.findText(Default_dict["Augmentation backend"], QtCore.Qt.MatchFixedString)
+        if index >= 0:
+            self.comboBox_augBackend.setCurrentIndex(index)
+        self.comboBox_augBackend.currentIndexChanged.connect(self.action_set_augmentation_backend)
         
         ####### Load model from model_zoo #######
         self.predefined_models = model_zoo.get_predefined_models()
@@ -299,6 +305,8 @@ class AIDeveloper(QtWidgets.QWidget):
         self.threadpool_single = QtCore.QThreadPool()
         self.threadpool_single.setMaxThreadCount(1)
         self.threadpool_single_queue = 0 #count nr. of threads in queue;
+        self.threadpool_scan = QtCore.QThreadPool()#Threadpool for reading metadata of dropped files
+        self.threadpool_scan.setMaxThreadCount(Default_dict["Scan threads"])
 
         #self.threadpool_single = QtCore.QThread()
         self.fittingpopups = []  #This app will be designed to allow training of several models ...
@@ -315,7 +323,8 @@ class AIDeveloper(QtWidgets.QWidget):
         self.plt2 = None #Used for the history-tab to show accuracy of loaded history files
         self.plt_cm = [] #Used to show images from the interactive Confusion matrix
         self.model_2_convert = None #Variable to store the path to a chosen model (for converting to .nnet)
-        self.ram = dict() #Variable to store data if Option "Data to RAM is enabled"
+        self.ram = aid_img.RamCache() #Variable to store data if Option "Data to RAM is enabled"
+        self.rtdc_ds = None #.rtdc file shown in the histogram popup
         self.ValidationSet = None
         self.Metrics = dict()
         self.clr_settings = {}
@@ -339,160 +348,160 @@ class AIDeveloper(QtWidgets.QWidget):
         filenames = list(np.array(l)[ind_true]) #select the indices that are valid
         filenames = [x for x in filenames if x.endswith(".rtdc")]
 
-        fileinfo = []
-        for i in range(len(filenames)):
-            rtdc_path = filenames[i]
+        #Files are scanned in the background (threadpool_scan limits the nr.
+        #of files that are opened at the same time). Each file is added to
+        #the table as soon as its metadata is available
+        for rtdc_path in filenames:
+            worker = Worker(self.scan_rtdc_worker,str(rtdc_path))
+            worker.signals.result.connect(self.add_file_to_table)
+            self.threadpool_scan.start(worker)
 
-            try:
-                failed,rtdc_ds = aid_bin.load_rtdc(rtdc_path)
-                if failed:
-                    msg = QtWidgets.QMessageBox()
-                    msg.setIcon(QtWidgets.QMessageBox.Critical)
-                    msg.setText(str(rtdc_ds))
-                    msg.setWindowTitle("Error occurred during loading file")
-                    msg.setStandardButtons(QtWidgets.QMessageBox.Ok)
-                    msg.exec_()
-                    return
 
-                features = list(rtdc_ds["events"].keys())
-                #Make sure that there is "images", "pos_x" and "pos_y" available
-                if "image" in features and "pos_x" in features and "pos_y" in features:
-                    nr_images = rtdc_ds["events"]["image"].len()
-                    pix = rtdc_ds.attrs["imaging:pixel size"]
-                    xtra_in_available = len(rtdc_ds.keys())>2 #Is True, only if there are more than 2 elements.
-                    fileinfo.append({"rtdc_ds":rtdc_ds,"rtdc_path":rtdc_path,"features":features,"nr_images":nr_images,"pix":pix,"xtra_in":xtra_in_available})
-                else:
-                    missing = []
-                    for feat in ["image","pos_x","pos_y"]:
-                        if feat not in features:
-                            missing.append(feat)
-                    msg = QtWidgets.QMessageBox()
-                    msg.setIcon(QtWidgets.QMessageBox.Information)
-                    msg.setText("Essential feature(s) are missing in data-set")
-                    msg.setDetailedText("Data-set: "+rtdc_path+"\nis missing "+str(missing))
-                    msg.setWindowTitle("Missing essential features")
-                    msg.setStandardButtons(QtWidgets.QMessageBox.Ok)
-                    msg.exec_()
+    def scan_rtdc_worker(self,rtdc_path,progress_callback,history_callback):
+        try:
+            return aid_bin.scan_rtdc(rtdc_path)
+        except Exception as e:
+            return {"rtdc_path":rtdc_path,"error":e}
 
-            except Exception as e:
-                print(e)
 
+    def add_file_to_table(self,fileinfo):
+        rtdc_path = fileinfo["rtdc_path"]
+        if "error" in fileinfo:
+            print(fileinfo["error"])
+            msg = QtWidgets.QMessageBox()
+            msg.setIcon(QtWidgets.QMessageBox.Critical)
+            msg.setText(str(fileinfo["error"]))
+            msg.setDetailedText("Data-set: "+rtdc_path)
+            msg.setWindowTitle("Error occurred during loading file")
+            msg.setStandardButtons(QtWidgets.QMessageBox.Ok)
+            msg.exec_()
+            return
 
-        for rowNumber in range(len(fileinfo)):#for url in l:
-            url = fileinfo[rowNumber]["rtdc_path"]
-            #add to table
-            rowPosition = self.table_dragdrop.rowCount()
-            self.table_dragdrop.insertRow(rowPosition)
-            
-            columnPosition = 0 #Del
-            btn_delete = QtWidgets.QPushButton(self.table_dragdrop)
-            btn_delete.setMaximumSize(QtCore.QSize(30, 30))
-            icon_del = QtGui.QIcon()
-            icon_del.addPixmap(QtGui.QPixmap(":/icon/icon/delete.png"), QtGui.QIcon.Normal, QtGui.QIcon.Off)
-            btn_delete.setIcon(icon_del)
-            self.table_dragdrop.setCellWidget(rowPosition, columnPosition, btn_delete) 
-            #self.table_dragdrop.resizeRowsToContents()
-            btn_delete.clicked.connect(self.delete_item)  
-            
-            
-            columnPosition = 1 #File
-            line = QtWidgets.QTableWidgetItem()
-            line.setText(url) # When there is / in the string, the left side cannot be elided.
-            #line.setTextAlignment(QtCore.Qt.AlignLeft)
-            #line.setTextElideMode(QtCore.Qt.ElideLeft)
-            line.setFlags( QtCore.Qt.ItemIsSelectable |  QtCore.Qt.ItemIsEnabled )
-            line.setToolTip(url)
-
-            self.table_dragdrop.setColumnWidth(columnPosition,100)
-            self.table_dragdrop.setItem(rowPosition, columnPosition, line)
-            
+        #Make sure that there is "images", "pos_x" and "pos_y" available
+        missing = [feat for feat in ["image","pos_x","pos_y"] if feat not in fileinfo["features"]]
+        if len(missing)>0:
+            msg = QtWidgets.QMessageBox()
+            msg.setIcon(QtWidgets.QMessageBox.Information)
+            msg.setText("Essential feature(s) are missing in data-set")
+            msg.setDetailedText("Data-set: "+rtdc_path+"\nis missing "+str(missing))
+            msg.setWindowTitle("Missing essential features")
+            msg.setStandardButtons(QtWidgets.QMessageBox.Ok)
+            msg.exec_()
+            return
 
-            columnPosition = 2 #Class
-            comboBox = QtWidgets.QComboBox(self.table_dragdrop)
-            class_items =["0","1","2","3","4","5","6","7","8","9"]
-            comboBox.addItems(class_items)
-            comboBox.setStyleSheet("QComboBox {"
-                                   "combobox-popup: 0;}"
-
-                                    "QComboBox:drop-down {"
-                                    "width:20px; "
-                                    "subcontrol-position: right center; "  # position
-                                    "subcontrol-origin: padding;}\n"  # alignment
-                                    )
-
-            comboBox.currentIndexChanged.connect(self.dataOverviewOn)
-            self.table_dragdrop.setCellWidget(rowPosition, columnPosition, comboBox)
-
-            for columnPosition in [3,4]: #T/V
-                #for each item, also create 2 checkboxes (train/valid)
-                item = QtWidgets.QTableWidgetItem()#("item {0} {1}".format(rowNumber, columnNumber))
-                item.setFlags( QtCore.Qt.ItemIsUserCheckable | QtCore.Qt.ItemIsEnabled  )
-                item.setCheckState(QtCore.Qt.Unchecked)
-                self.table_dragdrop.setItem(rowPosition, columnPosition, item)
+        url = fileinfo["rtdc_path"]
+        #add to table
+        rowPosition = self.table_dragdrop.rowCount()
+        self.table_dragdrop.insertRow(rowPosition)
+        
+        columnPosition = 0 #Del
+        btn_delete = QtWidgets.QPushButton(self.table_dragdrop)
+        btn_delete.setMaximumSize(QtCore.QSize(30, 30))
+        icon_del = QtGui.QIcon()
+        icon_del.addPixmap(QtGui.QPixmap(":/icon/icon/delete.png"), QtGui.QIcon.Normal, QtGui.QIcon.Off)
+        btn_delete.setIcon(icon_del)
+        self.table_dragdrop.setCellWidget(rowPosition, columnPosition, btn_delete) 
+        #self.table_dragdrop.resizeRowsToContents()
+        btn_delete.clicked.connect(self.delete_item)  
+        
+        
+        columnPosition = 1 #File
+        line = QtWidgets.QTableWidgetItem()
+        line.setText(url) # When there is / in the string, the left side cannot be elided.
+        #line.setTextAlignment(QtCore.Qt.AlignLeft)
+        #line.setTextElideMode(QtCore.Qt.ElideLeft)
+        line.setFlags( QtCore.Qt.ItemIsSelectable |  QtCore.Qt.ItemIsEnabled )
+        line.setToolTip(url)
+
+        self.table_dragdrop.setColumnWidth(columnPosition,100)
+        self.table_dragdrop.setItem(rowPosition, columnPosition, line)
+        
 
-            columnPosition = 5 #Show plot
-            #Place a button which allows to show a plot (scatter, histo...lets see)
-            btn = QtWidgets.QPushButton(self.table_dragdrop)
-            btn.setMinimumSize(50, 30)
-            btn.setMaximumSize(50, 30)
-            btn.clicked.connect(self.button_hist)
-            btn.setText('Plot')
-            self.table_dragdrop.setCellWidget(rowPosition, columnPosition, btn)
-            self.table_dragdrop.resizeRowsToContents()
-
-            columnPosition = 6 #Events
-            #Place a combobox with the available features
-            item = QtWidgets.QTableWidgetItem()
-            item.setData(QtCore.Qt.DisplayRole, fileinfo[rowNumber]["nr_images"])
-            item.setFlags(item.flags() &~QtCore.Qt.ItemIsEnabled &~ QtCore.Qt.ItemIsSelectable )
-            item.setTextAlignment(QtCore.Qt.AlignHCenter | QtCore.Qt.AlignVCenter)
-            self.table_dragdrop.setItem(rowPosition, columnPosition, item)
+        columnPosition = 2 #Class
+        comboBox = QtWidgets.QComboBox(self.table_dragdrop)
+        class_items =["0","1","2","3","4","5","6","7","8","9"]
+        comboBox.addItems(class_items)
+        comboBox.setStyleSheet("QComboBox {"
+                               "combobox-popup: 0;}"
 
-            columnPosition = 7 #Events/Epoch
-            #Field to user-define nr. of cells/epoch
-            item = QtWidgets.QTableWidgetItem()
-            item.setData(QtCore.Qt.EditRole,100)
-            item.setTextAlignment(QtCore.Qt.AlignHCenter | QtCore.Qt.AlignVCenter)
-            self.table_dragdrop.setItem(rowPosition, columnPosition, item)
+                                "QComboBox:drop-down {"
+                                "width:20px; "
+                                "subcontrol-position: right center; "  # position
+                                "subcontrol-origin: padding;}\n"  # alignment
+                                )
 
-            columnPosition = 8 #pixel
-            #Pixel size
-            item = QtWidgets.QTableWidgetItem()
-            pix = float(fileinfo[rowNumber]["pix"])
-            #print(pix)
-            item.setData(QtCore.Qt.EditRole,pix)
-            item.setTextAlignment(QtCore.Qt.AlignHCenter | QtCore.Qt.AlignVCenter)
-            self.table_dragdrop.setItem(rowPosition, columnPosition, item)
+        comboBox.currentIndexChanged.connect(self.dataOverviewOn)
+        self.table_dragdrop.setCellWidget(rowPosition, columnPosition, comboBox)
 
-            columnPosition = 9 #Shuffle
-            #Should data be shuffled (random?)
+        for columnPosition in [3,4]: #T/V
+            #for each item, also create 2 checkboxes (train/valid)
             item = QtWidgets.QTableWidgetItem()#("item {0} {1}".format(rowNumber, columnNumber))
             item.setFlags( QtCore.Qt.ItemIsUserCheckable | QtCore.Qt.ItemIsEnabled  )
-            item.setCheckState(QtCore.Qt.Checked)
-            item.setTextAlignment(QtCore.Qt.AlignHCenter | QtCore.Qt.AlignVCenter)
-            self.table_dragdrop.setItem(rowPosition, columnPosition, item)
-
-            columnPosition = 10 #Zoom
-            #Zooming factor
-            item = QtWidgets.QTableWidgetItem()
-            zoom = 1.0
-            item.setData(QtCore.Qt.EditRole,zoom)
-            item.setTextAlignment(QtCore.Qt.AlignHCenter | QtCore.Qt.AlignVCenter)
+            item.setCheckState(QtCore.Qt.Unchecked)
             self.table_dragdrop.setItem(rowPosition, columnPosition, item)
 
-            columnPosition = 11  #Xtra_In
-            #Should xtra_data be used?
-            item = QtWidgets.QTableWidgetItem()
-            xtra_in_available = fileinfo[rowNumber]["xtra_in"]
-            if xtra_in_available:
-                item.setFlags( QtCore.Qt.ItemIsUserCheckable | QtCore.Qt.ItemIsEnabled  )
-            else:
-                item.setFlags( QtCore.Qt.ItemIsUserCheckable )
-            item.setCheckState(QtCore.Qt.Unchecked)
+        columnPosition = 5 #Show plot
+        #Place a button which allows to show a plot (scatter, histo...lets see)
+        btn = QtWidgets.QPushButton(self.table_dragdrop)
+        btn.setMinimumSize(50, 30)
+        btn.setMaximumSize(50, 30)
+        btn.clicked.connect(self.button_hist)
+        btn.setText('Plot')
+        self.table_dragdrop.setCellWidget(rowPosition, columnPosition, btn)
+        self.table_dragdrop.resizeRowsToContents()
 
-            item.setTextAlignment(QtCore.Qt.AlignHCenter | QtCore.Qt.AlignVCenter)
-            self.table_dragdrop.setItem(rowPosition, columnPosition, item)
+        columnPosition = 6 #Events
+        #Place a combobox with the available features
+        item = QtWidgets.QTableWidgetItem()
+        item.setData(QtCore.Qt.DisplayRole, fileinfo["nr_images"])
+        item.setFlags(item.flags() &~QtCore.Qt.ItemIsEnabled &~ QtCore.Qt.ItemIsSelectable )
+        item.setTextAlignment(QtCore.Qt.AlignHCenter | QtCore.Qt.AlignVCenter)
+        self.table_dragdrop.setItem(rowPosition, columnPosition, item)
+
+        columnPosition = 7 #Events/Epoch
+        #Field to user-define nr. of cells/epoch
+        item = QtWidgets.QTableWidgetItem()
+        item.setData(QtCore.Qt.EditRole,100)
+        item.setTextAlignment(QtCore.Qt.AlignHCenter | QtCore.Qt.AlignVCenter)
+        self.table_dragdrop.setItem(rowPosition, columnPosition, item)
+
+        columnPosition = 8 #pixel
+        #Pixel size
+        item = QtWidgets.QTableWidgetItem()
+        pix = float(fileinfo["pix"])
+        #print(pix)
+        item.setData(QtCore.Qt.EditRole,pix)
+        item.setTextAlignment(QtCore.Qt.AlignHCenter | QtCore.Qt.AlignVCenter)
+        self.table_dragdrop.setItem(rowPosition, columnPosition, item)
+
+        columnPosition = 9 #Shuffle
+        #Should data be shuffled (random?)
+        item = QtWidgets.QTableWidgetItem()#("item {0} {1}".format(rowNumber, columnNumber))
+        item.setFlags( QtCore.Qt.ItemIsUserCheckable | QtCore.Qt.ItemIsEnabled  )
+        item.setCheckState(QtCore.Qt.Checked)
+        item.setTextAlignment(QtCore.Qt.AlignHCenter | QtCore.Qt.AlignVCenter)
+        self.table_dragdrop.setItem(rowPosition, columnPosition, item)
+
+        columnPosition = 10 #Zoom
+        #Zooming factor
+        item = QtWidgets.QTableWidgetItem()
+        zoom = 1.0
+        item.setData(QtCore.Qt.EditRole,zoom)
+        item.setTextAlignment(QtCore.Qt.AlignHCenter | QtCore.Qt.AlignVCenter)
+        self.table_dragdrop.setItem(rowPosition, columnPosition, item)
+
+        columnPosition = 11  #Xtra_In
+        #Should xtra_data be used?
+        item = QtWidgets.QTableWidgetItem()
+        xtra_in_available = fileinfo["xtra_in"]
+        if xtra_in_available:
+            item.setFlags( QtCore.Qt.ItemIsUserCheckable | QtCore.Qt.ItemIsEnabled  )
+        else:
+            item.setFlags( QtCore.Qt.ItemIsUserCheckable )
+        item.setCheckState(QtCore.Qt.Unchecked)
 
+        item.setTextAlignment(QtCore.Qt.AlignHCenter | QtCore.Qt.AlignVCenter)
+        self.table_dragdrop.setItem(rowPosition, columnPosition, item)
 
 
 
@@ -588,12 +597,12 @@ class AIDeveloper(QtWidgets.QWidget):
             #Prepare a table in tableWidget_Info
             self.tableWidget_Info.setColumnCount(0)
             self.tableWidget_Info.setRowCount(0)
-            self.tableWidget_Info.setColumnCount(4)
+            self.tableWidget_Info.setColumnCount(5)
             header = self.tableWidget_Info.horizontalHeader()
-            header_labels = ["Class","Events tot.","Events/Epoch","Name"]
+            header_labels = ["Class","Events tot.","Events/Epoch","Name","RAM"]
             self.tableWidget_Info.setHorizontalHeaderLabels(header_labels)
             header = self.tableWidget_Info.horizontalHeader()
-            for i in range(4):
+            for i in range(5):
                 header.setSectionResizeMode(i, QtWidgets.QHeaderView.ResizeToContents)
                 #header.setSectionResizeMode(i, QtWidgets.QHeaderView.Stretch)
             return
@@ -602,24 +611,24 @@ class AIDeveloper(QtWidgets.QWidget):
         self.tableWidget_Info.setRowCount(0)
 
         indices = [SelectedFiles[i]["class"] for i in range(len(SelectedFiles))]
-        self.tableWidget_Info.setColumnCount(4)
+        self.tableWidget_Info.setColumnCount(5)
         header = self.tableWidget_Info.horizontalHeader()
 
         nr_ind = len(set(indices)) #each index could occur for train and valid
         nr_rows = 2*nr_ind+2 #add two rows for intermediate headers (Train/Valid)
         self.tableWidget_Info.setRowCount(nr_rows)
         #Wich selected file has the most features?
-        header_labels = ["Class","Events tot.","Events/Epoch","Name"]
+        header_labels = ["Class","Events tot.","Events/Epoch","Name","RAM"]
         self.tableWidget_Info.setHorizontalHeaderLabels(header_labels)
         #self.tableWidget_Info.resizeColumnsToContents()
         header = self.tableWidget_Info.horizontalHeader()
-        for i in range(4):
+        for i in range(5):
             header.setSectionResizeMode(i, QtWidgets.QHeaderView.ResizeToContents)
             #header.setSectionResizeMode(i, QtWidgets.QHeaderView.Stretch)
 
         #Training info
         rowPosition = 0
-        self.tableWidget_Info.setSpan(rowPosition, 0, 1, 4)
+        self.tableWidget_Info.setSpan(rowPosition, 0, 1, 5)
         item = QtWidgets.QTableWidgetItem("Train. data")
         item.setTextAlignment(QtCore.Qt.AlignHCenter| QtCore.Qt.AlignVCenter)
 
@@ -669,10 +678,12 @@ class AIDeveloper(QtWidgets.QWidget):
                 item.setData(QtCore.Qt.EditRole,self.classes_custom[index_])
             self.tableWidget_Info.setItem(rowPosition, 3, item)
 
+            self.tableWidget_Info.setItem(rowPosition, 4, self.ram_status_item(SelectedFiles_train_index))
+
             rowPosition += 1
 
         #Validation info
-        self.tableWidget_Info.setSpan(rowPosition, 0, 1, 4)
+        self.tableWidget_Info.setSpan(rowPosition, 0, 1, 5)
         item = QtWidgets.QTableWidgetItem("Val. data")
         item.setTextAlignment(QtCore.Qt.AlignHCenter| QtCore.Qt.AlignVCenter)
         item.setFlags(QtCore.Qt.ItemIsEnabled | QtCore.Qt.ItemIsSelectable)
@@ -703,10 +714,29 @@ class AIDeveloper(QtWidgets.QWidget):
             item.setFlags(QtCore.Qt.ItemIsEnabled | QtCore.Qt.ItemIsSelectable)
             item.setData(QtCore.Qt.EditRole, str(np.sum(nr_events_epoch)))
             self.tableWidget_Info.setItem(rowPosition, 2, item)
+
+            self.tableWidget_Info.setItem(rowPosition, 4, self.ram_status_item(SelectedFiles_valid_index))
             rowPosition += 1
         self.tableWidget_Info.resizeColumnsToContents()
         self.tableWidget_Info.resizeRowsToContents()
 
+    def ram_status_item(self,SelectedFiles):
+        #Table item for the data overview: how many of the files are in RAM and up to date (see aid_img.RamCache.status)
+        crop = int(self.spinBox_imagecrop.value())
+        zoom_order = int(self.comboBox_zoomOrder.currentIndex()) #the combobox-index is already the zoom order
+        color_mode = self.get_color_mode()
+        paddingMode = str(self.comboBox_paddingMode.currentText())
+        status = []
+        for selectedfile in SelectedFiles:
+            params = aid_img.ram_params(crop,selectedfile["zoom_factor"],zoom_order,color_mode,paddingMode,selectedfile["xtra_in"])
+            status.append(self.ram.status(selectedfile["rtdc_path"],params))
+        item = QtWidgets.QTableWidgetItem()
+        item.setFlags(QtCore.Qt.ItemIsEnabled | QtCore.Qt.ItemIsSelectable)
+        item.setData(QtCore.Qt.EditRole, str(status.count("RAM"))+"/"+str(len(status)))
+        tooltip = [os.path.basename(selectedfile["rtdc_path"])+": "+status_ for selectedfile,status_ in zip(SelectedFiles,status)]
+        item.setToolTip("\n".join(tooltip))
+        return item
+
     def delete_item(self,item):
         """
         delete table item and corresponding layers
@@ -727,16 +757,10 @@ class AIDeveloper(QtWidgets.QWidget):
                 rtdc_path = self.table_dragdrop.item(rowPosition, 1).text()
                 rtdc_path = str(rtdc_path)
 
-                failed,rtdc_ds = aid_bin.load_rtdc(rtdc_path)
-                if failed:
-                    msg = QtWidgets.QMessageBox()
-                    msg.setIcon(QtWidgets.QMessageBox.Critical)
-                    msg.setText(str(rtdc_ds))
-                    msg.setWindowTitle("Error occurred during loading file")
-                    msg.setStandardButtons(QtWidgets.QMessageBox.Ok)
-                    msg.exec_()
+                fileinfo = self.get_fileinfo(rtdc_path)
+                if fileinfo is None:
                     return
-                nr_images = rtdc_ds["events"]["image"].len()
+                nr_images = fileinfo["nr_images"]
 
                 columnPosition = 7 #Ev./Ep.
                 item = QtWidgets.QTableWidgetItem()
@@ -787,7 +811,7 @@ class AIDeveloper(QtWidgets.QWidget):
 
             nr_images = rtdc_ds["events"]["image"].len()
             ind = np.random.randint(0,nr_images)
-            img = rtdc_ds["events"]["image"][ind]
+            img = aid_bin.read_events(rtdc_ds["events"]["image"],[ind])[0]
             if len(img.shape)==2:
                 height, width = img.shape
                 channels = 1
@@ -846,6 +870,21 @@ class AIDeveloper(QtWidgets.QWidget):
 
             self.send_to_napari(sample_img)
 
+    def get_fileinfo(self,rtdc_path):
+        #Metadata of a file in the table (aid_bin.scan_rtdc). The metadata is cached,
+        #hence the file is not opened again (only if it was modified on disk).
+        #Returns None after informing the user, if the file can't be opened
+        try:
+            return aid_bin.scan_rtdc(rtdc_path)
+        except Exception as e:
+            msg = QtWidgets.QMessageBox()
+            msg.setIcon(QtWidgets.QMessageBox.Critical)
+            msg.setText(str(e))
+            msg.setWindowTitle("Error occurred during loading file")
+            msg.setStandardButtons(QtWidgets.QMessageBox.Ok)
+            msg.exec_()
+            return None
+
     def items_clicked(self):
         #This function checks, which data has been checked on table_dragdrop and returns the necessary data
         rowCount = self.table_dragdrop.rowCount()
@@ -870,36 +909,19 @@ class AIDeveloper(QtWidgets.QWidget):
             xtra_in = bool(self.table_dragdrop.item(rowPosition, 11).checkState())
 
             if cb_t.checkState() == QtCore.Qt.Checked and nr_events_epoch>0: #add to training files if the user wants more than 0 images per epoch
-                failed,rtdc_ds = aid_bin.load_rtdc(rtdc_path)
-                if failed:
-                    msg = QtWidgets.QMessageBox()
-                    msg.setIcon(QtWidgets.QMessageBox.Critical)
-                    msg.setText(str(rtdc_ds))
-                    msg.setWindowTitle("Error occurred during loading file")
-                    msg.setStandardButtons(QtWidgets.QMessageBox.Ok)
-                    msg.exec_()
+                fileinfo = self.get_fileinfo(rtdc_path)
+                if fileinfo is None:
                     return
-
                 hash_ = aid_bin.hashfunction(rtdc_path)#rtdc_ds.hash
-                features = list(rtdc_ds["events"].keys())
-                nr_images = rtdc_ds["events"]["image"].len()
-                SelectedFiles.append({"rtdc_ds":rtdc_ds,"rtdc_path":rtdc_path,"features":features,"nr_images":nr_images,"class":index,"TrainOrValid":"Train","nr_events":nr_events,"nr_events_epoch":nr_events_epoch,"shuffle":shuffle,"zoom_factor":zoom_factor,"hash":hash_,"xtra_in":xtra_in})
+                SelectedFiles.append({"rtdc_path":rtdc_path,"features":fileinfo["features"],"nr_images":fileinfo["nr_images"],"class":index,"TrainOrValid":"Train","nr_events":nr_events,"nr_events_epoch":nr_events_epoch,"shuffle":shuffle,"zoom_factor":zoom_factor,"hash":hash_,"xtra_in":xtra_in})
 
             cb_v = self.table_dragdrop.item(rowPosition, 4)
             if cb_v.checkState() == QtCore.Qt.Checked and nr_events_epoch>0:
-                failed,rtdc_ds = aid_bin.load_rtdc(rtdc_path)
-                if failed:
-                    msg = QtWidgets.QMessageBox()
-                    msg.setIcon(QtWidgets.QMessageBox.Critical)
-                    msg.setText(str(rtdc_ds))
-                    msg.setWindowTitle("Error occurred during loading file")
-                    msg.setStandardButtons(QtWidgets.QMessageBox.Ok)
-                    msg.exec_()
+                fileinfo = self.get_fileinfo(rtdc_path)
+                if fileinfo is None:
                     return
                 hash_ = aid_bin.hashfunction(rtdc_path)
-                features = list(rtdc_ds["events"].keys())
-                nr_images = rtdc_ds["events"]["image"].len()
-                SelectedFiles.append({"rtdc_ds":rtdc_ds,"rtdc_path":rtdc_path,"features":features,"nr_images":nr_images,"class":index,"TrainOrValid":"Valid","nr_events":nr_events,"nr_events_epoch":nr_events_epoch,"shuffle":shuffle,"zoom_factor":zoom_factor,"hash":hash_,"xtra_in":xtra_in})
+                SelectedFiles.append({"rtdc_path":rtdc_path,"features":fileinfo["features"],"nr_images":fileinfo["nr_images"],"class":index,"TrainOrValid":"Valid","nr_events":nr_events,"nr_events_epoch":nr_events_epoch,"shuffle":shuffle,"zoom_factor":zoom_factor,"hash":hash_,"xtra_in":xtra_in})
         return SelectedFiles
 
 
@@ -961,16 +983,10 @@ class AIDeveloper(QtWidgets.QWidget):
                     rtdc_path = self.table_dragdrop.item(rowPosition, 1).text()
                     rtdc_path = str(rtdc_path)
 
-                    failed,rtdc_ds = aid_bin.load_rtdc(rtdc_path)
-                    if failed:
-                        msg = QtWidgets.QMessageBox()
-                        msg.setIcon(QtWidgets.QMessageBox.Critical)
-                        msg.setText(str(rtdc_ds))
-                        msg.setWindowTitle("Error occurred during loading file")
-                        msg.setStandardButtons(QtWidgets.QMessageBox.Ok)
-                        msg.exec_()
+                    fileinfo = self.get_fileinfo(rtdc_path)
+                    if fileinfo is None:
                         return
-                    nr_images = rtdc_ds["events"]["image"].len()
+                    nr_images = fileinfo["nr_images"]
 
                     columnPosition = 7
                     item = QtWidgets.QTableWidgetItem()
@@ -993,7 +1009,7 @@ class AIDeveloper(QtWidgets.QWidget):
         rtdc_path = self.table_dragdrop.item(rowPosition, 1).text()
         rtdc_path = str(rtdc_path)
 
-        failed,rtdc_ds = aid_bin.load_rtdc(rtdc_path)
+        failed,rtdc_ds = aid_bin.load_rtdc(rtdc_path,pin=True)#the popup keeps using the file
         if failed:
             msg = QtWidgets.QMessageBox()
             msg.setIcon(QtWidgets.QMessageBox.Critical)
@@ -1003,6 +1019,8 @@ class AIDeveloper(QtWidgets.QWidget):
             msg.exec_()
             return
 
+        if self.rtdc_ds is not None:#file of the previous popup is not needed anymore
+            aid_bin.release_rtdc(self.rtdc_ds)
         self.rtdc_ds = rtdc_ds
 #        feature_values = rtdc_ds[feature]
         #Init a popup window
@@ -1190,15 +1208,9 @@ class AIDeveloper(QtWidgets.QWidget):
         shuffle = [selectedfile["shuffle"] for selectedfile in SelectedFiles]
         #If the scaling method is "divide by mean and std of the whole training set":
         if norm == "StdScaling using mean and std of all training data":
-            mean_trainingdata,std_trainingdata = [],[]
-            for i in range(len(SelectedFiles)):
-                gen = aid_img.gen_crop_img(crop,rtdc_path[i],random_images=False,zoom_factor=zoom_factors[i],zoom_order=zoom_order,color_mode=self.comboBox_GrayOrRGB.currentText(),padding_mode=paddingMode)
-
-                images = next(gen)[0]
-                mean_trainingdata.append(np.mean(images))
-                std_trainingdata.append(np.std(images))
-            mean_trainingdata = np.mean(np.array(mean_trainingdata))
-            std_trainingdata = np.mean(np.array(std_trainingdata))
+            #Statistics are computed chunk-wise, pooled over all files and cached (see aid_img.image_stats)
+            stats = [aid_img.image_stats(rtdc_path[i],crop,zoom_factor=zoom_factors[i],zoom_order=zoom_order,color_mode=self.comboBox_GrayOrRGB.currentText(),padding_mode=paddingMode,roi_read=Default_dict["ROI read"]) for i in range(len(SelectedFiles))]
+            mean_trainingdata,std_trainingdata = aid_img.pooled_mean_std(stats)
             if np.allclose(std_trainingdata,0):
                 std_trainingdata = 0.0001
                 print("std_trainingdata was zero and is now set to 0.0001 to avoid div. by zero!")
@@ -1216,7 +1228,7 @@ class AIDeveloper(QtWidgets.QWidget):
             X,y = [],[]
             for i in range(len(SelectedFiles)):
                 gen = aid_img.gen_crop_img(cropsize2,rtdc_path[i],10,random_images=True,replace=True,zoom_factor=zoom_factors[i],\
-                                           zoom_order=zoom_order,color_mode=self.comboBox_GrayOrRGB.currentText(),padding_mode=paddingMode)
+                                           zoom_order=zoom_order,color_mode=self.comboBox_GrayOrRGB.currentText(),padding_mode=paddingMode,roi_read=Default_dict["ROI read"])
                 print("gen success")
 
                 try: #When all cells are at the border of the image, the generator will be empty. Avoid program crash by try, except
@@ -1238,7 +1250,10 @@ class AIDeveloper(QtWidgets.QWidget):
             else:
                 print("Invalid data dimension:" +str(X.shape))
 
-            X_batch, y_batch = aid_img.affine_augm(X,v_flip,h_flip,rotation,width_shift,height_shift,zoom,shear), y #Affine image augmentation
+            if Default_dict["Single-warp affine augm."]:
+                X_batch, y_batch = aid_img.affine_augm_crop(X,v_flip,h_flip,rotation,width_shift,height_shift,zoom,shear,crop,crop), y #Affine image augmentation directly to the final size
+            else:
+                X_batch, y_batch = aid_img.affine_augm(X,v_flip,h_flip,rotation,width_shift,height_shift,zoom,shear), y #Affine image augmentation
             X_batch = X_batch.astype(np.uint8) #make sure we stay in uint8
 
             #Now do the final cropping to the actual size that was set by user
@@ -1278,7 +1293,7 @@ class AIDeveloper(QtWidgets.QWidget):
             ############Cropping#####################
             X,y = [],[]
             for i in range(len(SelectedFiles)):
-                gen = aid_img.gen_crop_img(crop,rtdc_path[i],10,random_images=True,replace=True,zoom_factor=zoom_factors[i],zoom_order=zoom_order,color_mode=self.comboBox_GrayOrRGB.currentText(),padding_mode=paddingMode)
+                gen = aid_img.gen_crop_img(crop,rtdc_path[i],10,random_images=True,replace=True,zoom_factor=zoom_factors[i],zoom_order=zoom_order,color_mode=self.comboBox_GrayOrRGB.currentText(),padding_mode=paddingMode,roi_read=Default_dict["ROI read"])
 
                 try:
                     X.append(next(gen)[0])
@@ -1588,6 +1603,11 @@ class AIDeveloper(QtWidgets.QWidget):
         Default_dict["Path of last model"] = os.path.split(filename)[0]
         aid_bin.save_aid_settings(Default_dict)
 
+    def action_set_augmentation_backend(self):
+        #Remember the augmentation backend ("cv2" or "tf"); used for the next training
+        Default_dict["Augmentation backend"] = str(self.comboBox_augBackend.currentText())
+        aid_bin.save_aid_settings(Default_dict)
+
 
     def action_initialize_model(self,duties="initialize_train"):
         """
@@ -2165,9 +2185,9 @@ class AIDeveloper(QtWidgets.QWidget):
             cropsize2 = np.sqrt(crop**2+crop**2)
             cropsize2 = np.ceil(cropsize2 / 2.) * 2 #round to the next even number
 
-            #Estimate RAM needed
-            nr_imgs = np.sum([np.array(list(SelectedFiles)[i]["nr_images"]) for i in range(len(list(SelectedFiles)))])
-            ram_needed = np.round(nr_imgs * aid_bin.calc_ram_need(cropsize2),2)
+            #Estimate RAM needed (data in RAM and training pipeline)
+            plan = self.get_memory_plan(SelectedFiles,nr_classes)
+            ram_needed = np.round(plan["Peak"]/1024**2,2)
 
             if duties=="initialize":#Stop here if the model just needs to be intialized (for expert mode->partial trainability)
                 return
@@ -2392,6 +2412,10 @@ class AIDeveloper(QtWidgets.QWidget):
             elif yes_or_no == "&No":
                 pass
 
+        if DATA_len>0:
+            #Data was moved to RAM before. Update it (only new or changed files are loaded)
+            self.refresh_ram(self.items_clicked())
+            self.dataOverviewOn()
         if DATA_len==0:
            msg = QtWidgets.QMessageBox()
            msg.setIcon(QtWidgets.QMessageBox.Information)
@@ -2401,6 +2425,10 @@ class AIDeveloper(QtWidgets.QWidget):
            msg.buttonClicked.connect(popup_data_to_ram)
            msg.exec_()
 
+        #Compare the memory needed for training to the available memory
+        if not self.check_memory_plan(nr_classes):
+            return
+
         ###################Popup Window####################################
         self.fittingpopups = Fitting_Ui()
 # =============================================================================
@@ -2425,6 +2453,7 @@ class AIDeveloper(QtWidgets.QWidget):
         self.fittingpopups.setWindowTitle(os.path.split(new_modelname)[1])
         self.fittingpopups.progressBar_Fitting_pop.setValue(0) #set the progress bar to zero
         self.fittingpopups.tableWidget_HistoryInfo_pop.doubleClicked.connect(lambda item: self.tableWidget_HistoryInfo_pop_dclick(item))
+        self.fittingpopups.textBrowser_FittingInfo.append(self.memory_plan_info)
 
 
 
@@ -2460,7 +2489,7 @@ class AIDeveloper(QtWidgets.QWidget):
                         keys.insert(i,keys_first[i])
 
             for key in keys:
-                if "precision" in key or "auc" in key or "recall" in key or "LearningRate" in key:
+                if "precision" in key or "auc" in key or "recall" in key or "LearningRate" in key or key in ["Prefetch time","Idle time"]:
                     if not key in OtherMetrics_keys: #if this key is missing in self.fittingpopups.RealTime_OtherMetrics attach it!
                         self.fittingpopups.RealTime_OtherMetrics[key] = []
                     self.fittingpopups.RealTime_OtherMetrics[key].append(dic[key])
@@ -2520,7 +2549,7 @@ class AIDeveloper(QtWidgets.QWidget):
                                 y = np.array(self.fittingpopups.RealTime_Loss).astype(float)
                             elif key=="val_loss":
                                 y = np.array(self.fittingpopups.RealTime_ValLoss).astype(float)
-                            elif "precision" in key or "auc" in key or "recall" in key or "LearningRate" in key:
+                            elif "precision" in key or "auc" in key or "recall" in key or "LearningRate" in key or key in ["Prefetch time","Idle time"]:
                                y = np.array(self.fittingpopups.RealTime_OtherMetrics[key]).astype(float).reshape(-1,)
                             else:
                                 return
@@ -2544,6 +2573,56 @@ class AIDeveloper(QtWidgets.QWidget):
 
 
 
+    def get_memory_plan(self,SelectedFiles,nr_classes,ram_cache=True):
+        #Memory needed for training using the current settings (see aid_bin.memory_plan)
+        #ram_cache: if False, all data is read from .rtdc
+        crop = int(self.spinBox_imagecrop.value())
+        nr_processes = Default_dict["Augmentation processes"]
+        if nr_processes==0:
+            nr_processes = os.cpu_count()
+        max_bytes = aid_bin.ram_budget_bytes(Default_dict["RAM cache budget"]) if ram_cache else 0
+        return aid_bin.memory_plan(list(SelectedFiles),crop,self.get_color_mode(),nr_classes,batch_size=32,
+                                   max_bytes=max_bytes,streaming=Default_dict["Streaming pipeline"],
+                                   prefetch_depth=Default_dict["Prefetch queue depth"],aug_processes=nr_processes)
+
+    def check_memory_plan(self,nr_classes):
+        #Show the memory plan and warn if it exceeds the available memory. If
+        #"Memory plan auto-shrink" is on, Events/Epoch of the training files are reduced instead
+        #Returns False if the user cancelled
+        SelectedFiles = self.items_clicked()
+        plan = self.get_memory_plan(SelectedFiles,nr_classes,ram_cache=len(self.ram)>0)
+        #memory of data that is already in RAM is part of the plan
+        available = aid_bin.ram_budget_bytes(1.0)+self.ram.nbytes
+        text = "Estimated memory for training:\n"+aid_bin.memory_plan_text(plan)
+        text += "\nAvailable: "+str(np.round(available/1024**2,1))+" MB"
+        self.memory_plan_info = text
+        print(text)
+
+        scale = aid_bin.memory_plan_scale(plan,available)
+        if scale>=1:
+            return True
+        if Default_dict["Memory plan auto-shrink"] and scale>0:
+            for rowPosition in range(self.table_dragdrop.rowCount()):
+                train = self.table_dragdrop.item(rowPosition, 3).checkState() == QtCore.Qt.Checked
+                shuffle = bool(self.table_dragdrop.item(rowPosition, 9).checkState())
+                if train and shuffle:
+                    item = self.table_dragdrop.item(rowPosition, 7)
+                    nr_events_epoch = int(item.text())
+                    item.setData(QtCore.Qt.DisplayRole, max(1,int(nr_events_epoch*scale)))
+            text = "Not enough memory: Events/Epoch of training files was reduced to "+str(np.round(100*scale,1))+"%"
+            print(text)
+            self.memory_plan_info += "\n"+text
+            return True
+
+        msg = QtWidgets.QMessageBox()
+        msg.setIcon(QtWidgets.QMessageBox.Warning)
+        msg.setText("Training probably needs more memory than available ("+str(np.round(plan["Peak"]/1024**2,1))+" MB needed, "+str(np.round(available/1024**2,1))+" MB available). Reduce Events/Epoch, the RAM cache budget or use the streaming pipeline. Start fitting anyway?")
+        msg.setDetailedText(text)
+        msg.setWindowTitle("Not enough memory")
+        msg.setStandardButtons(QtWidgets.QMessageBox.Yes | QtWidgets.QMessageBox.No)
+        retval = msg.exec_()
+        return retval==QtWidgets.QMessageBox.Yes
+
     def action_lr_finder(self):
         #lr_find
         model_keras = self.model_keras
@@ -2618,6 +2697,10 @@ class AIDeveloper(QtWidgets.QWidget):
             elif yes_or_no == "&No":
                 pass
 
+        if DATA_len>0:
+            #Data was moved to RAM before. Update it (only new or changed files are loaded)
+            self.refresh_ram(self.items_clicked())
+            self.dataOverviewOn()
         if DATA_len==0:
            msg = QtWidgets.QMessageBox()
            msg.setIcon(QtWidgets.QMessageBox.Information)
@@ -2675,7 +2758,7 @@ class AIDeveloper(QtWidgets.QWidget):
 #                         model_keras = load_model(model_keras_path,custom_objects=aid_dl.get_custom_metrics())
 #                 else:
 # =============================================================================
-            model_keras = load_model(model_keras_path,custom_objects=aid_dl.get_custom_metrics())
+                model_keras = load_model(model_keras_path,custom_objects=aid_dl.get_custom_metrics())
 
             #Initialize a variable for the parallel model
             model_keras_p = None
@@ -2880,7 +2963,9 @@ class AIDeveloper(QtWidgets.QWidget):
                 DataOverview_df.to_excel(writer,sheet_name='DataOverview') #write data overview to separate sheet
                 pd.DataFrame().to_excel(writer,sheet_name='Parameters') #initialize empty Sheet
                 pd.DataFrame().to_excel(writer,sheet_name='History') #initialize empty Sheet
-
+                #The history is appended to a .csv file after each epoch. The History sheet is written at the end
+                #(or upon user-request). A _history.csv of an earlier training with the same name is overwritten
+                history_log = aid_bin.HistoryLog(new_modelname.split(".model")[0]+'_history.csv')
 
             elif collection==True:
                 SelectedFiles_df = pd.DataFrame(SelectedFiles)
@@ -2898,6 +2983,7 @@ class AIDeveloper(QtWidgets.QWidget):
                     DataOverview_df.to_excel(writer,sheet_name='DataOverview') #write data overview to separate sheet
                     pd.DataFrame().to_excel(writer,sheet_name='Parameters') #initialize empty Sheet
                     pd.DataFrame().to_excel(writer,sheet_name='History') #initialize empty Sheet
+                history_logs = [aid_bin.HistoryLog(path.split(".model")[0]+'_history.csv') for path in model_keras_path]
 
             ###############################Expert Mode values##################
             text_updates = ""
@@ -2974,43 +3060,38 @@ class AIDeveloper(QtWidgets.QWidget):
                 return
             xtra_in = list(xtra_in)[0]#this is either True or False
 
-            #read self.ram to new variable ; next clear ram. This is required for multitasking (training multiple models with maybe different data)
-            DATA = self.ram
+            #Use a copy of the entries of self.ram (arrays are shared). Later changes of self.ram (other
+            #training sessions with maybe different data) don't affect this training session
+            DATA = self.ram.copy()
             if verbose==1:
                 print("Length of DATA (in RAM) = "+str(len(DATA)))
 
+            #Random numbers of this training session. The seed is saved in the meta file;
+            #validation data, training data and the order of training events use independent streams
+            rng = aid_img.RngContext(Default_dict["Random seed"])
+            rng_valid,rng_train,rng_shuffle = rng.spawn(3)
+            print("Random seed: "+str(rng.seed))
+
 # =============================================================================
 #             #clear the ram again if desired
 #             if not self.actionKeep_Data_in_RAM.isChecked():
 #                 self.ram = dict()
 #                 print("Removed data from self.ram. For further training sessions, data has to be reloaded.")
 # =============================================================================
-            self.ram = dict()
-            print("Removed data from self.ram. For further training sessions, data has to be reloaded.")
 
 
 
             #If the scaling method is "divide by mean and std of the whole training set":
             if norm == "StdScaling using mean and std of all training data":
-                mean_trainingdata,std_trainingdata = [],[]
+                #Here, the entire training set needs to be used! Not only random images!
+                #Statistics are computed chunk-wise and pooled over all files
+                stats = []
                 for i in range(len(SelectedFiles_train)):
-                    #if Data_to_RAM was not enabled:
-                    #if not self.actionDataToRam.isChecked():
-                    if len(DATA)==0: #Here, the entire training set needs to be used! Not only random images!
-                        #Replace=true: means individual cells could occur several times
-                        gen_train = aid_img.gen_crop_img(crop,rtdc_path_train[i],random_images=False,zoom_factor=zoom_factors_train[i],zoom_order=zoom_order,color_mode=self.get_color_mode(),padding_mode=paddingMode)
+                    if rtdc_path_train[i] not in DATA:
+                        stats.append(aid_img.image_stats(rtdc_path_train[i],crop,zoom_factor=zoom_factors_train[i],zoom_order=zoom_order,color_mode=self.get_color_mode(),padding_mode=paddingMode,roi_read=Default_dict["ROI read"]))
                     else:
-                        gen_train = aid_img.gen_crop_img_ram(DATA,rtdc_path_train[i],random_images=False) #Replace true means that individual cells could occur several times
-# =============================================================================
-#                         if self.actionVerbose.isChecked():
-#                             print("Loaded data from RAM")
-# =============================================================================
-
-                    images = next(gen_train)[0]
-                    mean_trainingdata.append(np.mean(images))
-                    std_trainingdata.append(np.std(images))
-                mean_trainingdata = np.mean(np.array(mean_trainingdata))
-                std_trainingdata = np.mean(np.array(std_trainingdata))
+                        stats.append(aid_img.array_stats(DATA[rtdc_path_train[i]]["images"]))
+                mean_trainingdata,std_trainingdata = aid_img.pooled_mean_std(stats)
 
                 if np.allclose(std_trainingdata,0):
                     std_trainingdata = 0.0001
@@ -3122,6 +3203,10 @@ class AIDeveloper(QtWidgets.QWidget):
                 Para_dict["lossW_expert"]=lossW_expert,
                 Para_dict["class_weight"]=class_weight,
                 Para_dict["metrics"]=model_metrics,
+                Para_dict["Random seed"]=rng.seed,
+                Para_dict["Validation every nr. epochs"]=Default_dict["Validation every nr. epochs"],
+                Para_dict["Validation subsample"]=Default_dict["Validation subsample"],
+                Para_dict["Full validation every nr. epochs"]=Default_dict["Full validation every nr. epochs"],
 
                 #training data cannot be changed during training
                 if norm == "StdScaling using mean and std of all training data":
@@ -3196,11 +3281,11 @@ class AIDeveloper(QtWidgets.QWidget):
 #                         gen_valid = aid_img.gen_crop_img_ram(DATA,rtdc_path_valid[i],nr_events_epoch_valid[i],random_images=shuffle_valid[i],replace=True,xtra_in=xtra_in) #Replace true means that individual cells could occur several times
 # =============================================================================
             for i in range(len(SelectedFiles_valid)):
-                if len(DATA)==0:
+                if rtdc_path_valid[i] not in DATA:
                     #Replace=true means individual cells could occur several times
-                    gen_valid = aid_img.gen_crop_img(crop,rtdc_path_valid[i],nr_events_epoch_valid[i],random_images=shuffle_valid[i],replace=True,zoom_factor=zoom_factors_valid[i],zoom_order=zoom_order,color_mode=self.get_color_mode(),padding_mode=paddingMode,xtra_in=xtra_in)
+                    gen_valid = aid_img.gen_crop_img(crop,rtdc_path_valid[i],nr_events_epoch_valid[i],random_images=shuffle_valid[i],replace=True,zoom_factor=zoom_factors_valid[i],zoom_order=zoom_order,color_mode=self.get_color_mode(),padding_mode=paddingMode,xtra_in=xtra_in,roi_read=Default_dict["ROI read"],rng=rng_valid)
                 else:
-                    gen_valid = aid_img.gen_crop_img_ram(DATA,rtdc_path_valid[i],nr_events_epoch_valid[i],random_images=shuffle_valid[i],replace=True,xtra_in=xtra_in) #Replace true means that individual cells could occur several times
+                    gen_valid = aid_img.gen_crop_img_ram(DATA,rtdc_path_valid[i],nr_events_epoch_valid[i],random_images=shuffle_valid[i],replace=True,xtra_in=xtra_in,rng=rng_valid) #Replace true means that individual cells could occur several times
 
 
 # =============================================================================
@@ -3270,9 +3355,9 @@ class AIDeveloper(QtWidgets.QWidget):
             #get it to theano image format (channels first)
             #X_valid = X_valid.swapaxes(-1,-2).swapaxes(-2,-3)
             if norm == "StdScaling using mean and std of all training data":
-                X_valid = aid_img.image_normalization(X_valid,norm,mean_trainingdata,std_trainingdata)
+                X_valid = aid_img.image_normalization(X_valid,norm,mean_trainingdata,std_trainingdata,rng=rng_valid)
             else:
-                X_valid = aid_img.image_normalization(X_valid,norm)
+                X_valid = aid_img.image_normalization(X_valid,norm,rng=rng_valid)
 
             #Validation data can be cropped to final size already since no augmentation
             #will happen on this data set
@@ -3287,6 +3372,19 @@ class AIDeveloper(QtWidgets.QWidget):
                 print("Add Xtra Data to X_valid")
                 X_valid = [X_valid,xtra_valid]
 
+            #Validation runs every few epochs and optionally using a stratified subsample
+            #(see aid_dl.ValidationSchedule)
+            validation = aid_dl.ValidationSchedule(X_valid,Y_valid,batch_size=batchSize_expert,
+                                                   every=Default_dict["Validation every nr. epochs"],
+                                                   subsample=Default_dict["Validation subsample"],
+                                                   full_every=Default_dict["Full validation every nr. epochs"],
+                                                   rng=rng_valid)
+            if validation.every>1 or validation.subsample is not None:
+                text = "Validation every "+str(validation.every)+" epochs"
+                if validation.subsample is not None:
+                    text += " using "+str(Default_dict["Validation subsample"])+" of the validation data; full validation every "+str(validation.full_every)+" epochs"
+                print(text)
+
 
             ####################Update the PopupFitting########################
             self.fittingpopups.spinBox_NrEpochs.setValue(nr_epochs)
@@ -3313,11 +3411,41 @@ class AIDeveloper(QtWidgets.QWidget):
 
             #Dictionary defining affine image augmentation options:
             aug_paras = {"v_flip":v_flip,"h_flip":h_flip,"rotation":rotation,"width_shift":width_shift,"height_shift":height_shift,"zoom":zoom,"shear":shear}
+            if Default_dict["Single-warp affine augm."]:
+                aug_paras["crop"] = crop #affine augmentation directly to the final size
+            #Dictionary defining contrast/saturation/hue, blurring and brightness/noise augmentation options:
+            photometric_paras = {"contrast_on":contrast_on,"contrast_lower":contrast_lower,"contrast_higher":contrast_higher,
+                                 "saturation_on":saturation_on,"saturation_lower":saturation_lower,"saturation_higher":saturation_higher,
+                                 "hue_on":hue_on,"hue_delta":hue_delta,
+                                 "avgBlur_on":avgBlur_on,"avgBlur_min":avgBlur_min,"avgBlur_max":avgBlur_max,
+                                 "gaussBlur_on":gaussBlur_on,"gaussBlur_min":gaussBlur_min,"gaussBlur_max":gaussBlur_max,
+                                 "motionBlur_on":motionBlur_on,"motionBlur_kernel":motionBlur_kernel,"motionBlur_angle":motionBlur_angle,
+                                 "brightness_add_lower":brightness_add_lower,"brightness_add_upper":brightness_add_upper,
+                                 "brightness_mult_lower":brightness_mult_lower,"brightness_mult_upper":brightness_mult_upper,
+                                 "gaussnoise_mean":gaussnoise_mean,"gaussnoise_scale":gaussnoise_scale}
+            #Augmentation backend: OpenCV (aid_img) or a compiled TensorFlow graph (aid_dl.TFAugmenter)
+            tf_augm = None
+            if Default_dict["Augmentation backend"]=="tf":
+                if aid_dl.TFAugmenter.supports(photometric_paras):
+                    tf_augm = aid_dl.TFAugmenter(aug_paras,photometric_paras,crop)
+                else:
+                    print("The TensorFlow augmentation backend does not support saturation/hue and motion blur. OpenCV is used instead.")
 
-            Histories,Index,Saved,Stopwatch,LearningRate = [],[],[],[],[]
-            if collection==True:
-               HISTORIES = [ [] for model in model_keras]
-               SAVED = [ [] for model in model_keras]
+            #Streaming pipeline: instead of loading and augmenting the entire
+            #epoch at once, batches are loaded and augmented when keras requests them
+            streaming = Default_dict["Streaming pipeline"]
+            if streaming:
+                if norm == "StdScaling using mean and std of all training data":
+                    mean_,std_ = mean_trainingdata,std_trainingdata
+                else:
+                    mean_,std_ = None,None
+                train_seq = aid_dl.EpochSequence(rtdc_path_train,indices_train,nr_events_epoch_train,shuffle_train,
+                                                 zoom_factors_train,nr_classes,cropsize2,crop,batch_size=batchSize_expert,
+                                                 ram=DATA,zoom_order=zoom_order,color_mode=self.get_color_mode(),
+                                                 padding_mode=paddingMode,xtra_in=xtra_in,roi_read=Default_dict["ROI read"],
+                                                 affine_paras=aug_paras,photometric_paras=photometric_paras,
+                                                 norm=norm,mean_trainingdata=mean_,std_trainingdata=std_,rng=rng_train,
+                                                 tf_augmenter=tf_augm)
 
             counter = 0
             saving_failed = False #when saving fails, this becomes true and the user will be informed at the end of training
@@ -3335,657 +3463,619 @@ class AIDeveloper(QtWidgets.QWidget):
                 if 'precision' in key or 'recall' in key or 'auc' in key:
                     model_metrics_records[key] = 0 #those metrics start at zero and approach 1
                     model_metrics_records["val_"+key] = 0 #those metrics start at zero and approach 1
+            #Records on the validation subsample are not comparable to those on the full validation data
+            model_metrics_records_subsample = model_metrics_records.copy()
 
             gen_train_refresh = False
-            time_start = time.time()
-            t1 = time.time() #Initialize a timer; this is used to save the meta file every few seconds
-            t2 =  time.time() #Initialize a timer; this is used update the fitting parameters
-            while counter < nr_epochs:#nr_epochs: #resample nr_epochs times
-                #Only keep fitting if the respective window is open:
-                isVisible = self.fittingpopups.isVisible()
-                if isVisible:
-                    ############Keras image augmentation#####################
-                    #Start the first iteration:
-                    X_train,y_train,xtra_train = [],[],[]
-                    t3 = time.time()
-                    for i in range(len(SelectedFiles_train)):
-                        if len(DATA)==0 or gen_train_refresh:
-                            #Replace true means that individual cells could occur several times
-                            gen_train = aid_img.gen_crop_img(cropsize2,rtdc_path_train[i],nr_events_epoch_train[i],random_images=shuffle_train[i],replace=True,zoom_factor=zoom_factors_train[i],zoom_order=zoom_order,color_mode=self.get_color_mode(),padding_mode=paddingMode,xtra_in=xtra_in)
-                            gen_train_refresh = False
-                        else:
-                            gen_train = aid_img.gen_crop_img_ram(DATA,rtdc_path_train[i],nr_events_epoch_train[i],random_images=shuffle_train[i],replace=True,xtra_in=xtra_in) #Replace true means that individual cells could occur several times
+
+            #Parallel augmentation: persistent process pool, batches are exchanged via shared memory
+            nr_processes = Default_dict["Augmentation processes"]
+            if nr_processes==0:
+                nr_processes = os.cpu_count()
+            if nr_processes>1 and not streaming and tf_augm is None:
+                aug_pool = aid_img.AugmentationPool(nr_processes)
+                text = "Image augmentation uses "+str(nr_processes)+" processes"
+                print(text)
+                self.fittingpopups.textBrowser_FittingInfo.append(text)
+            else:
+                aug_pool = None
+
+            def load_augm_epoch():
+                #Load the training data of one epoch (from .rtdc or RAM), apply affine augmentation and crop
+                nonlocal gen_train_refresh
+                ############Keras image augmentation#####################
+                #Start the first iteration:
+                X_train,y_train,xtra_train = [],[],[]
+                t3 = time.time()
+                for i in range(len(SelectedFiles_train)):
+                    if rtdc_path_train[i] not in DATA or gen_train_refresh:
+                        #Replace true means that individual cells could occur several times
+                        gen_train = aid_img.gen_crop_img(cropsize2,rtdc_path_train[i],nr_events_epoch_train[i],random_images=shuffle_train[i],replace=True,zoom_factor=zoom_factors_train[i],zoom_order=zoom_order,color_mode=self.get_color_mode(),padding_mode=paddingMode,xtra_in=xtra_in,roi_read=Default_dict["ROI read"],rng=rng_train)
+                        gen_train_refresh = False
+                    else:
+                        gen_train = aid_img.gen_crop_img_ram(DATA,rtdc_path_train[i],nr_events_epoch_train[i],random_images=shuffle_train[i],replace=True,xtra_in=xtra_in,rng=rng_train) #Replace true means that individual cells could occur several times
 # =============================================================================
 #                             if self.actionVerbose.isChecked():
 #                                 print("Loaded data from RAM")
 # =============================================================================
-                        data_ = next(gen_train)
-                        X_train.append(data_[0])
-                        y_train.append(np.repeat(indices_train[i],X_train[-1].shape[0]))
-                        if xtra_in==True:
-                            xtra_train.append(data_[2])
-                        del data_
-
-                    X_train = np.concatenate(X_train)
-                    X_train = X_train.astype(np.uint8)
-                    y_train = np.concatenate(y_train)
+                    data_ = next(gen_train)
+                    X_train.append(data_[0])
+                    y_train.append(np.repeat(indices_train[i],X_train[-1].shape[0]))
                     if xtra_in==True:
-                        print("Retrieve Xtra Data...")
-                        xtra_train = np.concatenate(xtra_train)
+                        xtra_train.append(data_[2])
+                    del data_
 
-                    t4 = time.time()
-                    if verbose == 1:
-                        print("Time to load data (from .rtdc or RAM) and crop="+str(t4-t3))
+                X_train = np.concatenate(X_train)
+                X_train = X_train.astype(np.uint8)
+                y_train = np.concatenate(y_train)
+                if xtra_in==True:
+                    print("Retrieve Xtra Data...")
+                    xtra_train = np.concatenate(xtra_train)
 
-                    if len(X_train.shape)==4:
-                        channels=3
-                    elif len(X_train.shape)==3:
-                        channels=1
-                    else:
-                        print("Invalid data dimension:" +str(X_train.shape))
-                    if channels==1:
-                        #Add the "channels" dimension
-                        X_train = np.expand_dims(X_train,3)
-
-                    t3 = time.time()
-                    #Some parallellization: use nr_threads (number of CPUs)
-                    nr_threads = 1 #Somehow for MNIST and CIFAR, processing always took longer for nr_threads>1 . I tried nr_threads=2,4,8,16,24
-                    if nr_threads == 1:
-                        X_batch = aid_img.affine_augm(X_train,v_flip,h_flip,rotation,width_shift,height_shift,zoom,shear) #Affine image augmentation
-                        y_batch = np.copy(y_train)
+                t4 = time.time()
+                if verbose == 1:
+                    print("Time to load data (from .rtdc or RAM) and crop="+str(t4-t3))
+
+                if len(X_train.shape)==4:
+                    channels=3
+                elif len(X_train.shape)==3:
+                    channels=1
+                else:
+                    print("Invalid data dimension:" +str(X_train.shape))
+                if channels==1:
+                    #Add the "channels" dimension
+                    X_train = np.expand_dims(X_train,3)
+
+                t3 = time.time()
+                if tf_augm is not None:
+                    X_batch = tf_augm.affine(X_train,rng=rng_train) #Affine image augmentation in a TensorFlow graph
+                elif aug_pool is None:
+                    X_batch = aid_img.affine_augm_paras(X_train,aug_paras,rng=rng_train) #Affine image augmentation
+                else:#processes of aug_pool augment one part of the batch each
+                    X_batch = aug_pool.augment(X_train,affine_paras=aug_paras,rng=rng_train)
+                y_batch = np.copy(y_train)
+
+                Y_batch = to_categorical(y_batch, nr_classes)# * 2 - 1
+                t4 = time.time()
+                if verbose == 1:
+                    print("Time to perform affine augmentation ="+str(t4-t3))
+
+                t3 = time.time()
+                #Now do the final cropping to the actual size that was set by user
+                dim = X_batch.shape
+                if dim[2]!=crop:
+                    remove = int(dim[2]/2.0 - crop/2.0)
+                    X_batch = X_batch[:,remove:remove+crop,remove:remove+crop,:] #crop to crop x crop pixels #TensorFlow
+                t4 = time.time()
+                return X_batch,Y_batch,xtra_train
+
+            photometric_buffer = None #uint8 output of photometric_augm; only used inside photometric_norm
+            def photometric_norm(X_batch,out=None):
+                #Contrast/Saturation/Hue, blurring and brightness/noise augmentation; normalization
+                #out: buffer for the normalized images (see aid_img.image_normalization)
+                nonlocal photometric_buffer
+                t3 = time.time()
+                if tf_augm is not None:
+                    X_batch = tf_augm.photometric(X_batch,rng=rng_train)
+                elif aug_pool is None:
+                    X_batch = aid_img.photometric_augm(X_batch,photometric_paras,out=photometric_buffer,rng=rng_train)
+                    photometric_buffer = X_batch
+                else:
+                    X_batch = aug_pool.augment(X_batch,photometric_paras=photometric_paras,rng=rng_train)
+                t4 = time.time()
+                if verbose == 1:
+                    print("Time to augment contrast, saturation/hue, blur and brightness="+str(t4-t3))
+
+                t3 = time.time()
+                if norm == "StdScaling using mean and std of all training data":
+                    X_batch = aid_img.image_normalization(X_batch,norm,mean_trainingdata,std_trainingdata,out=out,rng=rng_train)
+                else:
+                    X_batch = aid_img.image_normalization(X_batch,norm,out=out,rng=rng_train)
+                t4 = time.time()
+                if verbose == 1:
+                    print("Time to apply normalization="+str(t4-t3))
+                return X_batch
+
+            def produce_epochs(reuse_buffer=False):
+                #Training data for the upcoming keras_refresh_nr_epochs*brightness_refresh_nr_epochs epochs
+                #reuse_buffer: the float32 buffer of the previous epoch is reused. Only possible
+                #if each epoch is consumed before the next one is produced (no prefetching)
+                nonlocal norm_buffer
+                X_batch_orig,Y_batch,xtra_train = load_augm_epoch()
+                for i in range(keras_refresh_nr_epochs*brightness_refresh_nr_epochs):
+                    X_batch = photometric_norm(X_batch_orig,out=norm_buffer if reuse_buffer else None)
+                    if reuse_buffer:
+                        norm_buffer = X_batch
+                    yield X_batch,Y_batch,xtra_train
+
+            def produce_epochs_inplace():
+                while True:
+                    yield from produce_epochs(reuse_buffer=True)
+
+            #Prefetching: while the model is fitted, the data for the next epoch(s) is prepared in the background
+            prefetch = Default_dict["Prefetch queue depth"]>0 and not streaming
+            norm_buffer = None #normalized training data; reused in each epoch
+            if prefetch:
+                prefetcher = aid_dl.EpochPrefetcher(produce_epochs,depth=Default_dict["Prefetch queue depth"])
+                next_epoch = prefetcher.get
+                text = "Prefetching training data in the background (queue depth "+str(Default_dict["Prefetch queue depth"])+")"
+                print(text)
+                self.fittingpopups.textBrowser_FittingInfo.append(text)
+            elif not streaming:
+                next_epoch = produce_epochs_inplace().__next__
+
+            def apply_changed_settings():
+                #"Apply at next epoch": take over the settings of the fitting popup.
+                #This runs between two calls of .fit(), hence the model can be recompiled
+                nonlocal nr_epochs,expert_mode,cycLrMin,cycLrMax,cycLrStepSize,cycLrGamma
+                nonlocal optimizer_settings,paddingMode,gen_train_refresh,dropout_expert,class_weight
+                nr_epochs = int(self.fittingpopups.spinBox_NrEpochs.value())
+
+                #brightness_mult_lower = float(self.fittingpopups.doubleSpinBox_MultLower_pop.value())
+                #gaussnoise_mean = float(self.fittingpopups.doubleSpinBox_GaussianNoiseMean_pop.value())
+                #gaussnoise_scale = float(self.fittingpopups.doubleSpinBox_GaussianNoiseScale_pop.value())
+
+                #contrast_on = bool(self.fittingpopups.checkBox_contrast_pop.isChecked())
+                #contrast_lower = float(self.fittingpopups.doubleSpinBox_contrastLower_pop.value())
+                #contrast_higher = float(self.fittingpopups.doubleSpinBox_contrastHigher_pop.value())
+                #saturation_on = bool(self.fittingpopups.checkBox_saturation_pop.isChecked())
+                #saturation_lower = float(self.fittingpopups.doubleSpinBox_saturationLower_pop.value())
+                #saturation_higher = float(self.fittingpopups.doubleSpinBox_saturationHigher_pop.value())
+                #hue_on = bool(self.fittingpopups.checkBox_hue_pop.isChecked())
+                #hue_delta = float(self.fittingpopups.doubleSpinBox_hueDelta_pop.value())
+
+                #motionBlur_kernel = str(self.fittingpopups.lineEdit_motionBlurKernel_pop.text())
+                #motionBlur_angle = str(self.fittingpopups.lineEdit_motionBlurAngle_pop.text())
+
+                #motionBlur_kernel = tuple(ast.literal_eval(motionBlur_kernel)) #translate string in the lineEdits to a tuple
+                #motionBlur_angle = tuple(ast.literal_eval(motionBlur_angle)) #translate string in the lineEdits to a tuple
+
+                #Expert mode stuff
+                expert_mode = False
+                #epochs_expert = int(self.fittingpopups.spinBox_epochs.value())
+
+                cycLrMin = []
+                cycLrMax = []
+                #cycLrMethod = str(self.fittingpopups.comboBox_cycLrMethod.currentText())
+                clr_settings = self.fittingpopups.clr_settings.copy() #Get a copy of the current optimizer_settings. .copy prevents that changes in the UI have immediate effect
+                cycLrStepSize = aid_dl.get_cyclStepSize(SelectedFiles,clr_settings["step_size"],batchSize_expert)
+                cycLrGamma = clr_settings["gamma"]
+
+                #loss_expert = str(self.fittingpopups.comboBox_expt_loss_pop.currentText())
+                optimizer_settings = self.fittingpopups.optimizer_settings.copy() #Get a copy of the current optimizer_settings. .copy prevents that changes in the UI have immediate effect
+                paddingMode_ = str(self.fittingpopups.comboBox_paddingMode_pop.currentText())
+                print("paddingMode_:"+str(paddingMode_))
+                if paddingMode_ != paddingMode:
+                    print("Changed the padding mode!")
+                    gen_train_refresh = True#otherwise changing paddingMode will not have any effect
+                    paddingMode = paddingMode_
+                    if streaming:
+                        train_seq.set_padding_mode(paddingMode)
+                    if prefetch:
+                        prefetcher.reset()#discard data that was prepared using the previous padding mode
+
+                try:
+                    dropout_expert = "["+dropout_expert+"]"
+                    dropout_expert = ast.literal_eval(dropout_expert)
+                except:
+                    dropout_expert = []
+                #lossW_expert = str(self.fittingpopups.lineEdit_lossW.text())
+                class_weight = self.get_class_weight(self.fittingpopups.SelectedFiles,lossW_expert) #
+
+                print("Updating parameter file (meta.xlsx)!")
+                update_para_dict()
+
+                text_updates = ""
+                #Compare current lr and the lr on expert tab:
+                if collection==False:
+                    lr_current = model_keras.optimizer.get_config()["learning_rate"]
+                else:
+                    lr_current = model_keras[0].optimizer.get_config()["learning_rate"]
+
+                lr_diff = learning_rate_const-lr_current
+                if  abs(lr_diff) > 1e-6:
+                    if collection==False:
+                        K.set_value(model_keras.optimizer.lr, learning_rate_const)
                     else:
-                        #Divde data in 4 batches
-                        X_train = np.array_split(X_train,nr_threads)
-                        y_train = np.array_split(y_train,nr_threads)
-
-                        self.X_batch = [False] * nr_threads
-                        self.y_batch = [False] * nr_threads
-                        self.counter_aug = 0
-                        self.Workers_augm = []
-
-                        def imgaug_worker(aug_paras,progress_callback,history_callback):
-                            i = aug_paras["i"]
-                            self.X_batch[i] = aid_img.affine_augm(aug_paras["X_train"],v_flip,h_flip,rotation,width_shift,height_shift,zoom,shear)
-                            self.y_batch[i] = aug_paras["y_train"]
-                            self.counter_aug+=1
-
-                        t3_a = time.time()
-                        for i in range(nr_threads):
-                            aug_paras_ = copy.deepcopy(aug_paras)
-                            aug_paras_["i"] = i
-                            aug_paras_["X_train"]=X_train[i]#augparas contains rotation and so on. X_train and y_train are overwritten in each iteration (for each worker new X_train)
-                            aug_paras_["y_train"]=y_train[i]
-
-                            self.Workers_augm.append(Worker(imgaug_worker,aug_paras_))
-                            self.threadpool.start(self.Workers_augm[i])
-
-                        while self.counter_aug < nr_threads:
-                            time.sleep(0.01)#Wait 0.1s, then check the len again
-                        t3_b = time.time()
-                        if verbose == 1:
-                            print("Time to perform affine augmentation_internal ="+str(t3_b-t3_a))
-
-                        X_batch = np.concatenate(self.X_batch)
-                        y_batch = np.concatenate(self.y_batch)
-
-                    Y_batch = to_categorical(y_batch, nr_classes)# * 2 - 1
-                    t4 = time.time()
-                    if verbose == 1:
-                        print("Time to perform affine augmentation ="+str(t4-t3))
-
-                    t3 = time.time()
-                    #Now do the final cropping to the actual size that was set by user
-                    dim = X_batch.shape
-                    if dim[2]!=crop:
-                        remove = int(dim[2]/2.0 - crop/2.0)
-                        X_batch = X_batch[:,remove:remove+crop,remove:remove+crop,:] #crop to crop x crop pixels #TensorFlow
-                    t4 = time.time()
-    #                    if verbose == 1:
-    #                        print("Time to crop to final size="+str(t4-t3))
-
-                    X_batch_orig = np.copy(X_batch) #save into new array and do some iterations with varying noise/brightness
-                    #reuse this X_batch_orig a few times since this augmentation was costly
-                    keras_iter_counter = 0
-                    while keras_iter_counter < keras_refresh_nr_epochs and counter < nr_epochs:
-                        keras_iter_counter+=1
-                        #if t2-t1>5: #check for changed settings every 5 seconds
-# =============================================================================
-#                         if self.actionVerbose.isChecked()==True:
-#                             verbose = 1
-#                         else:
-# =============================================================================
-                        verbose = 0
+                        K.set_value(model_keras[0].optimizer.lr, learning_rate_const)
 
-                        #Another while loop if the user wants to reuse the keras-augmented data
-                        #several times and only apply brightness augmentation:
-                        brightness_iter_counter = 0
-                        while brightness_iter_counter < brightness_refresh_nr_epochs and counter < nr_epochs:
-                            #In each iteration, start with non-augmented data
-                            X_batch = np.copy(X_batch_orig)#copy from X_batch_orig, X_batch will be altered without altering X_batch_orig
-                            X_batch = X_batch.astype(np.uint8)
+                    text_updates +=  "Changed the learning rate to "+ str(learning_rate_const)+"\n"
 
-                            #########X_batch = X_batch.astype(float)########## No float yet :) !!!
+                recompile = False
+                #Compare current optimizer and the optimizer on expert tab:
+                if collection==False:
+                    optimizer_current = aid_dl.get_optimizer_name(model_keras).lower()#get the current optimizer of the model
+                else:
+                    optimizer_current = aid_dl.get_optimizer_name(model_keras[0]).lower()#get the current optimizer of the model
 
-                            brightness_iter_counter += 1
-# =============================================================================
-#                             if self.actionVerbose.isChecked()==True:
-#                                 verbose = 1
-#                             else:
-# =============================================================================
-                            verbose = 0
+                if optimizer_current!=optimizer_expert.lower():#if the current model has a different optimizer
+                    recompile = True
+                    text_updates+="Changed the optimizer to "+optimizer_expert+"\n"
 
-                            if self.fittingpopups.checkBox_ApplyNextEpoch.isChecked():
-                                nr_epochs = int(self.fittingpopups.spinBox_NrEpochs.value())
+                #Compare current loss function and the loss-function on expert tab:
+                if collection==False:
+                    loss_ = model_keras.loss
+                else:
+                    loss_ = model_keras[0].loss
+                if loss_!=loss_expert:
+                    recompile = True
+                    model_metrics_records["loss"] = 9E20 #Reset the record for loss because new loss function could converge to a different min. value
+                    model_metrics_records["val_loss"] = 9E20 #Reset the record for loss because new loss function could converge to a different min. value
+                    model_metrics_records_subsample["val_loss"] = 9E20
+                    text_updates+="Changed the loss function to "+loss_expert+"\n"
+
+                if recompile==True and collection==False:
+                    print("Recompiling...")
+                    model_metrics_t = aid_dl.get_metrics_tensors(self.get_metrics(),nr_classes)
+                    aid_dl.model_compile(model_keras,loss_expert,optimizer_settings,learning_rate_const,model_metrics_t,nr_classes)
+                    if model_keras_p!=None:#if model_keras_p is NOT None, there exists a parallel model, which also needs to be re-compiled
+                        model_metrics_t = aid_dl.get_metrics_tensors(self.get_metrics(),nr_classes)
+                        aid_dl.model_compile(model_keras_p,loss_expert,optimizer_settings,learning_rate_const,model_metrics_t,nr_classes)
+                        print("Recompiled parallel model to change optimizer, loss and learninig rate.")
 
-                                #brightness_mult_lower = float(self.fittingpopups.doubleSpinBox_MultLower_pop.value())
-                                #gaussnoise_mean = float(self.fittingpopups.doubleSpinBox_GaussianNoiseMean_pop.value())
-                                #gaussnoise_scale = float(self.fittingpopups.doubleSpinBox_GaussianNoiseScale_pop.value())
-
-                                #contrast_on = bool(self.fittingpopups.checkBox_contrast_pop.isChecked())
-                                #contrast_lower = float(self.fittingpopups.doubleSpinBox_contrastLower_pop.value())
-                                #contrast_higher = float(self.fittingpopups.doubleSpinBox_contrastHigher_pop.value())
-                                #saturation_on = bool(self.fittingpopups.checkBox_saturation_pop.isChecked())
-                                #saturation_lower = float(self.fittingpopups.doubleSpinBox_saturationLower_pop.value())
-                                #saturation_higher = float(self.fittingpopups.doubleSpinBox_saturationHigher_pop.value())
-                                #hue_on = bool(self.fittingpopups.checkBox_hue_pop.isChecked())
-                                #hue_delta = float(self.fittingpopups.doubleSpinBox_hueDelta_pop.value())
-
-
-
-
-                                #motionBlur_kernel = str(self.fittingpopups.lineEdit_motionBlurKernel_pop.text())
-                                #motionBlur_angle = str(self.fittingpopups.lineEdit_motionBlurAngle_pop.text())
-
-                                #motionBlur_kernel = tuple(ast.literal_eval(motionBlur_kernel)) #translate string in the lineEdits to a tuple
-                                #motionBlur_angle = tuple(ast.literal_eval(motionBlur_angle)) #translate string in the lineEdits to a tuple
+                elif recompile==True and collection==True:
+                    if model_keras_p!=None:#if model_keras_p is NOT None, there exists a parallel model, which also needs to be re-compiled
+                        print("Altering learning rate is not suported for collections (yet)")
+                        return False
+                    print("Recompiling...")
+                    for m in model_keras:
+                        model_metrics_t = aid_dl.get_metrics_tensors(self.get_metrics(),nr_classes)
+                        aid_dl.model_compile(m,loss_expert,optimizer_settings,learning_rate_const,model_metrics_t,nr_classes)
 
-                                #Expert mode stuff
-                                expert_mode = False
-                                #epochs_expert = int(self.fittingpopups.spinBox_epochs.value())
-
-
-
-                                cycLrMin = []
-                                cycLrMax = []
-                                #cycLrMethod = str(self.fittingpopups.comboBox_cycLrMethod.currentText())
-                                clr_settings = self.fittingpopups.clr_settings.copy() #Get a copy of the current optimizer_settings. .copy prevents that changes in the UI have immediate effect
-                                cycLrStepSize = aid_dl.get_cyclStepSize(SelectedFiles,clr_settings["step_size"],batchSize_expert)
-                                cycLrGamma = clr_settings["gamma"]
-
-
-
-
-
-                                #loss_expert = str(self.fittingpopups.comboBox_expt_loss_pop.currentText())
-                                optimizer_settings = self.fittingpopups.optimizer_settings.copy() #Get a copy of the current optimizer_settings. .copy prevents that changes in the UI have immediate effect
-                                paddingMode_ = str(self.fittingpopups.comboBox_paddingMode_pop.currentText())
-                                print("paddingMode_:"+str(paddingMode_))
-                                if paddingMode_ != paddingMode:
-                                    print("Changed the padding mode!")
-                                    gen_train_refresh = True#otherwise changing paddingMode will not have any effect
-                                    paddingMode = paddingMode_
-
-                                try:
-                                    dropout_expert = "["+dropout_expert+"]"
-                                    dropout_expert = ast.literal_eval(dropout_expert)
-                                except:
-                                    dropout_expert = []
-                                #lossW_expert = str(self.fittingpopups.lineEdit_lossW.text())
-                                class_weight = self.get_class_weight(self.fittingpopups.SelectedFiles,lossW_expert) #
-
-                                print("Updating parameter file (meta.xlsx)!")
-                                update_para_dict()
-
-                                text_updates = ""
-                                #Compare current lr and the lr on expert tab:
-                                if collection==False:
-                                    lr_current = model_keras.optimizer.get_config()["learning_rate"]
-                                else:
-                                    lr_current = model_keras[0].optimizer.get_config()["learning_rate"]
-
-                                lr_diff = learning_rate_const-lr_current
-                                if  abs(lr_diff) > 1e-6:
-                                    if collection==False:
-                                        K.set_value(model_keras.optimizer.lr, learning_rate_const)
-                                    else:
-                                        K.set_value(model_keras[0].optimizer.lr, learning_rate_const)
-
-                                    text_updates +=  "Changed the learning rate to "+ str(learning_rate_const)+"\n"
-
-                                recompile = False
-                                #Compare current optimizer and the optimizer on expert tab:
-                                if collection==False:
-                                    optimizer_current = aid_dl.get_optimizer_name(model_keras).lower()#get the current optimizer of the model
-                                else:
-                                    optimizer_current = aid_dl.get_optimizer_name(model_keras[0]).lower()#get the current optimizer of the model
-
-                                if optimizer_current!=optimizer_expert.lower():#if the current model has a different optimizer
-                                    recompile = True
-                                    text_updates+="Changed the optimizer to "+optimizer_expert+"\n"
-
-                                #Compare current loss function and the loss-function on expert tab:
-                                if collection==False:
-                                    loss_ = model_keras.loss
-                                else:
-                                    loss_ = model_keras[0].loss
-                                if loss_!=loss_expert:
-                                    recompile = True
-                                    model_metrics_records["loss"] = 9E20 #Reset the record for loss because new loss function could converge to a different min. value
-                                    model_metrics_records["val_loss"] = 9E20 #Reset the record for loss because new loss function could converge to a different min. value
-                                    text_updates+="Changed the loss function to "+loss_expert+"\n"
-
-                                if recompile==True and collection==False:
-                                    print("Recompiling...")
-                                    model_metrics_t = aid_dl.get_metrics_tensors(self.get_metrics(),nr_classes)
-                                    aid_dl.model_compile(model_keras,loss_expert,optimizer_settings,learning_rate_const,model_metrics_t,nr_classes)
-                                    if model_keras_p!=None:#if model_keras_p is NOT None, there exists a parallel model, which also needs to be re-compiled
-                                        model_metrics_t = aid_dl.get_metrics_tensors(self.get_metrics(),nr_classes)
-                                        aid_dl.model_compile(model_keras_p,loss_expert,optimizer_settings,learning_rate_const,model_metrics_t,nr_classes)
-                                        print("Recompiled parallel model to change optimizer, loss and learninig rate.")
-
-                                elif recompile==True and collection==True:
-                                    if model_keras_p!=None:#if model_keras_p is NOT None, there exists a parallel model, which also needs to be re-compiled
-                                        print("Altering learning rate is not suported for collections (yet)")
-                                        return
-                                    print("Recompiling...")
-                                    for m in model_keras:
-                                        model_metrics_t = aid_dl.get_metrics_tensors(self.get_metrics(),nr_classes)
-                                        aid_dl.model_compile(m,loss_expert,optimizer_settings,learning_rate_const,model_metrics_t,nr_classes)
-
-                                self.fittingpopups.textBrowser_FittingInfo.append(text_updates)
-
-                                #self.model_keras = model_keras #overwrite the model in self
-                                self.fittingpopups.checkBox_ApplyNextEpoch.setChecked(False)
-
-
-                            ##########Contrast/Saturation/Hue augmentation#########
-                            #is there any of contrast/saturation/hue augmentation to do?
-                            X_batch = X_batch.astype(np.uint8)
-                            if contrast_on:
-                                t_con_aug_1 = time.time()
-                                X_batch = aid_img.contrast_augm_cv2(X_batch,contrast_lower,contrast_higher) #this function is almost 15 times faster than random_contrast from tf!
-                                t_con_aug_2 = time.time()
-                                if verbose == 1:
-                                    print("Time to augment contrast="+str(t_con_aug_2-t_con_aug_1))
-
-                            if saturation_on or hue_on:
-                                t_sat_aug_1 = time.time()
-                                X_batch = aid_img.satur_hue_augm_cv2(X_batch.astype(np.uint8),saturation_on,saturation_lower,saturation_higher,hue_on,hue_delta) #Gray and RGB; both values >0!
-                                t_sat_aug_2 = time.time()
-                                if verbose == 1:
-                                    print("Time to augment saturation/hue="+str(t_sat_aug_2-t_sat_aug_1))
-
-                            ##########Average/Gauss/Motion blurring#########
-                            #is there any of blurring to do?
-
-                            if avgBlur_on:
-                                t_avgBlur_1 = time.time()
-                                X_batch = aid_img.avg_blur_cv2(X_batch,avgBlur_min,avgBlur_max)
-                                t_avgBlur_2 = time.time()
-                                if verbose == 1:
-                                    print("Time to perform average blurring="+str(t_avgBlur_2-t_avgBlur_1))
-
-                            if gaussBlur_on:
-                                t_gaussBlur_1 = time.time()
-                                X_batch = aid_img.gauss_blur_cv(X_batch,gaussBlur_min,gaussBlur_max)
-                                t_gaussBlur_2 = time.time()
-                                if verbose == 1:
-                                    print("Time to perform gaussian blurring="+str(t_gaussBlur_2-t_gaussBlur_1))
-
-                            if motionBlur_on:
-                                t_motionBlur_1 = time.time()
-                                X_batch = aid_img.motion_blur_cv(X_batch,motionBlur_kernel,motionBlur_angle)
-                                t_motionBlur_2 = time.time()
-                                if verbose == 1:
-                                    print("Time to perform motion blurring="+str(t_motionBlur_2-t_motionBlur_1))
-
-                            ##########Brightness noise#########
-                            t3 = time.time()
-                            X_batch = aid_img.brightn_noise_augm_cv2(X_batch,brightness_add_lower,brightness_add_upper,brightness_mult_lower,brightness_mult_upper,gaussnoise_mean,gaussnoise_scale)
-                            t4 = time.time()
-                            if verbose == 1:
-                                print("Time to augment brightness="+str(t4-t3))
-
-                            t3 = time.time()
-                            if norm == "StdScaling using mean and std of all training data":
-                                X_batch = aid_img.image_normalization(X_batch,norm,mean_trainingdata,std_trainingdata)
-                            else:
-                                X_batch = aid_img.image_normalization(X_batch,norm)
-                            t4 = time.time()
-                            if verbose == 1:
-                                print("Time to apply normalization="+str(t4-t3))
-
-                            #Fitting can be paused
-                            while str(self.fittingpopups.pushButton_Pause_pop.text())==" ":
-                                time.sleep(1) #wait 1 seconds and then check the text on the button again
-
-                            if verbose == 1:
-                                print("X_batch.shape")
-                                print(X_batch.shape)
-
-                            if xtra_in==True:
-                                print("Add Xtra Data to X_batch")
-                                X_batch = [X_batch,xtra_train]
-
-                            #generate a list of callbacks, get empty list if callback_lr is none
-                            callbacks = []
-                            if callback_lr!=None:
-                                callbacks.append(callback_lr)
-
-                            ###################################################
-                            ###############Actual fitting######################
-                            ###################################################
-                            if collection==False:
-                                if model_keras_p == None:
-                                    history = model_keras.fit(X_batch, Y_batch, batch_size=batchSize_expert,epochs=epochs_expert,verbose=verbose,\
-                                                              validation_data=(X_valid, Y_valid),class_weight=class_weight,callbacks=callbacks)
-                                elif model_keras_p != None:
-                                    history = model_keras_p.fit(X_batch, Y_batch, batch_size=batchSize_expert, epochs=epochs_expert,verbose=verbose,\
-                                                                validation_data=(X_valid, Y_valid),class_weight=class_weight,callbacks=callbacks)
-
-                                Histories.append(history.history)
-                                Stopwatch.append(time.time()-time_start)
-                                learningrate = K.get_value(history.model.optimizer.lr)
-                                LearningRate.append(learningrate)
-
-                                #Check if any metric broke a record
-                                record_broken = False #initially, assume there is no new record
-                                for key in history.history.keys():
-                                    value = history.history[key][-1]
-                                    record = model_metrics_records[key]
-                                    if 'val_accuracy' in key or 'val_precision' in key or 'val_recall' in key or 'val_auc' in key:
-                                        #These metrics should go up (towards 1)
-                                        if value>record:
-                                            model_metrics_records[key] = value
-                                            record_broken = True
-                                            print(key+" broke record -> Model will be saved" )
-
-                                    elif 'val_loss' in key:
-                                        #This metric should go down (towards 0)
-                                        if value<record:
-                                            model_metrics_records[key] = value
-                                            record_broken = True
-                                            print(key+" broke record -> Model will be saved")
-                                                #self.fittingpopups.textBrowser_FittingInfo.append(text)
-
-                                if record_broken:#if any record was broken...
+                self.fittingpopups.textBrowser_FittingInfo.append(text_updates)
+
+                #self.model_keras = model_keras #overwrite the model in self
+                self.fittingpopups.checkBox_ApplyNextEpoch.setChecked(False)
+                return True
+
+            def broken_records(logs,validated):
+                #Return the metrics that broke their record (and update the records)
+                #validated: validation data used in this epoch ("full", "subsample" or None)
+                if validated is None:#no validation in this epoch
+                    return []
+                records = model_metrics_records if validated=="full" else model_metrics_records_subsample
+                keys = []
+                for key in logs.keys():
+                    value = logs[key]
+                    record = records[key]
+                    if 'val_accuracy' in key or 'val_precision' in key or 'val_recall' in key or 'val_auc' in key:
+                        #These metrics should go up (towards 1)
+                        if value>record:
+                            records[key] = value
+                            keys.append(key)
+                    elif 'val_loss' in key:
+                        #This metric should go down (towards 0)
+                        if value<record:
+                            records[key] = value
+                            keys.append(key)
+                return keys
+
+            def save_model_single():
+                #Save the model after a record was broken (to temp, if the folder became inaccessible)
+                nonlocal new_modelname,writer,history_log,saving_failed
 # =============================================================================
-#                                     if deviceSelected=="Multi-GPU":#in case of Multi-GPU...
-#                                         #In case of multi-GPU, first copy the weights of the parallel model to the normal model
-#                                         model_keras.set_weights(model_keras_p.layers[-2].get_weights())
+#                 if deviceSelected=="Multi-GPU":#in case of Multi-GPU...
+#                     #In case of multi-GPU, first copy the weights of the parallel model to the normal model
+#                     model_keras.set_weights(model_keras_p.layers[-2].get_weights())
 # =============================================================================
-                                    #Save the model
-                                    text = "Save model to following directory: \n"+os.path.dirname(new_modelname)
-                                    #print(text)
-
-                                    if os.path.exists(os.path.dirname(new_modelname)):
-                                        model_keras.save(new_modelname.split(".model")[0]+"_"+str(counter)+".model",save_format='h5')
-                                        text = "Record was broken -> saved model"
-                                        #print(text)
-                                        self.fittingpopups.textBrowser_FittingInfo.append(text)
-
-                                    else:#in case the folder does not exist (anymore), create a folder in temp
-                                        #what is the foldername of the model?
-                                        text = "Saving failed. Create folder in temp"
-                                        print(text)
-                                        self.fittingpopups.textBrowser_FittingInfo.append(text)
-
-                                        saving_failed = True
-                                        temp_path = aid_bin.create_temp_folder()#create a temp folder if it does not already exist
-
-                                        text = "Your temp. folder is here: "+str(temp_path)
-                                        print(text)
-                                        self.fittingpopups.textBrowser_FittingInfo.append(text)
-
-                                        parentfolder = aid_bin.splitall(new_modelname)[-2]
-                                        fname = os.path.split(new_modelname)[-1]
-
-                                        #create that folder in temp if it not exists already
-                                        if not os.path.exists(os.path.join(temp_path,parentfolder)):
-                                            text = "Create folder in temp:\n"+os.path.join(temp_path,parentfolder)
-                                            print(text)
-                                            self.fittingpopups.textBrowser_FittingInfo.append(text)
-                                            os.mkdir(os.path.join(temp_path,parentfolder))
-
-                                        #change the new_modelname to a path in temp
-                                        new_modelname = os.path.join(temp_path,parentfolder,fname)
-
-                                        #inform user!
-                                        text = "Could not find original folder. Files are now saved to "+new_modelname
-                                        text = "<span style=\' color: red;\'>" +text+"</span>"
-                                        self.fittingpopups.textBrowser_FittingInfo.append(text)
-                                        text = "<span style=\' color: black;\'>" +""+"</span>"
-                                        self.fittingpopups.textBrowser_FittingInfo.append(text)
-
-                                        #Save the  model
-                                        model_keras.save(new_modelname.split(".model")[0]+"_"+str(counter)+".model",save_format='h5')
-                                        text = "Model saved successfully to temp"
-                                        print(text)
-                                        self.fittingpopups.textBrowser_FittingInfo.append(text)
-
-                                        #Also update the excel writer!
-                                        writer = pd.ExcelWriter(new_modelname.split(".model")[0]+'_meta.xlsx', engine='openpyxl')
-                                        self.fittingpopups.writer = writer
-                                        pd.DataFrame().to_excel(writer,sheet_name='UsedData') #initialize empty Sheet
-                                        SelectedFiles_df.to_excel(writer,sheet_name='UsedData')
-                                        DataOverview_df.to_excel(writer,sheet_name='DataOverview') #write data overview to separate sheet
-                                        pd.DataFrame().to_excel(writer,sheet_name='Parameters') #initialize empty Sheet
-                                        pd.DataFrame().to_excel(writer,sheet_name='History') #initialize empty Sheet
-
-                                    Saved.append(1)
-
-                                #Also save the model upon user-request
-                                elif bool(self.fittingpopups.checkBox_saveEpoch_pop.isChecked())==True:
-                                    if deviceSelected=="Multi-GPU":#in case of Multi-GPU...
-                                        #In case of multi-GPU, first copy the weights of the parallel model to the normal model
-                                        model_keras.set_weights(model_keras_p.layers[-2].get_weights())
-                                    model_keras.save(new_modelname.split(".model")[0]+"_"+str(counter)+".model",save_format='h5')
-                                    Saved.append(1)
-                                    self.fittingpopups.checkBox_saveEpoch_pop.setChecked(False)
-                                else:
-                                    Saved.append(0)
-
-                            elif collection==True:
-                                for i in range(len(model_keras)):
-                                    #Expert-settings return automatically to default values when Expert-mode is unchecked
-                                    history = model_keras[i].fit(X_batch, Y_batch, batch_size=batchSize_expert, epochs=epochs_expert,verbose=verbose, validation_data=(X_valid, Y_valid),class_weight=class_weight,callbacks=callbacks)
-                                    HISTORIES[i].append(history.history)
-                                    learningrate = K.get_value(history.model.optimizer.lr)
-
-                                    print("model_keras_path[i]")
-                                    print(model_keras_path[i])
-
-                                    #Check if any metric broke a record
-                                    record_broken = False #initially, assume there is no new record
-
-                                    for key in history.history.keys():
-                                        value = history.history[key][-1]
-                                        record = model_metrics_records[key]
-                                        if 'val_accuracy' in key or 'val_precision' in key or 'val_recall' in key or 'val_auc' in key:
-                                            #These metrics should go up (towards 1)
-                                            if value>record:
-                                                model_metrics_records[key] = value
-                                                record_broken = True
-                                                text = key+" broke record -> Model will be saved"
-                                                print(text)
-                                                self.fittingpopups.textBrowser_FittingInfo.append(text)
-
-                                                #one could 'break' here, but I want to update all records
-                                        elif 'val_loss' in key:
-                                            #This metric should go down (towards 0)
-                                            if value<record:
-                                                model_metrics_records[key] = value
-                                                record_broken = True
-                                                text = key+" broke record -> Model will be saved"
-                                                print(text)
-                                                self.fittingpopups.textBrowser_FittingInfo.append(text)
-
-                                    #For collections of models:
-                                    if record_broken:
-                                        #Save the model
-                                        model_keras[i].save(model_keras_path[i].split(".model")[0]+"_"+str(counter)+".model")
-                                        SAVED[i].append(1)
-                                    elif bool(self.fittingpopups.checkBox_saveEpoch_pop.isChecked())==True:
-                                        model_keras[i].save(model_keras_path[i].split(".model")[0]+"_"+str(counter)+".model")
-                                        SAVED[i].append(1)
-                                        self.fittingpopups.checkBox_saveEpoch_pop.setChecked(False)
-                                    else:
-                                        SAVED[i].append(0)
-
-
-                            callback_progessbar = float(counter)/nr_epochs
-                            progress_callback.emit(100.0*callback_progessbar)
-                            history_emit = history.history
-                            history_emit["LearningRate"] = [learningrate]
-                            history_callback.emit(history_emit)
-                            Index.append(counter)
-
-                            t2 =  time.time()
-
-                            if collection==False:
-                                if counter==0:
-                                    #If this runs the first time, create the file with header
-                                    DF1 = [[ h[h_i][-1] for h_i in h] for h in Histories] #if nb_epoch in .fit() is >1, only save the last history item, beacuse this would a model that could be saved
-                                    DF1 = np.r_[DF1]
-                                    DF1 = pd.DataFrame( DF1,columns=Histories[0].keys() )
-
-                                    DF1["Saved"] = Saved
-                                    DF1["Time"] = Stopwatch
-                                    DF1["LearningRate"] = LearningRate
-                                    DF1.index = Index
-
-                                    #If this runs the first time, create the file with header
-                                    if os.path.isfile(new_modelname.split(".model")[0]+'_meta.xlsx'):
-                                        os.chmod(new_modelname.split(".model")[0]+'_meta.xlsx', S_IREAD|S_IRGRP|S_IROTH|S_IWRITE|S_IWGRP|S_IWOTH) #read/write
-                                    DF1.to_excel(writer,sheet_name='History')
-                                    writer.save()
-                                    os.chmod(new_modelname.split(".model")[0]+'_meta.xlsx', S_IREAD|S_IRGRP|S_IROTH)
-
-                                    meta_saving_t = int(self.fittingpopups.spinBox_saveMetaEvery.value())
-                                    text = "meta.xlsx was saved (automatic saving every "+str(meta_saving_t)+"s)"
-                                    print(text)
-                                    self.fittingpopups.textBrowser_FittingInfo.append(text)
-
-                                    #self.fittingpopups.backup.append({"DF1":DF1})
-                                    Index,Histories,Saved,Stopwatch,LearningRate = [],[],[],[],[]#reset the lists
-
-                                #Get a sensible frequency for saving the dataframe (every 20s)
-                                elif t2-t1>int(self.fittingpopups.spinBox_saveMetaEvery.value()):
-                                #elif counter%50==0:  #otherwise save the history to excel after each n epochs
-                                    DF1 = [[ h[h_i][-1] for h_i in h] for h in Histories] #if nb_epoch in .fit() is >1, only save the last history item, beacuse this would a model that could be saved
-                                    DF1 = np.r_[DF1]
-                                    DF1 = pd.DataFrame( DF1,columns=Histories[0].keys() )
-                                    DF1["Saved"] = Saved
-                                    DF1["Time"] = Stopwatch
-                                    DF1["LearningRate"] = LearningRate
-                                    DF1.index = Index
-
-                                    #Saving
-                                    if os.path.exists(os.path.dirname(new_modelname)):#check if folder is (still) available
-                                        if os.path.isfile(new_modelname.split(".model")[0]+'_meta.xlsx'):
-                                            os.chmod(new_modelname.split(".model")[0]+'_meta.xlsx', S_IREAD|S_IRGRP|S_IROTH|S_IWRITE|S_IWGRP|S_IWOTH) #make read/write
-                                        DF1.to_excel(writer,sheet_name='History', startrow=writer.sheets['History'].max_row,header= False)
-                                        writer.save()
-                                        os.chmod(new_modelname.split(".model")[0]+'_meta.xlsx', S_IREAD|S_IRGRP|S_IROTH)  #make read only
-
-                                        meta_saving_t = int(self.fittingpopups.spinBox_saveMetaEvery.value())
-                                        text = "meta.xlsx was saved (automatic saving every "+str(meta_saving_t)+"s to directory:\n)"+new_modelname
-                                        print(text)
-                                        self.fittingpopups.textBrowser_FittingInfo.append(text)
-
-                                        Index,Histories,Saved,Stopwatch,LearningRate = [],[],[],[],[]#reset the lists
-                                        t1 = time.time()
-                                    else:#If folder not available, create a folder in temp
-                                        text = "Failed to save meta.xlsx. -> Create folder in temp\n"
-                                        saving_failed = True
-                                        temp_path = aid_bin.create_temp_folder()#create a temp folder if it does not already exist
-                                        text += "Your temp folder is here: "+str(temp_path)+"\n"
-                                        folder = os.path.split(new_modelname)[-2]
-                                        folder = os.path.split(folder)[-1]
-                                        fname = os.path.split(new_modelname)[-1]
-                                        #create that folder in temp if it does'nt exist already
-                                        if not os.path.exists(os.path.join(temp_path,folder)):
-                                            os.mkdir(os.path.join(temp_path,folder))
-                                            text +="Created directory in temp:\n"+os.path.join(temp_path,folder)
-
-                                        print(text)
-                                        #change the new_modelname to a path in temp
-                                        new_modelname = os.path.join(temp_path,folder,fname)
-
-                                        #inform user!
-                                        text = "Could not find original folder. Files are now saved to "+new_modelname
-                                        text = "<span style=\' color: red;\'>" +text+"</span>"#put red text to the infobox
-                                        self.fittingpopups.textBrowser_FittingInfo.append(text)
-                                        text = "<span style=\' color: black;\'>" +""+"</span>"#reset textcolor to black
-                                        self.fittingpopups.textBrowser_FittingInfo.append(text)
-
-
-                                        #update the excel writer
-                                        writer = pd.ExcelWriter(new_modelname.split(".model")[0]+'_meta.xlsx', engine='openpyxl')
-                                        self.fittingpopups.writer = writer
-                                        pd.DataFrame().to_excel(writer,sheet_name='UsedData') #initialize empty Sheet
-                                        SelectedFiles_df.to_excel(writer,sheet_name='UsedData')
-                                        DataOverview_df.to_excel(writer,sheet_name='DataOverview') #write data overview to separate sheet
-                                        pd.DataFrame().to_excel(writer,sheet_name='Parameters') #initialize empty Sheet
-                                        pd.DataFrame().to_excel(writer,sheet_name='History') #initialize empty Sheet
-
-                                        if os.path.isfile(new_modelname.split(".model")[0]+'_meta.xlsx'):
-                                            print("There is already such a file...AID will add new data to it. Please check if this is OK")
-                                            os.chmod(new_modelname.split(".model")[0]+'_meta.xlsx', S_IREAD|S_IRGRP|S_IROTH|S_IWRITE|S_IWGRP|S_IWOTH) #read/write
-                                        DF1.to_excel(writer,sheet_name='History')
-                                        writer.save()
-                                        os.chmod(new_modelname.split(".model")[0]+'_meta.xlsx', S_IREAD|S_IRGRP|S_IROTH)
-                                        print("meta.xlsx was saved")
-                                        Index,Histories,Saved,Stopwatch,LearningRate = [],[],[],[],[]#reset the lists
-
-
-                            if collection==True:
-                                if counter==0:
-                                    for i in range(len(HISTORIES)):
-                                        Histories = HISTORIES[i]
-                                        Saved = SAVED[i]
-                                        #If this runs the first time, create the file with header
-                                        DF1 = [[ h[h_i][-1] for h_i in h] for h in Histories] #if nb_epoch in .fit() is >1, only save the last history item, beacuse this would a model that could be saved
-                                        DF1 = np.r_[DF1]
-                                        DF1 = pd.DataFrame( DF1,columns=Histories[0].keys() )
-                                        DF1["Saved"] = Saved
-                                        DF1.index = Index
-                                        HISTORIES[i] = []#reset the Histories list
-                                        SAVED[i] = []
-                                        #If this runs the first time, create the file with header
-                                        if os.path.isfile(model_keras_path[i].split(".model")[0]+'_meta.xlsx'):
-                                            os.chmod(model_keras_path[i].split(".model")[0]+'_meta.xlsx', S_IREAD|S_IRGRP|S_IROTH|S_IWRITE|S_IWGRP|S_IWOTH) #read/write
-                                        DF1.to_excel(Writers[i],sheet_name='History')
-                                        Writers[i].save()
-                                        os.chmod(model_keras_path[i].split(".model")[0]+'_meta.xlsx', S_IREAD|S_IRGRP|S_IROTH)
-                                        print("meta.xlsx was saved")
-                                    Index = []#reset the Index list
-
-                                #Get a sensible frequency for saving the dataframe (every 20s)
-                                elif t2-t1>int(self.fittingpopups.spinBox_saveMetaEvery.value()):
-                                    for i in range(len(HISTORIES)):
-                                        Histories = HISTORIES[i]
-                                        Saved = SAVED[i]
-                                        DF1 = [[ h[h_i][-1] for h_i in h] for h in Histories] #if nb_epoch in .fit() is >1, only save the last history item, beacuse this would a model that could be saved
-                                        DF1 = np.r_[DF1]
-                                        DF1 = pd.DataFrame( DF1,columns=Histories[0].keys() )
-                                        DF1["Saved"] = Saved
-                                        DF1.index = Index
-                                        HISTORIES[i] = []#reset the Histories list
-                                        SAVED[i] = []
-                                        #Saving
-                                        #TODO: save to temp, if harddisk not available to prevent crash.
-                                        if os.path.isfile(model_keras_path[i].split(".model")[0]+'_meta.xlsx'):
-                                            os.chmod(model_keras_path[i].split(".model")[0]+'_meta.xlsx', S_IREAD|S_IRGRP|S_IROTH|S_IWRITE|S_IWGRP|S_IWOTH) #make read/write
-                                        DF1.to_excel(Writers[i],sheet_name='History', startrow=Writers[i].sheets['History'].max_row,header= False)
-                                        Writers[i].save()
-                                        os.chmod(model_keras_path[i].split(".model")[0]+'_meta.xlsx', S_IREAD|S_IRGRP|S_IROTH)  #make read only
-                                        print("meta.xlsx was saved")
-                                        t1 = time.time()
-                                    Index = []#reset the Index list
-
-                            counter+=1
+                #Save the model
+                text = "Save model to following directory: \n"+os.path.dirname(new_modelname)
+                #print(text)
+
+                if os.path.exists(os.path.dirname(new_modelname)):
+                    checkpoint_writers[0].save(model_keras,new_modelname.split(".model")[0]+"_"+str(counter)+".model")
+                    text = "Record was broken -> saving model"
+                    #print(text)
+                    self.fittingpopups.textBrowser_FittingInfo.append(text)
+
+                else:#in case the folder does not exist (anymore), create a folder in temp
+                    #what is the foldername of the model?
+                    text = "Saving failed. Create folder in temp"
+                    print(text)
+                    self.fittingpopups.textBrowser_FittingInfo.append(text)
+
+                    saving_failed = True
+                    temp_path = aid_bin.create_temp_folder()#create a temp folder if it does not already exist
+
+                    text = "Your temp. folder is here: "+str(temp_path)
+                    print(text)
+                    self.fittingpopups.textBrowser_FittingInfo.append(text)
+
+                    parentfolder = aid_bin.splitall(new_modelname)[-2]
+                    fname = os.path.split(new_modelname)[-1]
+
+                    #create that folder in temp if it not exists already
+                    if not os.path.exists(os.path.join(temp_path,parentfolder)):
+                        text = "Create folder in temp:\n"+os.path.join(temp_path,parentfolder)
+                        print(text)
+                        self.fittingpopups.textBrowser_FittingInfo.append(text)
+                        os.mkdir(os.path.join(temp_path,parentfolder))
+
+                    #change the new_modelname to a path in temp
+                    new_modelname = os.path.join(temp_path,parentfolder,fname)
+
+                    #inform user!
+                    text = "Could not find original folder. Files are now saved to "+new_modelname
+                    text = "<span style=\' color: red;\'>" +text+"</span>"
+                    self.fittingpopups.textBrowser_FittingInfo.append(text)
+                    text = "<span style=\' color: black;\'>" +""+"</span>"
+                    self.fittingpopups.textBrowser_FittingInfo.append(text)
+
+                    #Save the  model
+                    checkpoint_writers[0].save(model_keras,new_modelname.split(".model")[0]+"_"+str(counter)+".model")
+                    text = "Saving model to temp"
+                    print(text)
+                    self.fittingpopups.textBrowser_FittingInfo.append(text)
+
+                    #Also update the excel writer!
+                    writer = pd.ExcelWriter(new_modelname.split(".model")[0]+'_meta.xlsx', engine='openpyxl')
+                    self.fittingpopups.writer = writer
+                    pd.DataFrame().to_excel(writer,sheet_name='UsedData') #initialize empty Sheet
+                    SelectedFiles_df.to_excel(writer,sheet_name='UsedData')
+                    DataOverview_df.to_excel(writer,sheet_name='DataOverview') #write data overview to separate sheet
+                    pd.DataFrame().to_excel(writer,sheet_name='Parameters') #initialize empty Sheet
+                    pd.DataFrame().to_excel(writer,sheet_name='History') #initialize empty Sheet
+                    history_log.close()
+                    history_log = aid_bin.HistoryLog(new_modelname.split(".model")[0]+'_history.csv')
+
+            def save_meta_single(row):
+                #Append the history of this epoch to the _history.csv file. Every
+                #spinBox_saveMetaEvery seconds, the file is forced to be written to the disk
+                nonlocal t1,new_modelname,writer,history_log,saving_failed
+                if not os.path.exists(os.path.dirname(new_modelname)):#If folder not available, create a folder in temp
+                    text = "Failed to save the history. -> Create folder in temp\n"
+                    saving_failed = True
+                    temp_path = aid_bin.create_temp_folder()#create a temp folder if it does not already exist
+                    text += "Your temp folder is here: "+str(temp_path)+"\n"
+                    folder = os.path.split(new_modelname)[-2]
+                    folder = os.path.split(folder)[-1]
+                    fname = os.path.split(new_modelname)[-1]
+                    #create that folder in temp if it does'nt exist already
+                    if not os.path.exists(os.path.join(temp_path,folder)):
+                        os.mkdir(os.path.join(temp_path,folder))
+                        text +="Created directory in temp:\n"+os.path.join(temp_path,folder)
+
+                    print(text)
+                    #change the new_modelname to a path in temp
+                    new_modelname = os.path.join(temp_path,folder,fname)
+
+                    #inform user!
+                    text = "Could not find original folder. Files are now saved to "+new_modelname
+                    text = "<span style=\' color: red;\'>" +text+"</span>"#put red text to the infobox
+                    self.fittingpopups.textBrowser_FittingInfo.append(text)
+                    text = "<span style=\' color: black;\'>" +""+"</span>"#reset textcolor to black
+                    self.fittingpopups.textBrowser_FittingInfo.append(text)
+
+                    #update the excel writer and the history
+                    writer = pd.ExcelWriter(new_modelname.split(".model")[0]+'_meta.xlsx', engine='openpyxl')
+                    self.fittingpopups.writer = writer
+                    pd.DataFrame().to_excel(writer,sheet_name='UsedData') #initialize empty Sheet
+                    SelectedFiles_df.to_excel(writer,sheet_name='UsedData')
+                    DataOverview_df.to_excel(writer,sheet_name='DataOverview') #write data overview to separate sheet
+                    pd.DataFrame().to_excel(writer,sheet_name='Parameters') #initialize empty Sheet
+                    pd.DataFrame().to_excel(writer,sheet_name='History') #initialize empty Sheet
+                    history_log.close()
+                    history_log = aid_bin.HistoryLog(new_modelname.split(".model")[0]+'_history.csv')
+
+                t2 = time.time()
+                sync = counter==0 or t2-t1>int(self.fittingpopups.spinBox_saveMetaEvery.value())
+                history_log.append(counter,row,sync=sync)
+                if sync:
+                    t1 = t2
+                #Also write the History sheet of meta.xlsx upon user-request
+                if bool(self.fittingpopups.checkBox_saveMeta_pop.isChecked())==True:
+                    export_history(history_log,writer,new_modelname.split(".model")[0]+'_meta.xlsx')
+                    self.fittingpopups.checkBox_saveMeta_pop.setChecked(False)
+
+            def save_meta_collection(rows):
+                #Append the histories of all models of the collection to their _history.csv
+                nonlocal t1
+                t2 = time.time()
+                sync = counter==0 or t2-t1>int(self.fittingpopups.spinBox_saveMetaEvery.value())
+                #TODO: save to temp, if harddisk not available to prevent crash.
+                for i in range(len(history_logs)):
+                    history_logs[i].append(counter,rows[i],sync=sync)
+                if sync:
+                    t1 = t2
+                if bool(self.fittingpopups.checkBox_saveMeta_pop.isChecked())==True:
+                    for i in range(len(history_logs)):
+                        export_history(history_logs[i],Writers[i],model_keras_path[i].split(".model")[0]+'_meta.xlsx')
+                    self.fittingpopups.checkBox_saveMeta_pop.setChecked(False)
+
+            def export_history(history_log,writer,metaname):
+                #Write the history so far to the History sheet of meta.xlsx (rewrites the entire workbook)
+                history_log.to_excel(writer,sheet_name='History')
+                if os.path.isfile(metaname):
+                    os.chmod(metaname, S_IREAD|S_IRGRP|S_IROTH|S_IWRITE|S_IWGRP|S_IWOTH) #make read/write
+                writer.save()
+                os.chmod(metaname, S_IREAD|S_IRGRP|S_IROTH) #make read only
+                self.fittingpopups.textBrowser_FittingInfo.append("Saved history to "+metaname)
+
+            def emit_history(logs,learningrate):
+                callback_progessbar = float(counter)/nr_epochs
+                progress_callback.emit(100.0*callback_progessbar)
+                history_emit = {key:[value] for key,value in logs.items()}
+                history_emit["LearningRate"] = [learningrate]
+                if prefetch:
+                    history_emit["Prefetch time"] = [prefetcher.prefetch_time]
+                    history_emit["Idle time"] = [prefetcher.idle_time]
+                history_callback.emit(history_emit)
+
+            def epoch_begin(epoch,logs=None):
+                #Keras callback: fitting can be paused
+                while str(self.fittingpopups.pushButton_Pause_pop.text())==" ":
+                    time.sleep(1) #wait 1 seconds and then check the text on the button again
+
+            def epoch_end(epoch,logs):
+                #Keras callback (single model): save the model if a record was broken or
+                #upon user-request, emit the history and append it to the _history.csv
+                nonlocal counter
+                val_logs,validated = validation.evaluate(model_fit,epoch)
+                logs = dict(logs,**val_logs)
+                stopwatch = time.time()-time_start
+                learningrate = K.get_value(model_fit.optimizer.lr)
+
+                #Check if any metric broke a record
+                keys = broken_records(logs,validated)
+                for key in keys:
+                    print(key+" broke record -> Model will be saved" )
+                if len(keys)>0:#if any record was broken...
+                    save_model_single()
+                    saved = 1
+                #Also save the model upon user-request
+                elif bool(self.fittingpopups.checkBox_saveEpoch_pop.isChecked())==True:
+                    if deviceSelected=="Multi-GPU":#in case of Multi-GPU...
+                        #In case of multi-GPU, first copy the weights of the parallel model to the normal model
+                        model_keras.set_weights(model_keras_p.layers[-2].get_weights())
+                    #models saved upon user-request are not skipped in favour of newer ones
+                    checkpoint_writers[0].save(model_keras,new_modelname.split(".model")[0]+"_"+str(counter)+".model",coalesce=False)
+                    saved = 1
+                    self.fittingpopups.checkBox_saveEpoch_pop.setChecked(False)
+                else:
+                    saved = 0
+
+                report_checkpoints()
+                emit_history(logs,learningrate)
+                save_meta_single(dict(logs,Saved=saved,Time=stopwatch,LearningRate=learningrate))
+                counter+=1
+
+                #Only keep fitting if the respective window is open. Changed settings
+                #are applied between two calls of .fit() (see below)
+                if not self.fittingpopups.isVisible() or self.fittingpopups.checkBox_ApplyNextEpoch.isChecked():
+                    model_fit.stop_training = True
+
+            def report_checkpoints():
+                #Inform the user about models that were saved in the background
+                for checkpoint_writer in checkpoint_writers:
+                    for text in checkpoint_writer.pop_messages():
+                        self.fittingpopups.textBrowser_FittingInfo.append(text)
+
+            #Models are saved on background threads, training continues meanwhile
+            if collection==False:
+                checkpoint_writers = [aid_dl.CheckpointWriter(model_keras,save_format='h5',sess=sess)]
+            else:
+                checkpoint_writers = [aid_dl.CheckpointWriter(m,save_format=None,sess=sess) for m in model_keras]
 
+            #generate a list of callbacks, get empty list if callback_lr is none
+            callbacks = []
+            if callback_lr!=None:
+                callbacks.append(callback_lr)
+
+            time_start = time.time()
+            t1 = time.time() #Initialize a timer; this is used to sync the history file every few seconds
+            if collection==False:
+                ###################################################
+                ###############Actual fitting######################
+                ###################################################
+                #A single call of .fit() runs over all epochs. The training data of each
+                #epoch is streamed (train_seq) or prepared for the entire epoch (EpochFeeder).
+                #Saving, the history and pausing are handled by callbacks
+                model_fit = model_keras if model_keras_p == None else model_keras_p
+                if streaming:
+                    #shuffle=False: the events are already in random order (rng)
+                    fit_data = {"x":train_seq,"workers":1,"use_multiprocessing":False,"shuffle":False}
+                elif self.fittingpopups.isVisible():
+                    feeder = aid_dl.EpochFeeder(next_epoch,batchSize_expert,xtra_in=xtra_in,rng=rng_shuffle)
+                    fit_data = {"x":feeder.dataset(),"steps_per_epoch":len(feeder)}
+                callback_epoch = tf.keras.callbacks.LambdaCallback(on_epoch_begin=epoch_begin,on_epoch_end=epoch_end)
+                while counter < nr_epochs and self.fittingpopups.isVisible():
+                    if self.fittingpopups.checkBox_ApplyNextEpoch.isChecked():
+                        if apply_changed_settings()==False:
+                            return
+                        if counter >= nr_epochs:
+                            break
+                    if counter>0 and streaming:
+                        #The previous .fit() was stopped after an epoch; draw new events
+                        #unless keras already did so at the end of that epoch
+                        train_seq.next_epoch()
+                    model_fit.fit(**fit_data,initial_epoch=counter,epochs=nr_epochs,verbose=verbose,
+                                  class_weight=class_weight,callbacks=callbacks+[callback_epoch])
+
+            elif collection==True:
+                #The models of the collection are fitted at the same time on the same training
+                #data (aid_dl.CollectionFitter). Batches of a streamed epoch (train_seq) cannot be
+                #loaded from several threads, hence those models are fitted one after another
+                fitter = aid_dl.CollectionFitter(len(model_keras),threads=1 if streaming else Default_dict["Collection parallel fits"],sess=sess)
+                #each model needs its own learning rate callback
+                callbacks_collection = [copy.deepcopy(callbacks) for m in model_keras]
+
+                def fit_member(i):
+                    #Fit model i for one epoch and validate it (runs on a thread of fitter)
+                    #Expert-settings return automatically to default values when Expert-mode is unchecked
+                    history = model_keras[i].fit(**fit_data, epochs=epochs_expert,verbose=verbose,class_weight=class_weight,callbacks=callbacks_collection[i])
+                    logs = {key:history.history[key][-1] for key in history.history.keys()}
+                    val_logs,validated = validation.evaluate(model_keras[i],counter)
+                    logs.update(val_logs)
+                    return logs,validated,K.get_value(history.model.optimizer.lr)
+
+                while counter < nr_epochs and self.fittingpopups.isVisible():
+                    settings_changed = False
+                    if self.fittingpopups.checkBox_ApplyNextEpoch.isChecked():
+                        if apply_changed_settings()==False:
+                            fitter.close()
+                            return
+                        settings_changed = True
+                        if counter >= nr_epochs:
+                            break
+                    #arguments for .fit(): either the whole (augmented) epoch or the Sequence that streams it
+                    if streaming:
+                        #all models get the same events and augmentation (SharedEpoch); the
+                        #events are already in random order (rng)
+                        fit_data = {"x":aid_dl.SharedEpoch(train_seq),"workers":1,"use_multiprocessing":False,"shuffle":False}
+                    else:
+                        X_batch,Y_batch,xtra_train = next_epoch()
+                        if xtra_in==True:
+                            print("Add Xtra Data to X_batch")
+                            X_batch = [X_batch,xtra_train]
+                        fit_data = {"x":X_batch,"y":Y_batch,"batch_size":batchSize_expert}
+                    epoch_begin(counter)
+
+                    #Changed settings (e.g. recompiling, class_weight) can add operations to the graph during .fit(),
+                    #which must not happen on several threads at the same time
+                    results = fitter.map(fit_member,sequential=settings_changed)
+                    if streaming:
+                        train_seq.sample_epoch() #events of the next epoch (once for all models)
+                    rows = []
+                    for i in range(len(model_keras)):
+                        logs,validated,learningrate = results[i]
+
+                        print("model_keras_path[i]")
+                        print(model_keras_path[i])
+
+                        #Check if any metric broke a record
+                        keys = broken_records(logs,validated)
+                        for key in keys:
+                            text = key+" broke record -> Model will be saved"
+                            print(text)
+                            self.fittingpopups.textBrowser_FittingInfo.append(text)
+
+                        #For collections of models:
+                        if len(keys)>0:
+                            #Save the model
+                            checkpoint_writers[i].save(model_keras[i],model_keras_path[i].split(".model")[0]+"_"+str(counter)+".model")
+                            rows.append(dict(logs,Saved=1))
+                        elif bool(self.fittingpopups.checkBox_saveEpoch_pop.isChecked())==True:
+                            checkpoint_writers[i].save(model_keras[i],model_keras_path[i].split(".model")[0]+"_"+str(counter)+".model",coalesce=False)
+                            rows.append(dict(logs,Saved=1))
+                            self.fittingpopups.checkBox_saveEpoch_pop.setChecked(False)
+                        else:
+                            rows.append(dict(logs,Saved=0))
+
+                    report_checkpoints()
+                    emit_history(logs,learningrate)
+                    save_meta_collection(rows)
+                    counter+=1
+                fitter.close()
+
+            if streaming:
+                train_seq.close()
+            if prefetch:
+                prefetcher.stop()
+            if aug_pool is not None:
+                aug_pool.close()
+            for checkpoint_writer in checkpoint_writers:
+                checkpoint_writer.close()#wait until all models are written
+            report_checkpoints()
             progress_callback.emit(100.0)
 
             #If the original storing locating became inaccessible (folder name changed, HD unplugged...)
@@ -4006,54 +4096,24 @@ class AIDeveloper(QtWidgets.QWidget):
                 self.fittingpopups.textBrowser_FittingInfo.setStyleSheet("background-color: yellow;")
                 self.fittingpopups.textBrowser_FittingInfo.moveCursor(QtGui.QTextCursor.End)
 
+            #The History sheet of meta.xlsx is written once, from the _history.csv
             if collection==False:
-                if len(Histories)>0: #if the list for History files is not empty, process it!
-                    DF1 = [[ h[h_i][-1] for h_i in h] for h in Histories] #if nb_epoch in .fit() is >1, only save the last history item, beacuse this would a model that could be saved
-                    DF1 = np.r_[DF1]
-                    DF1 = pd.DataFrame( DF1,columns=Histories[0].keys() )
-                    DF1["Saved"] = Saved
-                    DF1["Time"] = Stopwatch
-                    DF1["LearningRate"] = LearningRate
-                    DF1.index = Index
-                    Index = []#reset the Index list
-                    Histories = []#reset the Histories list
-                    Saved = []
-                    #does such a file exist already? append!
-                    if not os.path.isfile(new_modelname.split(".model")[0]+'_meta.xlsx'):
-                       DF1.to_excel(writer,sheet_name='History')
-                    else: # else it exists so append without writing the header
-                       DF1.to_excel(writer,sheet_name='History', startrow=writer.sheets['History'].max_row,header= False)
+                history_log.to_excel(writer,sheet_name='History')
+                history_log.close()
                 if os.path.isfile(new_modelname.split(".model")[0]+'_meta.xlsx'):
                     os.chmod(new_modelname.split(".model")[0]+'_meta.xlsx', S_IREAD|S_IRGRP|S_IROTH|S_IWRITE|S_IWGRP|S_IWOTH) #make read/write
                 writer.save()
                 writer.close()
 
             if collection==True:
-                for i in range(len(HISTORIES)):
-                    Histories = HISTORIES[i]
-                    Saved = SAVED[i]
-                    if len(Histories)>0: #if the list for History files is not empty, process it!
-                        DF1 = [[ h[h_i][-1] for h_i in h] for h in Histories] #if nb_epoch in .fit() is >1, only save the last history item, beacuse this would a model that could be saved
-                        DF1 = np.r_[DF1]
-                        DF1 = pd.DataFrame( DF1,columns=Histories[0].keys() )
-                        DF1["Saved"] = Saved
-                        DF1.index = Index
-                        HISTORIES[i] = []#reset the Histories list
-                        SAVED[i] = []
-                        #does such a file exist already? append!
-                        if not os.path.isfile(model_keras_path[i].split(".model")[0]+'_meta.xlsx'):
-                           DF1.to_excel(Writers[i],sheet_name='History')
-                        else: # else it exists so append without writing the header
-                           DF1.to_excel(writer,sheet_name='History', startrow=writer.sheets['History'].max_row,header= False)
+                for i in range(len(history_logs)):
+                    history_logs[i].to_excel(Writers[i],sheet_name='History')
+                    history_logs[i].close()
                     if os.path.isfile(model_keras_path[i].split(".model")[0]+'_meta.xlsx'):
                         os.chmod(model_keras_path[i].split(".model")[0]+'_meta.xlsx', S_IREAD|S_IRGRP|S_IROTH|S_IWRITE|S_IWGRP|S_IWOTH) #make read/write
                     Writers[i].save()
                     Writers[i].close()
 
-                Index = []#reset the Index list
-
-
-
             sess.close()
     #        try:
     #            aid_dl.reset_keras(model_keras)
@@ -4109,8 +4169,33 @@ class AIDeveloper(QtWidgets.QWidget):
 # =============================================================================
 #         self.statusbar.showMessage("Moving data to RAM")
 # =============================================================================
-        #check that the nr. of classes are equal to the model out put
         SelectedFiles = self.items_clicked()
+        max_bytes = self.refresh_ram(SelectedFiles)
+        if max_bytes==None:
+            return
+
+        refresh = self.ram.last_refresh
+        from_disk = [selectedfile["rtdc_path"] for selectedfile in SelectedFiles if selectedfile["rtdc_path"] not in self.ram]
+        msg = QtWidgets.QMessageBox()
+        msg.setIcon(QtWidgets.QMessageBox.Information)
+        text = "Kept "+str(len(refresh["kept"]))+", loaded "+str(len(refresh["loaded"]))+" and removed "+str(len(refresh["removed"]))+" file(s)."
+        if len(from_disk)==0:
+            msg.setText("Successfully moved data to RAM. "+text)
+        else:
+            msg.setText("Moved data to RAM. "+text+" Due to the RAM cache budget ("+str(np.round(max_bytes/1024**3,2))+"GB), "+str(len(set(from_disk)))+" file(s) will be read from .rtdc during training.")
+            msg.setDetailedText("\n".join(sorted(set(from_disk))))
+        msg.setWindowTitle("Moved Data to RAM")
+        msg.setStandardButtons(QtWidgets.QMessageBox.Ok)
+        msg.exec_()
+        self.dataOverviewOn()
+
+# =============================================================================
+#         self.statusbar.showMessage("")
+# =============================================================================
+
+    def refresh_ram(self,SelectedFiles):
+        #Update self.ram: only files that are new or were changed (crop, zoom, color mode, padding) are loaded
+        #Returns the RAM cache budget in bytes (None if loading failed)
         color_mode = self.get_color_mode()
         zoom_factors = [selectedfile["zoom_factor"] for selectedfile in SelectedFiles]
         #zoom_order = [self.actionOrder0.isChecked(),self.actionOrder1.isChecked(),self.actionOrder2.isChecked(),self.actionOrder3.isChecked(),self.actionOrder4.isChecked(),self.actionOrder5.isChecked()]
@@ -4123,19 +4208,22 @@ class AIDeveloper(QtWidgets.QWidget):
         cropsize2 = np.sqrt(crop**2+crop**2)
         cropsize2 = np.ceil(cropsize2 / 2.) * 2 #round to the next even number
 
-        dic = aid_img.crop_imgs_to_ram(list(SelectedFiles),crop,zoom_factors=zoom_factors,zoom_order=zoom_order,color_mode=color_mode)
-        self.ram = dic
+        paddingMode = str(self.comboBox_paddingMode.currentText())
 
-        msg = QtWidgets.QMessageBox()
-        msg.setIcon(QtWidgets.QMessageBox.Information)
-        msg.setText("Successfully moved data to RAM")
-        msg.setWindowTitle("Moved Data to RAM")
-        msg.setStandardButtons(QtWidgets.QMessageBox.Ok)
-        msg.exec_()
+        #Cropped images are cached on disk and reused in later sessions
+        if Default_dict["Crop cache On"]:
+            cache_dir = aid_bin.get_crop_cache_dir(Default_dict["Crop cache directory"])
+            cache_size_GB = Default_dict["Crop cache max. size (GB)"]
+        else:
+            cache_dir,cache_size_GB = None,None
 
-# =============================================================================
-#         self.statusbar.showMessage("")
-# =============================================================================
+        #Only as many files as fit into the memory budget are loaded; others are read from .rtdc
+        max_bytes = aid_bin.ram_budget_bytes(Default_dict["RAM cache budget"])
+        dic = aid_img.crop_imgs_to_ram(list(SelectedFiles),crop,zoom_factors=zoom_factors,zoom_order=zoom_order,color_mode=color_mode,padding_mode=paddingMode,cache_dir=cache_dir,cache_size_GB=cache_size_GB,roi_read=Default_dict["ROI read"],max_bytes=max_bytes,ram=self.ram)
+        if dic==None:
+            return
+        self.ram = dic
+        return max_bytes
 
     def get_class_weight(self,SelectedFiles,lossW_expert,custom_check_classes=False):
         t1 = time.time()
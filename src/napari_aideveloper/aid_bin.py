@@ -4,6 +4,8 @@ Created on Tue Feb 22 16:20:53 2022
 
 @author: nana
 """
+import collections
+import csv
 import datetime
 import hashlib
 import json
@@ -12,6 +14,7 @@ import pathlib
 import re
 import shutil
 import tarfile
+import threading
 import time
 import urllib
 import warnings
@@ -19,6 +22,8 @@ import zipfile
 
 import h5py
 import numpy as np
+import pandas as pd
+import psutil
 import six
 from scipy.interpolate import RectBivariateSpline
 from scipy.stats import gaussian_kde, skew
@@ -30,25 +35,237 @@ dir_root = os.path.dirname(__file__)#ask the module for its origin
 #: Chunk size for storing HDF5 data
 CHUNK_SIZE = 100
 
-def load_rtdc(rtdc_path):
+class RtdcHandlePool():
+    """
+    LRU pool of open .rtdc files (h5py.File, read-only) keyed by path and
+    modification time. Loading a file again (for example to show example
+    images) returns the handle that is already open. If the file was
+    modified on disk, a new handle is opened and the outdated one is closed.
+
+    Handles that are used for a longer time (or in a different thread) are
+    pinned using pin=True and release() (reference counting). If more than
+    max_open files are open, the least recently used handles that are not
+    pinned are closed.
+
+    max_open: int; maximum nr. of open files that are not pinned
+    rdcc_nbytes: int; size of the HDF5 chunk cache of each file (bytes)
+    """
+    def __init__(self,max_open=32,rdcc_nbytes=16*1024**2):
+        self.max_open = int(max_open)
+        self.rdcc_nbytes = int(rdcc_nbytes)
+        self.handles = collections.OrderedDict() #key: (path,mtime); value: [rtdc_ds,refcount]
+        self.lock = threading.RLock()
+
+    def configure(self,max_open=None,rdcc_nbytes=None):
+        """
+        Change the settings. A new chunk cache size only applies to files
+        opened afterwards
+        """
+        with self.lock:
+            if max_open is not None:
+                self.max_open = int(max_open)
+            if rdcc_nbytes is not None:
+                self.rdcc_nbytes = int(rdcc_nbytes)
+            self.evict()
+
+    def get(self,rtdc_path,pin=False):
+        key = (os.path.abspath(rtdc_path),os.path.getmtime(rtdc_path))
+        with self.lock:
+            entry = self.handles.get(key)
+            if entry is None or not entry[0].id.valid:#not open yet or closed elsewhere
+                try:
+                    #sometimes there occurs an error when opening hdf files,
+                    #therefore try opening a second time in case of an error.
+                    #This is very strange, and seems like a dirty solution,
+                    #but I never saw it failing two times in a row
+                    rtdc_ds = h5py.File(rtdc_path,'r',rdcc_nbytes=self.rdcc_nbytes)
+                except:
+                    rtdc_ds = h5py.File(rtdc_path,'r',rdcc_nbytes=self.rdcc_nbytes)
+                entry = [rtdc_ds,0 if entry is None else entry[1]]
+                self.handles[key] = entry
+            self.handles.move_to_end(key)
+            if pin:
+                entry[1] += 1
+            self.evict()
+            return entry[0]
+
+    def release(self,rtdc_ds):
+        """
+        Unpin a handle (obtained using pin=True)
+        """
+        with self.lock:
+            for entry in self.handles.values():
+                if entry[0] is rtdc_ds:
+                    entry[1] = max(0,entry[1]-1)
+                    break
+            self.evict()
+
+    def close_key(self,key):
+        rtdc_ds = self.handles.pop(key)[0]
+        if rtdc_ds.id.valid:
+            rtdc_ds.close()
+
+    def evict(self):
+        with self.lock:
+            #close handles of files that were modified on disk in the meantime
+            newest = {}
+            for path,mtime in self.handles.keys():
+                newest[path] = max(mtime,newest.get(path,mtime))
+            for key in list(self.handles.keys()):
+                if key[1]<newest[key[0]] and self.handles[key][1]==0:
+                    self.close_key(key)
+            #close the least recently used handles that are not pinned
+            unpinned = [key for key in self.handles.keys() if self.handles[key][1]==0]
+            while len(unpinned)>self.max_open:
+                self.close_key(unpinned.pop(0))
+
+    def close_path(self,rtdc_path):
+        """
+        Close all handles of a file (e.g. before it is overwritten)
+        """
+        with self.lock:
+            for key in list(self.handles.keys()):
+                if key[0]==os.path.abspath(rtdc_path):
+                    self.close_key(key)
+
+    def close_all(self):
+        with self.lock:
+            for key in list(self.handles.keys()):
+                self.close_key(key)
+
+#Shared by all functions that read .rtdc files
+rtdc_handles = RtdcHandlePool()
+
+def load_rtdc(rtdc_path,pin=False):
     """
     This function load .rtdc files using h5py and takes care of catching all
-    errors
+    errors. Files are kept open in rtdc_handles and the same handle is
+    returned when the file is loaded again.
+    pin: bool; if True, the handle is not closed until release_rtdc is called
     """
     try:
-        try:
-            #sometimes there occurs an error when opening hdf files,
-            #therefore try opening a second time in case of an error.
-            #This is very strange, and seems like a dirty solution,
-            #but I never saw it failing two times in a row
-            rtdc_ds = h5py.File(rtdc_path, 'r')
-        except:
-            rtdc_ds = h5py.File(rtdc_path, 'r')
+        rtdc_ds = rtdc_handles.get(rtdc_path,pin=pin)
         return False,rtdc_ds #failed=False
     except Exception as e:
         #There is an issue loading the files!
         return True,e
 
+def release_rtdc(rtdc_ds):
+    """
+    Release a handle that was loaded using load_rtdc(rtdc_path,pin=True)
+    """
+    rtdc_handles.release(rtdc_ds)
+
+#Metadata of scanned .rtdc files. Key: (path,size,mtime)
+rtdc_scan_cache = {}
+rtdc_scan_lock = threading.Lock()
+
+def scan_rtdc(rtdc_path):
+    """
+    Collect the metadata that is shown in the file table: available features,
+    nr. of images, pixel size and whether there is xtra_in data.
+    The result is cached using path, size and modification time of the file,
+    so dropping the same (unchanged) file again does not touch the file.
+    Raises the error of load_rtdc if the file can't be opened.
+    """
+    stat = os.stat(rtdc_path)
+    key = (os.path.abspath(rtdc_path),stat.st_size,stat.st_mtime)
+    with rtdc_scan_lock:
+        if key in rtdc_scan_cache:
+            return dict(rtdc_scan_cache[key],rtdc_path=rtdc_path)
+
+    #scans run on threads: pin the handle, such that other scans can't close it
+    failed,rtdc_ds = load_rtdc(rtdc_path,pin=True)
+    if failed:
+        raise rtdc_ds
+    try:
+        features = list(rtdc_ds["events"].keys())
+        fileinfo = {"rtdc_path":rtdc_path,"features":features}
+        if "image" in features and "pos_x" in features and "pos_y" in features:
+            fileinfo["nr_images"] = rtdc_ds["events"]["image"].len()
+            fileinfo["pix"] = rtdc_ds.attrs["imaging:pixel size"]
+            fileinfo["xtra_in"] = len(rtdc_ds.keys())>2 #Is True, only if there are more than 2 elements.
+    finally:
+        release_rtdc(rtdc_ds)
+
+    with rtdc_scan_lock:
+        rtdc_scan_cache[key] = fileinfo
+    return dict(fileinfo)
+
+def read_events(dataset,indices,max_chunks=20):
+    """
+    Read the events at the given indices from an HDF5 dataset (for example
+    rtdc_ds["events"]["image"]).
+    Fancy-indexing a h5py dataset results in one small read per event and
+    compressed chunks are decompressed again for each event they contain.
+    Here, the requested indices are grouped by HDF5 chunk and neighboring
+    chunks are read with one slice, such that each chunk is decompressed only
+    once. The events are then gathered into a contiguous array.
+
+    Parameters
+    ----------
+    dataset: h5py dataset (or ndarray) of shape (N,...)
+    indices: list or ndarray of int
+        indices of the events. Indices can be unsorted and can occur
+        several times
+    max_chunks: int
+        maximum number of chunks that are read at once (limits the RAM
+        that is needed temporarily)
+
+    Returns
+    ----------
+    ndarray of shape (len(indices),...) with the events in the order of
+    indices
+    """
+    indices = np.asarray(indices,dtype=np.int64)
+    if isinstance(dataset,np.ndarray):
+        return dataset[indices]
+    out = np.empty((len(indices),)+dataset.shape[1:],dtype=dataset.dtype)
+    if len(indices)==0:
+        return out
+
+    order = np.argsort(indices,kind="stable")
+    indices_sorted = indices[order]
+    for start,stop,lo,hi in get_chunk_blocks(dataset,indices_sorted,max_chunks):
+        block = dataset[start:stop]
+        out[order[lo:hi]] = block[indices_sorted[lo:hi]-start]
+    return out
+
+def get_chunk_blocks(dataset,indices_sorted,max_chunks=20):
+    """
+    Group sorted event indices into blocks of neighboring HDF5 chunks.
+    Chunks that contain none of the indices are skipped.
+
+    Parameters
+    ----------
+    dataset: h5py dataset of shape (N,...)
+    indices_sorted: ndarray of int; sorted indices of the events
+    max_chunks: int; maximum number of chunks per block
+
+    Returns
+    ----------
+    list of tuples (start,stop,lo,hi): the block contains the events
+    start:stop of the dataset, which are the requested events
+    indices_sorted[lo:hi]
+    """
+    if dataset.chunks is not None:
+        chunk_len = dataset.chunks[0]
+    else:#contiguous dataset
+        chunk_len = CHUNK_SIZE
+    chunk_ids = np.unique(indices_sorted//chunk_len)
+    #Find runs of neighboring chunks and split them into blocks of max_chunks
+    run_starts = np.r_[0,np.where(np.diff(chunk_ids)>1)[0]+1]
+    run_ends = np.r_[run_starts[1:],len(chunk_ids)]
+    blocks = []
+    for run_start,run_end in zip(run_starts,run_ends):
+        for block_start in range(run_start,run_end,max_chunks):
+            block_end = min(block_start+max_chunks,run_end)
+            start = chunk_ids[block_start]*chunk_len
+            stop = min((chunk_ids[block_end-1]+1)*chunk_len,dataset.shape[0])
+            lo,hi = np.searchsorted(indices_sorted,[start,stop])
+            blocks.append((start,stop,lo,hi))
+    return blocks
+
 def save_aid_settings(Default_dict):
     dir_settings = os.path.join(dir_root,"aid_settings.json")#dir to settings
     #Save the layout to Default_dict
@@ -122,28 +339,211 @@ def hashfunction(rtdc_path):
               hashfile(rtdc_path, blocksize=65536, count=20)]
     return hashlib.md5(obj2bytes(tohash)).hexdigest()
 
-def calc_ram_need(crop):
+def get_crop_cache_dir(cache_dir=""):
+    """Folder of the crop cache. Empty string means default location"""
+    if cache_dir=="" or cache_dir is None:
+        cache_dir = os.path.join(os.path.expanduser('~'),".aideveloper","crop_cache")
+    return cache_dir
+
+def crop_cache_key(rtdc_path,crop,zoom_factor,zoom_order,color_mode,padding_mode,xtra_in):
+    """Key for the crop cache based on file content and all cropping parameters"""
+    tohash = [hashfunction(rtdc_path),os.path.getsize(rtdc_path),int(crop),float(zoom_factor),str(zoom_order),
+              str(color_mode),str(padding_mode),bool(xtra_in)]
+    return hashlib.md5(obj2bytes(tohash)).hexdigest()
+
+def crop_cache_load(cache_dir,key):
+    """
+    Load cropped images, indices and xtra_in data from the crop cache.
+    Images are returned as read-only memory map.
+    Returns None if there is no (complete) entry for key
+    """
+    path = os.path.join(cache_dir,key)
+    fnames = [os.path.join(path,f) for f in ["images.npy","indices.npy","xtra_in.npy"]]
+    if not all([os.path.isfile(f) for f in fnames]):
+        return None
+    try:
+        images = np.load(fnames[0],mmap_mode="r")
+        indices = np.load(fnames[1])
+        xtra_in_data = np.load(fnames[2])
+    except Exception as e:
+        print("Could not load cache entry "+path+"\n"+str(e))
+        return None
+    os.utime(path) #mark entry as recently used
+    return images,indices,xtra_in_data
+
+def crop_cache_save(cache_dir,key,images,indices,xtra_in_data,max_size_GB=10):
+    """
+    Store cropped images, indices and xtra_in data in the crop cache and
+    evict the least recently used entries if the cache gets larger than
+    max_size_GB
+    """
+    path = os.path.join(cache_dir,key)
+    path_tmp = path+"_tmp"+str(os.getpid())
+    try:
+        os.makedirs(path_tmp,exist_ok=True)
+        np.save(os.path.join(path_tmp,"images.npy"),np.asarray(images))
+        np.save(os.path.join(path_tmp,"indices.npy"),np.asarray(indices))
+        np.save(os.path.join(path_tmp,"xtra_in.npy"),np.asarray(xtra_in_data))
+        if os.path.isdir(path):
+            shutil.rmtree(path,ignore_errors=True)
+        os.replace(path_tmp,path) #entry only becomes visible when complete
+    except Exception as e:
+        print("Could not write cache entry "+path+"\n"+str(e))
+        shutil.rmtree(path_tmp,ignore_errors=True)
+        return
+    crop_cache_evict(cache_dir,max_size_GB,keep=[key])
+
+def crop_cache_evict(cache_dir,max_size_GB,keep=[]):
+    """Delete least recently used entries until the cache is smaller than max_size_GB"""
+    if not os.path.isdir(cache_dir):
+        return
+    entries = []
+    for key in os.listdir(cache_dir):
+        path = os.path.join(cache_dir,key)
+        if not os.path.isdir(path):
+            continue
+        size = sum([os.path.getsize(os.path.join(path,f)) for f in os.listdir(path)])
+        entries.append((os.path.getmtime(path),size,key))
+    size_total = sum([entry[1] for entry in entries])
+    for mtime,size,key in sorted(entries):#oldest first
+        if size_total<=max_size_GB*1024**3:
+            break
+        if key in keep:
+            continue
+        print("Crop cache: removing "+key)
+        shutil.rmtree(os.path.join(cache_dir,key),ignore_errors=True)
+        size_total -= size
+
+def ram_budget_bytes(budget):
+    """
+    Convert the setting "RAM cache budget" to bytes
+    budget: float; <=1: fraction of the currently available memory, >1: GB
+    """
+    budget = float(budget)
+    if budget<=1:
+        return int(budget*psutil.virtual_memory().available)
+    return int(budget*1024**3)
+
+def ram_cache_plan(SelectedFiles,crop,color_mode,max_bytes=None):
+    """
+    Decide which files are kept in RAM. Files that are sampled most often per
+    epoch (nr_events_epoch/nr_images) profit most and are chosen first, as
+    long as they fit into max_bytes. The remaining files are read from .rtdc.
+    Returns two lists of rtdc_paths: (in RAM, from disk)
+    """
+    channels = 3 if color_mode.lower()=="rgb" else 1
+    rate,nbytes = {},{}
+    for selectedfile in SelectedFiles:
+        rtdc_path = selectedfile["rtdc_path"]
+        nr_images = max(int(selectedfile["nr_images"]),1)
+        if selectedfile.get("shuffle",True):
+            rate_ = selectedfile.get("nr_events_epoch",nr_images)/float(nr_images)
+        else:
+            rate_ = 1.0 #all images are used in each epoch
+        #same file can be used for training and validation
+        rate[rtdc_path] = max(rate.get(rtdc_path,0),rate_)
+        nbytes[rtdc_path] = nr_images*int(crop)**2*channels #uint8
+
+    in_ram,from_disk = [],[]
+    total = 0
+    for rtdc_path in sorted(rate,key=rate.get,reverse=True):
+        if max_bytes==None or total+nbytes[rtdc_path]<=max_bytes:
+            in_ram.append(rtdc_path)
+            total += nbytes[rtdc_path]
+        else:
+            from_disk.append(rtdc_path)
+    return in_ram,from_disk
+
+def memory_plan(SelectedFiles,crop,color_mode,nr_classes,batch_size=32,max_bytes=None,
+                streaming=False,prefetch_depth=0,aug_processes=1):
+    """
+    Analytic estimate of the memory (bytes) that is needed for training.
+    SelectedFiles: list of dicts (nr_images, nr_events_epoch, shuffle, TrainOrValid)
+    crop: int; final image size. Images are loaded at cropsize2 (=crop*sqrt(2))
+    to allow rotation and cropped to crop after affine augmentation
+    max_bytes: RAM cache budget (see ram_cache_plan)
+    streaming: bool; batches are loaded by aid_dl.EpochSequence
+    prefetch_depth: int; nr. of epochs prepared in the background (aid_dl.EpochPrefetcher)
+    aug_processes: int; nr. of processes for augmentation (aid_img.AugmentationPool)
+
+    Returns a dict. "RAM cache" and "Validation set" are kept during the
+    whole training. Other entries are the memory of the training data of one
+    epoch during the respective stage. "Peak" is the expected maximum.
+    """
+    channels = 3 if color_mode.lower()=="rgb" else 1
     crop = int(crop)
-    n=1000
-    #100k cropped images (64x64 pix unsigned integer8) need 400MB of RAM:
-    Imgs = []
-    sizex,sizey = crop,crop
-    for i in range(n):
-        Imgs.append(np.random.randint(low=0,high=255,size=(sizex,sizey),dtype=np.uint8))
-    Imgs = np.array(Imgs)
-    #Imgs = Imgs.astype(np.uint8)
-    MB = Imgs.nbytes/1048576.0 #Amount of RAM for 1000 images
-    MB = MB/float(n)
-    return MB
+    cropsize2 = int(np.ceil(np.sqrt(crop**2+crop**2)/2.)*2)
+
+    def nr_events(selectedfile):
+        if selectedfile["shuffle"]:
+            return int(selectedfile["nr_events_epoch"])
+        return int(selectedfile["nr_images"]) #all images are used
+    n_train = sum([nr_events(f) for f in SelectedFiles if f["TrainOrValid"]=="Train"])
+    n_valid = sum([nr_events(f) for f in SelectedFiles if f["TrainOrValid"]=="Valid"])
+
+    plan = dict()
+    in_ram,from_disk = ram_cache_plan(SelectedFiles,crop,color_mode,max_bytes)
+    nr_images = {f["rtdc_path"]:int(f["nr_images"]) for f in SelectedFiles}
+    plan["RAM cache"] = sum([nr_images[rtdc_path] for rtdc_path in in_ram])*crop**2*channels
+    #uint8 images, float32 after normalization, float32 one-hot labels
+    plan["Validation set"] = n_valid*crop**2*channels*(1+4) + n_valid*nr_classes*4
+
+    if streaming:
+        #keras keeps up to 10 batches in its queue (max_queue_size) plus the current one
+        n = min(batch_size,n_train)*11
+    else:
+        n = n_train
+    U2 = n*cropsize2**2*channels #uint8 images before affine augmentation
+    U = n*crop**2*channels #uint8 images after cropping
+    F = 4*U #float32 images after normalization
+    Y = 4*n*nr_classes #one-hot labels
+    #list of arrays of each file and the concatenated array
+    plan["Loading and cropping"] = 2*U2
+    #input and output; AugmentationPool: additionally shared input/output buffers
+    plan["Affine augmentation"] = 2*U2 if aug_processes<=1 else 4*U2
+    #X_batch_orig, augmented copy, float32 result and temporary array of the normalization
+    plan["Photometric augm. and normalization"] = 2*U + 2*F
+    #training data, labels and the tensor keras creates from the training data
+    plan["Fitting"] = U + 2*F + Y
+    if streaming:
+        plan["Fitting"] += n_train*2*8 #file and event index of each event of the epoch
+    plan["Prefetch queue"] = 0
+    if prefetch_depth>0 and not streaming:
+        plan["Prefetch queue"] = prefetch_depth*(F+Y)
+
+    stages = [plan["Loading and cropping"],plan["Affine augmentation"],plan["Photometric augm. and normalization"]]
+    if plan["Prefetch queue"]>0:
+        #the next epoch is prepared while the model is fitted
+        epoch_peak = plan["Fitting"]+plan["Prefetch queue"]+max(stages)
+    else:
+        epoch_peak = max(stages+[plan["Fitting"]])
+    plan["Peak"] = plan["RAM cache"]+plan["Validation set"]+epoch_peak
+    return plan
+
+def memory_plan_scale(plan,available):
+    """
+    Factor to scale the nr. of training events per epoch such that the
+    memory plan (see memory_plan) fits into available bytes. The RAM cache
+    and the validation set do not depend on the nr. of training events.
+    Returns a value <=0 if the plan does not fit, even without training events
+    """
+    fixed = plan["RAM cache"]+plan["Validation set"]
+    if plan["Peak"]<=available:
+        return 1.0
+    return (available-fixed)/float(plan["Peak"]-fixed)
+
+def memory_plan_text(plan):
+    """Memory plan as text (one line per stage, in MB)"""
+    return "\n".join([key+": "+str(np.round(value/1024**2,1))+" MB" for key,value in plan.items()])
 
 def ram_compare_data(ram_dic,new_dic):
     #compare the rtdc filenames:
     new_rtdc_paths = [a["rtdc_path"] for a in new_dic["SelectedFiles"]]
-    ram_rtdc_paths = list(ram_dic["rtdc_path"])
+    ram_rtdc_paths = ram_dic.rtdc_paths
     test_rtdc_paths = set(ram_rtdc_paths)==set(new_rtdc_paths)
 
     #Compare the image shape (size)
-    ram_imgshape = ram_dic["Cropped_Images"][0].shape
+    ram_imgshape = ram_dic[ram_rtdc_paths[0]]["images"].shape
     ram_imgcrop = ram_imgshape[1]
     new_imgcrop = new_dic["cropsize2"]
     test_imgcrop = ram_imgcrop==new_imgcrop
@@ -159,7 +559,7 @@ def ram_compare_data(ram_dic,new_dic):
     test_colormode = ram_colormode==new_colormode
 
     #compare the number of images
-    ram_nr_images = [a.shape[0] for a in ram_dic["Cropped_Images"]]
+    ram_nr_images = [ram_dic[rtdc_path]["images"].shape[0] for rtdc_path in ram_rtdc_paths]
     new_nr_images = [a["nr_images"] for a in new_dic["SelectedFiles"]]
     test_nr_images = set(ram_nr_images)==set(new_nr_images)
 
@@ -178,6 +578,7 @@ def write_rtdc(fname,rtdc_datasets,X_valid,Indices,cropped=True,color_mode='Gray
     """
     #Check if a file with name fname already exists:
     if os.path.isfile(fname):
+        rtdc_handles.close_path(fname)
         os.remove(fname) #delete it
         print("overwrite existing file")
 
@@ -558,6 +959,7 @@ def write_rtdc(fname,rtdc_datasets,X_valid,Indices,cropped=True,color_mode='Gray
     """
     #Check if a file with name fname already exists:
     if os.path.isfile(fname):
+        rtdc_handles.close_path(fname)
         os.remove(fname) #delete it
         print("overwrite existing file")
 
@@ -601,9 +1003,9 @@ def write_rtdc(fname,rtdc_datasets,X_valid,Indices,cropped=True,color_mode='Gray
                 indices = Indices[i]
                 if len(indices>0):
                     if cropped==False:
-                        images.append([rtdc_ds["events"]["image"][ii] for ii in indices])
-                    pos_x.append([rtdc_ds["events"]["pos_x"][ii] for ii in indices])
-                    pos_y.append([rtdc_ds["events"]["pos_y"][ii] for ii in indices])
+                        images.append(read_events(rtdc_ds["events"]["image"],indices))
+                    pos_x.append(read_events(rtdc_ds["events"]["pos_x"],indices))
+                    pos_y.append(read_events(rtdc_ds["events"]["pos_y"],indices))
 
         if cropped==True:
             images = X_valid
@@ -726,14 +1128,14 @@ def write_rtdc(fname,rtdc_datasets,X_valid,Indices,cropped=True,color_mode='Gray
                     #     store_scalar(h5group=events,name=feat, data=values, compression="gzip")
 
                     elif feat=="mask":# in ["mask", "image"]:
-                        mask = np.array(rtdc_ds["events"]["mask"])[indices]
+                        mask = read_events(rtdc_ds["events"]["mask"],indices)
                         if cropped:
                             pix = rtdc_ds.attrs["imaging:pixel size"]
                             pos_x = np.array(rtdc_ds["events"]["pos_x"])[indices]/pix
                             pos_y = np.array(rtdc_ds["events"]["pos_y"])[indices]/pix
                             img_dim_x = Images[0].shape[1]
                             img_dim_y = Images[0].shape[0]
-                            mask = aid_img.image_crop_pad_cv2(list(mask),pos_x,pos_y,pix,img_dim_x,img_dim_y,padding_mode="cv2.BORDER_CONSTANT")
+                            mask = aid_img.image_crop_pad_batch(mask,pos_x,pos_y,img_dim_x,img_dim_y,padding_mode="cv2.BORDER_CONSTANT")
 
                         mask = np.asarray(mask, dtype=np.uint8)
                         if mask.max() != 255 and mask.max() != 0 and mask.min() == 0:
@@ -755,11 +1157,10 @@ def write_rtdc(fname,rtdc_datasets,X_valid,Indices,cropped=True,color_mode='Gray
                             pos_y = np.array(rtdc_ds["events"]["pos_y"])[indices]/pix
                             img_dim_x = Images[0].shape[1]
                             img_dim_y = Images[0].shape[0]
-                            image_list = np.array(rtdc_ds["events"][feat])[indices]
-                            image_list = aid_img.image_crop_pad_cv2(list(image_list),pos_x,pos_y,pix,img_dim_x,img_dim_y,padding_mode="cv2.BORDER_CONSTANT")
-                            image_list = np.array(image_list)
+                            image_list = read_events(rtdc_ds["events"][feat],indices)
+                            image_list = aid_img.image_crop_pad_batch(image_list,pos_x,pos_y,img_dim_x,img_dim_y,padding_mode="cv2.BORDER_CONSTANT")
                         else:
-                            image_list = np.array(rtdc_ds["events"][feat])[indices]
+                            image_list = read_events(rtdc_ds["events"][feat],indices)
                         store_image(h5group=events,name=feat, data=image_list, compression="gzip")
 
                     elif feat == "trace":
@@ -813,6 +1214,69 @@ def write_rtdc(fname,rtdc_datasets,X_valid,Indices,cropped=True,color_mode='Gray
                 pass
 
 
+def fsync_file(fname):
+    #Make sure the content of the file was written to the disk
+    with open(fname,"rb+") as f:
+        os.fsync(f.fileno())
+
+
+class HistoryLog():
+    """
+    Append-only training history (.csv file). Each call of append() adds one
+    row (one epoch) to the end of the file, hence the cost per epoch does not
+    depend on the nr. of epochs that are already in the file (in contrast to
+    saving the History sheet of meta.xlsx, which rewrites the entire workbook).
+    The columns are defined by the first row; keys that are missing in later
+    rows are left empty and new keys are ignored.
+    The History sheet of meta.xlsx is written using to_excel() (end of
+    training or upon user-request).
+
+    fname: str; path of the .csv file
+    resume: bool; if True, rows are appended to an existing file (its header
+    defines the columns). Otherwise (new training) an existing file is overwritten
+    """
+    def __init__(self,fname,resume=False):
+        self.fname = fname
+        self.columns = None
+        if resume and os.path.isfile(fname) and os.path.getsize(fname)>0:
+            with open(fname,"r",newline="") as f:
+                self.columns = next(csv.reader(f))[1:] #first column is the index (epoch)
+        self.f = open(fname,"a" if self.columns is not None else "w",newline="")
+        self.writer = csv.writer(self.f)
+
+    def append(self,index,row,sync=False):
+        """
+        index: int; epoch
+        row: dict; name of metric -> value
+        sync: bool; force writing the file to the disk (os.fsync)
+        """
+        if self.columns is None:
+            self.columns = list(row.keys())
+            self.writer.writerow([""]+self.columns)
+        self.writer.writerow([index]+[row.get(key,"") for key in self.columns])
+        self.f.flush()
+        if sync:
+            os.fsync(self.f.fileno())
+
+    def read(self):
+        """
+        Returns the history as pandas DataFrame (index: epoch)
+        """
+        if not self.f.closed:
+            self.f.flush()
+        return pd.read_csv(self.fname,index_col=0)
+
+    def to_excel(self,writer,sheet_name="History"):
+        #Write the history to a sheet of the excel file (pd.ExcelWriter)
+        if self.columns is None:#nothing logged yet
+            return
+        self.read().to_excel(writer,sheet_name=sheet_name)
+
+    def close(self):
+        if not self.f.closed:
+            self.f.close()
+
+
 def create_temp_folder():
     temp_path = os.path.join(dir_root,"temp")
     if os.path.exists(temp_path):
@@ -872,11 +1336,11 @@ def open_temp():
 def ram_compare_data(ram_dic,new_dic):
     #compare the rtdc filenames:
     new_rtdc_paths = [a["rtdc_path"] for a in new_dic["SelectedFiles"]]
-    ram_rtdc_paths = list(ram_dic["rtdc_path"])
+    ram_rtdc_paths = ram_dic.rtdc_paths
     test_rtdc_paths = set(ram_rtdc_paths)==set(new_rtdc_paths)
 
     #Compare the image shape (size)
-    ram_imgshape = ram_dic["Cropped_Images"][0].shape
+    ram_imgshape = ram_dic[ram_rtdc_paths[0]]["images"].shape
     ram_imgcrop = ram_imgshape[1]
     new_imgcrop = new_dic["cropsize2"]
     test_imgcrop = ram_imgcrop==new_imgcrop
@@ -892,7 +1356,7 @@ def ram_compare_data(ram_dic,new_dic):
     test_colormode = ram_colormode==new_colormode
 
     #compare the number of images
-    ram_nr_images = [a.shape[0] for a in ram_dic["Cropped_Images"]]
+    ram_nr_images = [ram_dic[rtdc_path]["images"].shape[0] for rtdc_path in ram_rtdc_paths]
     new_nr_images = [a["nr_images"] for a in new_dic["SelectedFiles"]]
     test_nr_images = set(ram_nr_images)==set(new_nr_images)
 
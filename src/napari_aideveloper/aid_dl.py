@@ -4,6 +4,13 @@ Created on Thu Mar 24 13:13:59 2022
 
 @author: nana
 """
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import cv2
 import keras_metrics
 import numpy as np
 import pandas as pd
@@ -12,6 +19,12 @@ from tensorflow.keras import backend as K
 from tensorflow.keras.layers import Activation, Dense
 from tensorflow.keras.models import Model
 
+from . import aid_bin, aid_img
+
+#Adding operations to a graph is not thread-safe. Held by threads that may add
+#operations to the graph of the session while others use it (CheckpointWriter, CollectionFitter)
+graph_lock = threading.Lock()
+
 #from . import keras_metrics #side package for precision, recall etc during training
 global keras_metrics
 
@@ -204,6 +217,844 @@ class exponentialDecay(tf.keras.callbacks.Callback):
         K.set_value(self.model.optimizer.lr, self.exp_decay())
 
 
+class EpochSequence(tf.keras.utils.Sequence):
+    """
+    Streaming input pipeline for training.
+    Instead of loading and augmenting all images of an epoch at once, only
+    the events of the epoch are drawn (nr_events_epoch per file, like
+    aid_img.gen_crop_img/gen_crop_img_ram) and each batch is loaded (from RAM
+    or .rtdc), cropped, augmented and normalized when keras requests it.
+    Peak memory is therefore given by batch_size (times the number of batches
+    keras prefetches) instead of the size of the epoch.
+    A new set of events is drawn at the end of each epoch.
+
+    rtdc_paths, classes, nr_events_epoch, shuffle, zoom_factors: lists with
+    one entry per training file
+    ram: aid_img.RamCache; cropped images of the files contained there (see
+    aid_img.crop_imgs_to_ram) are taken from RAM, other files are read from .rtdc
+    cropsize: int; size of images loaded from .rtdc (larger than crop to allow rotation)
+    crop: int; final size of the images
+    affine_paras: dict; arguments for aid_img.affine_augm_paras (v_flip,h_flip,rotation,width_shift,height_shift,zoom,shear,crop)
+    or None (no affine augmentation)
+    photometric_paras: dict; arguments for aid_img.photometric_augm or None (no photometric augmentation)
+    rng: aid_img.RngContext or None (default random numbers). The events of
+    each epoch are drawn from rng; each batch gets its own child stream, so
+    the result does not depend on the order in which keras requests batches
+    tf_augmenter: TFAugmenter or None; if given, batches are augmented by
+    TFAugmenter (affine_paras and photometric_paras are not used)
+    """
+    def __init__(self,rtdc_paths,classes,nr_events_epoch,shuffle,zoom_factors,
+                 nr_classes,cropsize,crop,batch_size=32,ram=None,
+                 zoom_order="cv2.INTER_LINEAR",color_mode="Grayscale",
+                 padding_mode="constant",xtra_in=False,roi_read=False,
+                 affine_paras=None,photometric_paras=None,norm="None",
+                 mean_trainingdata=None,std_trainingdata=None,rng=None,
+                 tf_augmenter=None):
+        self.rtdc_paths = list(rtdc_paths)
+        self.classes = np.array(classes)
+        self.nr_events_epoch = list(nr_events_epoch)
+        self.shuffle = list(shuffle)
+        self.zoom_factors = list(zoom_factors)
+        self.nr_classes = nr_classes
+        self.cropsize = int(cropsize)
+        self.crop = int(crop)
+        self.batch_size = int(batch_size)
+        self.zoom_order = zoom_order
+        self.channels = 3 if color_mode=="RGB" else 1
+        self.padding_mode = aid_img.pad_arguments_np2cv(padding_mode)
+        self.xtra_in = xtra_in
+        self.roi_read = roi_read
+        if affine_paras is None:#no affine augmentation
+            affine_paras = {"v_flip":False,"h_flip":False,"rotation":0,"width_shift":0,
+                            "height_shift":0,"zoom":0,"shear":0}
+        if photometric_paras is None:#no photometric augmentation
+            photometric_paras = {"contrast_on":False,"contrast_lower":1,"contrast_higher":1,
+                                 "saturation_on":False,"saturation_lower":1,"saturation_higher":1,
+                                 "hue_on":False,"hue_delta":0,
+                                 "avgBlur_on":False,"avgBlur_min":0,"avgBlur_max":0,
+                                 "gaussBlur_on":False,"gaussBlur_min":0,"gaussBlur_max":0,
+                                 "motionBlur_on":False,"motionBlur_kernel":None,"motionBlur_angle":None,
+                                 "brightness_add_lower":0,"brightness_add_upper":0,
+                                 "brightness_mult_lower":1,"brightness_mult_upper":1,
+                                 "gaussnoise_mean":0,"gaussnoise_scale":0}
+        self.affine_paras = affine_paras
+        self.photometric_paras = photometric_paras
+        self.norm = norm
+        self.mean_trainingdata = mean_trainingdata
+        self.std_trainingdata = std_trainingdata
+        self.rng = aid_img.get_rng(rng)
+        self.tf_augmenter = tf_augmenter
+
+        self.ram = dict()
+        self.rtdc_ds,self.pos_x,self.pos_y,self.xtra_data = [],[],[],[]
+        if ram is not None:
+            #keep references to the arrays in ram (no copy)
+            for rtdc_path in self.rtdc_paths:
+                if rtdc_path in ram:
+                    self.ram[rtdc_path] = ram[rtdc_path]
+        self.open_files()
+        self.sample_epoch()
+
+    def open_files(self):
+        """
+        Open the .rtdc files that are not in RAM and get the positions (and
+        xtra_in data) of all events
+        """
+        self.rtdc_ds,self.pos_x,self.pos_y,self.xtra_data = [],[],[],[]
+        self.nr_events = []
+        for rtdc_path,zoom_factor in zip(self.rtdc_paths,self.zoom_factors):
+            if rtdc_path in self.ram:
+                self.rtdc_ds.append(None)
+                self.pos_x.append(None)
+                self.pos_y.append(None)
+                self.xtra_data.append(None)
+                self.nr_events.append(len(self.ram[rtdc_path]["images"]))
+                continue
+            failed,rtdc_ds = aid_bin.load_rtdc(rtdc_path,pin=True)
+            if failed:
+                raise IOError("Error occurred during loading file "+str(rtdc_path)+": "+str(rtdc_ds))
+            pix = rtdc_ds.attrs["imaging:pixel size"] #get pixelation (um/pix)
+            self.rtdc_ds.append(rtdc_ds)
+            #/pix converts to pixel index; adjust for zooming
+            self.pos_x.append(zoom_factor*rtdc_ds["events"]["pos_x"][:]/pix)
+            self.pos_y.append(zoom_factor*rtdc_ds["events"]["pos_y"][:]/pix)
+            self.xtra_data.append(np.array(rtdc_ds["xtra_in"]) if self.xtra_in else None)
+            self.nr_events.append(len(rtdc_ds["events"]["image"]))
+
+    def sample_epoch(self):
+        """
+        Draw the events for the next epoch: nr_events_epoch random events
+        (with replacement) of files with shuffle=True, all events otherwise
+        """
+        file_ind,event_ind = [],[]
+        for i in range(len(self.rtdc_paths)):
+            if self.shuffle[i]:
+                ind = self.rng.choice(self.nr_events[i],size=self.nr_events_epoch[i],replace=True)
+            else:
+                ind = np.arange(self.nr_events[i])
+            file_ind.append(np.repeat(i,len(ind)))
+            event_ind.append(ind)
+        permut = self.rng.permutation(sum([len(ind) for ind in event_ind]))
+        self.file_ind = np.concatenate(file_ind)[permut]
+        self.event_ind = np.concatenate(event_ind)[permut]
+        #one seed per batch: reading a batch again (e.g. by the next model of
+        #a collection, see SharedEpoch) gives the same augmentation
+        self.batch_seeds = self.rng.seed_seq.spawn(len(self))
+        self.served = False #True once keras requested a batch of these events
+
+    def set_padding_mode(self,padding_mode):
+        """
+        Change the padding mode for upcoming batches. Images in RAM were
+        cropped using the previous padding mode, therefore data is read from
+        .rtdc from now on
+        """
+        padding_mode = aid_img.pad_arguments_np2cv(padding_mode)
+        if padding_mode==self.padding_mode:
+            return
+        self.padding_mode = padding_mode
+        if len(self.ram)>0:
+            self.ram = dict()
+            self.close()
+            self.open_files()
+
+    def __len__(self):
+        return int(np.ceil(len(self.event_ind)/float(self.batch_size)))
+
+    def load_batch(self,file_ind,event_ind,rng=None):
+        """
+        Get the cropped (not yet augmented) images of the given events
+        rng: aid_img.RngContext or None; used for padding_mode "alternate"
+        """
+        images = None
+        xtra_data = []
+        for i in np.unique(file_ind):
+            sel = np.where(file_ind==i)[0]
+            #load each event only once, even if it is required several times
+            ind_unique,ind_inverse = np.unique(event_ind[sel],return_inverse=True)
+            rtdc_path = self.rtdc_paths[i]
+            if rtdc_path in self.ram:
+                images_ = np.take(self.ram[rtdc_path]["images"],ind_unique,axis=0)
+                if self.xtra_in:
+                    xtra_ = np.take(self.ram[rtdc_path]["xtra_in"],ind_unique,axis=0)
+            else:
+                images_ = aid_img.crop_events(self.rtdc_ds[i]["events"]["image"],ind_unique,
+                                              self.pos_x[i][ind_unique],self.pos_y[i][ind_unique],
+                                              self.cropsize,self.zoom_factors[i],self.zoom_order,
+                                              self.channels,self.padding_mode,self.roi_read,rng=rng)
+                images_ = aid_img.check_squared(images_)
+                if self.xtra_in:
+                    xtra_ = self.xtra_data[i][ind_unique]
+            if images is None:
+                images = np.zeros((len(event_ind),)+images_.shape[1:],dtype=np.uint8)
+                if self.xtra_in:
+                    xtra_data = np.zeros((len(event_ind),)+xtra_.shape[1:],dtype=xtra_.dtype)
+            images[sel] = images_[ind_inverse]
+            if self.xtra_in:
+                xtra_data[sel] = xtra_[ind_inverse]
+        return images,xtra_data
+
+    def __getitem__(self,idx):
+        file_ind = self.file_ind[idx*self.batch_size:(idx+1)*self.batch_size]
+        event_ind = self.event_ind[idx*self.batch_size:(idx+1)*self.batch_size]
+        rng = aid_img.RngContext(seed_seq=self.batch_seeds[idx])
+        self.served = True
+        X_batch,xtra_batch = self.load_batch(file_ind,event_ind,rng)
+        if len(X_batch.shape)==3:
+            #Add the "channels" dimension
+            X_batch = np.expand_dims(X_batch,3)
+
+        if self.tf_augmenter is not None:
+            X_batch = self.tf_augmenter.augment(X_batch,rng=rng)
+        else:
+            X_batch = aid_img.affine_augm_paras(X_batch,self.affine_paras,rng=rng) #Affine image augmentation
+        #Now do the final cropping to the actual size that was set by user
+        if X_batch.shape[2]!=self.crop:
+            remove = int(X_batch.shape[2]/2.0 - self.crop/2.0)
+            X_batch = X_batch[:,remove:remove+self.crop,remove:remove+self.crop,:]
+
+        if self.tf_augmenter is None:
+            X_batch = aid_img.photometric_augm(X_batch,self.photometric_paras,rng=rng)
+        X_batch = aid_img.image_normalization(X_batch,self.norm,self.mean_trainingdata,self.std_trainingdata,rng=rng)
+        Y_batch = tf.keras.utils.to_categorical(self.classes[file_ind],self.nr_classes)
+        if self.xtra_in:
+            return [X_batch,xtra_batch],Y_batch
+        return X_batch,Y_batch
+
+    def on_epoch_end(self):
+        self.sample_epoch()
+
+    def next_epoch(self):
+        """
+        Draw new events unless the current ones were not used yet. Keras calls
+        on_epoch_end from its enqueuer thread, which does not happen if .fit()
+        is stopped (stop_training) before the enqueuer reached the end of the
+        epoch. Call this before restarting .fit()
+        """
+        if self.served:
+            self.sample_epoch()
+
+    def close(self):
+        for rtdc_ds in self.rtdc_ds:
+            if rtdc_ds is not None:
+                aid_bin.release_rtdc(rtdc_ds)
+        self.rtdc_ds = []
+
+
+class SharedEpoch(tf.keras.utils.Sequence):
+    """
+    The current epoch of an EpochSequence for one model of a collection. All
+    models are fitted on the same events with the same augmentation: keras
+    calls on_epoch_end after the .fit() of each model, which does nothing
+    here. The next epoch is drawn by calling sample_epoch() of the
+    EpochSequence once all models of the collection were fitted.
+
+    seq: EpochSequence
+    """
+    def __init__(self,seq):
+        super().__init__()
+        self.seq = seq
+
+    def __len__(self):
+        return len(self.seq)
+
+    def __getitem__(self,idx):
+        return self.seq[idx]
+
+    def on_epoch_end(self):
+        pass
+
+
+class EpochFeeder():
+    """
+    Serves training data that is prepared for an entire epoch at once
+    (loaded, augmented and normalized by the fitting routine) as an endless
+    tf.data.Dataset of batches. This allows a single call of .fit() to run
+    over many epochs: each epoch requires one call of get_epoch, the batches
+    are then sliced by tf.data without python overhead per batch or per epoch.
+    Use .fit(feeder.dataset(),steps_per_epoch=len(feeder)). In graph mode
+    (inside the tf.compat.v1.Session of the fitting routine), the graph of the
+    dataset is built once; it does not grow with the nr. of epochs.
+
+    get_epoch: callable returning (X,Y,xtra) of the next epoch, e.g.
+    EpochPrefetcher.get. All epochs need to contain the same nr. of events
+    batch_size: int
+    xtra_in: bool; if True, batches are ((X,xtra),Y)
+    rng: aid_img.RngContext or None (default random numbers); order of the
+    events within each epoch
+    """
+    def __init__(self,get_epoch,batch_size=32,xtra_in=False,rng=None):
+        self.get_epoch = get_epoch
+        self.batch_size = int(batch_size)
+        self.xtra_in = xtra_in
+        self.rng = aid_img.get_rng(rng)
+        #the first epoch is requested right away to get the nr. of batches and the dtypes
+        self.first_epoch = get_epoch()
+        X,Y,xtra = self.first_epoch
+        self.nr_events = len(Y)
+        def spec(a):
+            return tf.TensorSpec(shape=(None,)+a.shape[1:],dtype=a.dtype)
+        x_spec = (spec(X),spec(xtra)) if xtra_in else spec(X)
+        self.signature = (x_spec,spec(Y),tf.TensorSpec(shape=(None,),dtype=tf.int64))
+
+    def __len__(self):
+        return int(np.ceil(self.nr_events/float(self.batch_size)))
+
+    def epochs(self):
+        #Generator over epochs; each new iterator of the dataset continues with the next epoch
+        while True:
+            if self.first_epoch is not None:
+                X,Y,xtra = self.first_epoch
+                self.first_epoch = None
+            else:
+                X,Y,xtra = self.get_epoch()
+            order = self.rng.permutation(len(Y))
+            if self.xtra_in:
+                yield (X,xtra),Y,order
+            else:
+                yield X,Y,order
+
+    def batches(self,x,y,order):
+        ind = tf.data.Dataset.from_tensor_slices(order).batch(self.batch_size)
+        return ind.map(lambda i: (tf.nest.map_structure(lambda a: tf.gather(a,i),x),tf.gather(y,i)))
+
+    def dataset(self):
+        return tf.data.Dataset.from_generator(self.epochs,output_signature=self.signature).flat_map(self.batches)
+
+
+class ValidationSchedule():
+    """
+    Validation during training, using model.evaluate instead of passing the
+    validation data to .fit() in each epoch. The arrays are fed batch-wise
+    (in graph mode, as in the fitting routine, through the input
+    placeholders of the model), such that the validation data does not
+    become a constant of the graph.
+    Validation runs every `every` epochs. If subsample>0, a fixed stratified
+    subsample of the validation data is used and the full validation data
+    only every `full_every` epochs. Epoch 0 is always validated using the
+    full validation data.
+
+    X_valid: array or list of arrays ([X_valid,xtra_valid])
+    Y_valid: one-hot encoded labels
+    batch_size: int
+    every: int; validate every nr. of epochs
+    subsample: float; fraction of the validation events of each class that
+    is used (0: always use the full validation data)
+    full_every: int; validate using the full validation data every nr. of epochs
+    rng: aid_img.RngContext or None (default random numbers); used to draw the subsample
+    """
+    def __init__(self,X_valid,Y_valid,batch_size=32,every=1,subsample=0.0,full_every=10,rng=None):
+        self.batch_size = int(batch_size)
+        self.every = max(1,int(every))
+        self.full_every = max(1,int(full_every))
+        self.metrics_names = None
+        self.full = (X_valid,Y_valid)
+        self.subsample = None
+        if 0<subsample<1:
+            rng = aid_img.get_rng(rng)
+            y_valid = np.argmax(Y_valid,axis=1)
+            ind = []
+            for c in np.unique(y_valid):
+                ind_c = np.where(y_valid==c)[0]
+                nr_events = max(1,int(round(subsample*len(ind_c))))
+                ind.append(rng.choice(ind_c,size=nr_events,replace=False))
+            ind = np.sort(np.concatenate(ind))
+            if type(X_valid)==list:
+                X_sub = [np.take(x,ind,axis=0) for x in X_valid]
+            else:
+                X_sub = np.take(X_valid,ind,axis=0)
+            self.subsample = (X_sub,np.take(Y_valid,ind,axis=0))
+
+    def which(self,epoch):
+        """
+        Validation data to be used in the given epoch: "full", "subsample"
+        or None (no validation)
+        """
+        if self.subsample is None:
+            return "full" if epoch%self.every==0 else None
+        if epoch%self.full_every==0:
+            return "full"
+        return "subsample" if epoch%self.every==0 else None
+
+    def evaluate(self,model,epoch):
+        """
+        Validate the model if scheduled for this epoch.
+        Returns the metrics (keys with prefix "val_"; NaN if there was no
+        validation in this epoch) and the validation data used (see which)
+        """
+        which = self.which(epoch)
+        if which is None and self.metrics_names is not None:
+            return {"val_"+key:np.nan for key in self.metrics_names},None
+        X,Y = self.subsample if which=="subsample" else self.full
+        values = model.evaluate(X,Y,batch_size=self.batch_size,verbose=0)
+        if not isinstance(values,list):#only the loss
+            values = [values]
+        self.metrics_names = list(model.metrics_names)
+        return {"val_"+key:value for key,value in zip(self.metrics_names,values)},which or "full"
+
+
+class TFAugmenter():
+    """
+    Graph-mode (tf.function) backend for image augmentation, alternative to
+    the OpenCV loops of aid_img. The whole batch is augmented by a compiled
+    TensorFlow graph on the CPU, without Python code per image:
+    - affine: flipping, zooming, rotation, shift and shear are composed into
+    one matrix per image (as in aid_img.affine_augm_crop) and applied by a
+    single projective transform, directly to the final crop size
+    - photometric: contrast, average and Gaussian blur (separable depthwise
+    convolutions; each image has its own kernel), brightness and noise
+    The parameters have the same meaning as for aid_img.affine_augm_paras and
+    aid_img.photometric_augm and the results are statistically equivalent;
+    saturation/hue and motion blur are not supported (see supports).
+
+    affine_paras: dict (v_flip,h_flip,rotation,width_shift,height_shift,zoom,shear)
+    photometric_paras: dict; see aid_img.photometric_augm
+    crop: int; final size of the images (None: same size as the input)
+    """
+    def __init__(self,affine_paras,photometric_paras,crop=None):
+        self.affine_paras = dict(affine_paras)
+        self.photometric_paras = dict(photometric_paras)
+        self.crop = crop
+        signature = [tf.TensorSpec([None,None,None,None],tf.uint8),tf.TensorSpec([2],tf.int64)]
+        self.affine_fn = tf.function(self.affine_graph,input_signature=signature)
+        self.photometric_fn = tf.function(self.photometric_graph,input_signature=signature)
+        self.graph_ops = dict() #graph mode: (fn,graph) -> (images placeholder,seed placeholder,output)
+
+    @staticmethod
+    def supports(photometric_paras):
+        p = photometric_paras
+        return not (p["saturation_on"] or p["hue_on"] or p["motionBlur_on"])
+
+    def run(self,fn,images,rng):
+        images = np.asarray(images,dtype=np.uint8)
+        if len(images.shape)==3:
+            images = np.expand_dims(images,3)
+        seed = aid_img.get_rng(rng).integers(0,2**31-1,size=2)
+        if tf.executing_eagerly():
+            with tf.device("/CPU:0"):
+                return fn(images,tf.constant(seed,dtype=tf.int64)).numpy()
+        #Graph mode (fitting routine, inside a tf.compat.v1.Session): fn is added
+        #to the graph once (placeholders) and evaluated by the default session
+        graph = tf.compat.v1.get_default_graph()
+        if (fn,graph) not in self.graph_ops:
+            with tf.device("/CPU:0"):
+                images_in = tf.compat.v1.placeholder(tf.uint8,[None,None,None,None])
+                seed_in = tf.compat.v1.placeholder(tf.int64,[2])
+                self.graph_ops[(fn,graph)] = (images_in,seed_in,fn(images_in,seed_in))
+        images_in,seed_in,images_out = self.graph_ops[(fn,graph)]
+        return tf.compat.v1.get_default_session().run(images_out,feed_dict={images_in:images,seed_in:seed})
+
+    def affine(self,images,rng=None):
+        """
+        Affine augmentation and cropping to crop x crop pixels (uint8)
+        rng: aid_img.RngContext or None; the seed of the graph is drawn from rng
+        """
+        return self.run(self.affine_fn,images,rng)
+
+    def photometric(self,images,rng=None):
+        """
+        Contrast, blurring, brightness and noise augmentation (uint8)
+        rng: aid_img.RngContext or None; the seed of the graph is drawn from rng
+        """
+        return self.run(self.photometric_fn,images,rng)
+
+    def augment(self,images,rng=None):
+        rng = aid_img.get_rng(rng)
+        return self.photometric(self.affine(images,rng),rng)
+
+    def affine_graph(self,images,seed):
+        p = self.affine_paras
+        seeds = tf.random.experimental.stateless_split(seed,num=7)
+        shape = tf.shape(images)
+        n = shape[0]
+        rows,cols = tf.cast(shape[1],tf.float32),tf.cast(shape[2],tf.float32)
+        if self.crop is None:
+            final_h,final_w = shape[1],shape[2]
+        else:
+            final_h,final_w = self.crop,self.crop
+
+        def uniform(i,low,high):
+            return tf.random.stateless_uniform([n],seeds[i],minval=low,maxval=high)
+
+        rot,width_shift,height_shift,shear = abs(p["rotation"]),abs(p["width_shift"]),abs(p["height_shift"]),abs(p["shear"])
+        height_shift = height_shift*rows if height_shift<1 else tf.constant(float(height_shift))
+        width_shift = width_shift*cols if width_shift<1 else tf.constant(float(width_shift))
+        zero,one = tf.zeros([n]),tf.ones([n])
+        fx,fy = one,one
+        if p["zoom"]!=0:
+            zoom = abs(p["zoom"])
+            low,high = (1-zoom,1+zoom) if zoom<1 else (1.0/zoom,zoom)
+            fx,fy = uniform(0,low,high),uniform(1,low,high)
+        deg = uniform(2,-rot,rot) if rot!=0 else zero
+        height_shift_rnd = uniform(3,-height_shift,height_shift) if p["height_shift"]!=0 else zero
+        width_shift_rnd = uniform(4,-width_shift,width_shift) if p["width_shift"]!=0 else zero
+        shear_rnd = uniform(5,-np.deg2rad(shear),np.deg2rad(shear)) if shear!=0 else zero
+
+        #flipping, same probabilities as aid_img.flip_code_rnd
+        if p["v_flip"] and p["h_flip"]:
+            code = tf.random.stateless_uniform([n],seeds[6],minval=-1,maxval=2,dtype=tf.int32)
+            #tf.equal: in graph mode, == compares the tensor objects
+            flip_y,flip_x = tf.equal(code,0)|tf.equal(code,-1),tf.equal(code,1)|tf.equal(code,-1)
+        else:
+            flip = tf.random.stateless_uniform([n],seeds[6],minval=0,maxval=2,dtype=tf.int32)>0
+            flip_y = flip if p["v_flip"] else tf.zeros([n],tf.bool)
+            flip_x = flip if p["h_flip"] else tf.zeros([n],tf.bool)
+        sx,tx = tf.where(flip_x,-one,one),tf.where(flip_x,cols-1,zero)
+        sy,ty = tf.where(flip_y,-one,one),tf.where(flip_y,rows-1,zero)
+
+        def zoom_offset(length,f):
+            #see aid_img.zoom_offset
+            length_zoom = tf.round(length*f)
+            diff = length_zoom-length
+            crop = -(tf.floor(length_zoom/2)-tf.floor(length/2))
+            pad = tf.floor(tf.abs(diff)/2)
+            return tf.where(diff>0,crop,tf.where(diff<0,pad,zero))
+
+        #flip and zoom: x -> fx*(sx*x+tx)+0.5*fx-0.5+offset
+        zx = fx*sx
+        zx_0 = fx*tx+0.5*fx-0.5+zoom_offset(cols,fx)
+        zy = fy*sy
+        zy_0 = fy*ty+0.5*fy-0.5+zoom_offset(rows,fy)
+        #rotation, shear and shift around the center (see aid_img.affine_augm)
+        alpha,beta = tf.cos(deg*np.pi/180),tf.sin(deg*np.pi/180)
+        a00,a01 = alpha,beta+shear_rnd
+        a10,a11 = -beta+shear_rnd,alpha
+        a02 = (1-alpha)*cols/2-beta*rows/2+width_shift_rnd-shear_rnd*cols/2-tf.floor(cols/2-final_w/2)
+        a12 = beta*cols/2+(1-alpha)*rows/2+height_shift_rnd-shear_rnd*rows/2-tf.floor(rows/2-final_h/2)
+        M = tf.stack([tf.stack([a00*zx,a01*zy,a00*zx_0+a01*zy_0+a02],axis=1),
+                      tf.stack([a10*zx,a11*zy,a10*zx_0+a11*zy_0+a12],axis=1),
+                      tf.stack([zero,zero,one],axis=1)],axis=1)
+        #the projective transform maps output to input coordinates
+        M_inv = tf.linalg.inv(M)
+        transforms = tf.concat([tf.reshape(M_inv[:,:2,:],[n,6]),tf.zeros([n,2])],axis=1)
+        images = tf.raw_ops.ImageProjectiveTransformV3(images=tf.cast(images,tf.float32),transforms=transforms,
+                                                      output_shape=tf.stack([final_h,final_w]),fill_value=0.0,
+                                                      interpolation="BILINEAR",fill_mode="CONSTANT")
+        return tf.cast(tf.clip_by_value(tf.round(images),0,255),tf.uint8)
+
+    def photometric_graph(self,images,seed):
+        p = self.photometric_paras
+        seeds = tf.random.experimental.stateless_split(seed,num=6)
+        n = tf.shape(images)[0]
+        images = tf.cast(images,tf.float32)
+
+        def to_uint8_range(x):
+            return tf.clip_by_value(tf.round(x),0,255)
+
+        def kernel_sizes(i,k1,k2):
+            #random kernel size for each image, as in aid_img.avg_blur_cv2
+            if k1==k2:
+                return tf.fill([n],int(k2))
+            return tf.random.stateless_uniform([n],seeds[i],minval=int(min(k1,k2)),maxval=int(max(k1,k2)),dtype=tf.int32)
+
+        if p["contrast_on"]:
+            c = tf.random.stateless_uniform([n,1,1,1],seeds[0],minval=p["contrast_lower"],maxval=p["contrast_higher"])
+            images = to_uint8_range(c*images+128-c*128)
+        if p["avgBlur_on"]:
+            k = tf.maximum(kernel_sizes(1,p["avgBlur_min"],p["avgBlur_max"]),1) #kernel size 0: no blurring
+            size = int(max(p["avgBlur_min"],p["avgBlur_max"],1))//2*2+1
+            j = tf.range(size)[None,:]-(size//2-k[:,None]//2) #position within the box (anchor at k//2, like cv2.blur)
+            kernels = tf.where((j>=0)&(j<k[:,None]),1.0/tf.cast(k[:,None],tf.float32),0.0)
+            images = to_uint8_range(self.separable_filter(images,kernels))
+        if p["gaussBlur_on"]:
+            k = kernel_sizes(2,p["gaussBlur_min"],p["gaussBlur_max"])
+            k = 2*(k//2)+1 #make k odd
+            size = int(max(p["gaussBlur_min"],p["gaussBlur_max"]))//2*2+1
+            kernels = tf.gather(tf.constant(self.gauss_kernels(size)),k//2)
+            images = to_uint8_range(self.separable_filter(images,kernels))
+
+        m = tf.random.stateless_uniform([n,1,1,1],seeds[3],minval=p["brightness_mult_lower"],maxval=p["brightness_mult_upper"])
+        add = tf.random.stateless_uniform([n,1,1,1],seeds[4],minval=p["brightness_add_lower"],maxval=p["brightness_add_upper"])
+        noise = tf.random.stateless_normal(tf.shape(images),seeds[5],mean=p["gaussnoise_mean"],stddev=p["gaussnoise_scale"])
+        noise = tf.cast(tf.cast(noise,tf.int32),tf.float32) #noise is int16 in aid_img.brightn_noise_augm_cv2
+        images = to_uint8_range(m*images+add+noise)
+        return tf.cast(images,tf.uint8)
+
+    @staticmethod
+    def gauss_kernels(size):
+        """
+        1D kernels of cv2.GaussianBlur (sigma=0) for all odd kernel sizes up
+        to size, centered in an array of length size
+        Returns float32 array of shape (size//2+1,size); row i: kernel size 2*i+1
+        """
+        kernels = np.zeros((size//2+1,size),dtype=np.float32)
+        for i in range(size//2+1):
+            kernels[i,size//2-i:size//2+i+1] = cv2.getGaussianKernel(2*i+1,0).ravel()
+        return kernels
+
+    @staticmethod
+    def separable_filter(images,kernels):
+        """
+        Filter each image with its own separable kernel (rows and columns).
+        The batch is moved into the channels, such that one depthwise
+        convolution filters all images. Border: reflect101 (default of cv2).
+        images: float tensor of shape (N,H,W,C)
+        kernels: float tensor of shape (N,size); size has to be odd
+        """
+        shape = tf.shape(images)
+        n,h,w,c = shape[0],shape[1],shape[2],shape[3]
+        pad = kernels.shape[1]//2
+        x = tf.reshape(tf.transpose(images,[1,2,0,3]),[1,h,w,n*c])
+        kernels = tf.transpose(tf.repeat(kernels,c,axis=0)) #(size,N*C)
+        x = tf.pad(x,[[0,0],[0,0],[pad,pad],[0,0]],mode="REFLECT")
+        x = tf.nn.depthwise_conv2d(x,kernels[None,:,:,None],strides=[1,1,1,1],padding="VALID")
+        x = tf.pad(x,[[0,0],[pad,pad],[0,0],[0,0]],mode="REFLECT")
+        x = tf.nn.depthwise_conv2d(x,kernels[:,None,:,None],strides=[1,1,1,1],padding="VALID")
+        return tf.transpose(tf.reshape(x,[h,w,n,c]),[2,0,1,3])
+
+class EpochPrefetcher():
+    """
+    Producer/consumer prefetching of training data: while the model is fitted,
+    the data for the following epoch(s) is prepared on a background thread.
+
+    produce_fn: callable returning an iterable of items (e.g. (X_batch,Y_batch,xtra_train)),
+    one item per call of .fit(). produce_fn is called again when exhausted.
+    depth: int; maximum nr. of prepared items waiting in the queue
+    """
+    def __init__(self,produce_fn,depth=1):
+        self.produce_fn = produce_fn
+        self.queue = queue.Queue(maxsize=max(1,int(depth)))
+        self.version = 0 #incremented by reset(); items of older versions are discarded
+        self.stop_event = threading.Event()
+        self.error = None
+        self.prefetch_time = 0.0 #time it took to prepare the last item returned by get()
+        self.idle_time = 0.0 #time get() had to wait for the last item
+        self.thread = threading.Thread(target=self.run,daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while not self.stop_event.is_set():
+            version = self.version
+            try:
+                t1 = time.time()
+                for item in self.produce_fn():
+                    if not self.put((version,item,time.time()-t1)):
+                        return
+                    if version!=self.version:
+                        break #parameters were changed; start over
+                    t1 = time.time()
+            except Exception as e:
+                print("Error during prefetching of training data: "+str(e))
+                self.error = e
+                return
+
+    def put(self,entry):
+        #wait for space in the queue, unless the prefetcher is stopped
+        while not self.stop_event.is_set():
+            try:
+                self.queue.put(entry,timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def get(self):
+        """
+        Return the next prepared item (only items prepared after the last reset())
+        """
+        t1 = time.time()
+        while True:
+            try:
+                version,item,prefetch_time = self.queue.get(timeout=0.1)
+            except queue.Empty:
+                if self.error is not None:
+                    raise self.error
+                continue
+            if version==self.version:
+                self.prefetch_time = prefetch_time
+                self.idle_time = time.time()-t1
+                return item
+
+    def reset(self):
+        """
+        Discard prepared items, e.g. after parameters were changed
+        ("Apply at next epoch")
+        """
+        self.version += 1
+        while True:
+            try:
+                self.queue.get_nowait()
+            except queue.Empty:
+                break
+
+    def stop(self):
+        self.stop_event.set()
+        self.reset()
+        self.thread.join()
+
+
+class CheckpointWriter():
+    """
+    Saves models on a background thread, so that fitting does not have to
+    wait until a model is serialized and written to disk.
+    save() only takes a snapshot of the weights (in memory). On the writer
+    thread, the weights are put into a copy of the model (clone_model), which
+    is saved to a temporary file, flushed to disk (fsync) and then renamed.
+    If a newer snapshot arrives while an older one is still waiting, the
+    older one is dropped (coalesce=True). Saved files contain the
+    architecture and the weights (no optimizer state).
+
+    model: keras model; its architecture is cloned once
+    save_format: argument for model.save ('h5' or None)
+    sess: tf.compat.v1.Session of the model (graph mode, as in the fitting
+    routine). The writer thread does not inherit the session and the graph of
+    the calling thread; they are entered explicitly. Default: the default
+    session of the calling thread (None in eager mode)
+    Adding operations to the graph is not thread-safe: the assign operations
+    of the copy are created in __init__ (calling thread) and saving, which may
+    add operations (SavedModel), holds graph_lock. Hence several writers (e.g.
+    one per model of a collection) save one at a time.
+    """
+    def __init__(self,model,save_format='h5',sess=None):
+        self.sess = sess if sess is not None else tf.compat.v1.get_default_session()
+        self.model = tf.keras.models.clone_model(model)
+        self.model.set_weights(model.get_weights()) #creates the assign operations on the calling thread
+        self.save_format = save_format
+        self.condition = threading.Condition()
+        self.pending = [] #(path,weights,coalesce)
+        self.messages = [] #reports for the user; see pop_messages()
+        self.stop_requested = False
+        self.thread = threading.Thread(target=self.run,daemon=True)
+        self.thread.start()
+
+    def save(self,model,path,coalesce=True):
+        """
+        Take a snapshot of the weights of model, which is saved to path
+        coalesce: if True, this snapshot replaces waiting snapshots that
+        were submitted with coalesce=True
+        """
+        weights = model.get_weights()
+        with self.condition:
+            if coalesce:
+                for path_,weights_,coalesce_ in self.pending:
+                    if coalesce_:
+                        self.messages.append("Skipped saving "+path_+" (newer model available)")
+                self.pending = [p for p in self.pending if not p[2]]
+            self.pending.append((path,weights,coalesce))
+            self.condition.notify()
+
+    def run(self):
+        if self.sess is None:
+            self.write_pending()
+        else:
+            with self.sess.graph.as_default(),self.sess.as_default():
+                self.write_pending()
+
+    def write_pending(self):
+        while True:
+            with self.condition:
+                while len(self.pending)==0 and not self.stop_requested:
+                    self.condition.wait()
+                if len(self.pending)==0:
+                    return
+                path,weights,coalesce = self.pending.pop(0)
+            try:
+                with graph_lock:
+                    self.write(path,weights)
+                text = "Saved model: "+path
+            except Exception as e:
+                text = "Saving model failed: "+path+"\n"+str(e)
+            print(text)
+            with self.condition:
+                self.messages.append(text)
+
+    def write(self,path,weights):
+        self.model.set_weights(weights)
+        path_temp = path+".tmp"
+        self.model.save(path_temp,save_format=self.save_format,include_optimizer=False)
+        #make sure the data is on the disk before the file appears under its final name
+        if os.path.isdir(path_temp):
+            for root,dirs,files in os.walk(path_temp):
+                for fname in files:
+                    aid_bin.fsync_file(os.path.join(root,fname))
+        else:
+            aid_bin.fsync_file(path_temp)
+        os.replace(path_temp,path)
+
+    def pop_messages(self):
+        """
+        Return (and forget) the reports of finished saves
+        """
+        with self.condition:
+            messages,self.messages = self.messages,[]
+        return messages
+
+    def close(self):
+        """
+        Write all waiting snapshots and stop the writer thread
+        """
+        with self.condition:
+            self.stop_requested = True
+            self.condition.notify()
+        self.thread.join()
+
+
+class CollectionFitter():
+    """
+    Fits the models of a collection at the same time: each model runs its own
+    .fit() on a thread of a pool, all using the same (augmented) training data
+    of the epoch, which is shared in memory (not copied). TensorFlow releases
+    the GIL during the computations, so the Python overhead of one model
+    (per batch) overlaps with the computations of the others, and small
+    models, which cannot use all cores, share the CPU.
+    Models must not share state that changes during fitting (e.g. callbacks).
+    The threads of the pool do not inherit the session and the graph of the
+    calling thread; they are entered explicitly. All models use the thread
+    pools of the session (see get_config), hence fitting several models at
+    the same time does not increase the nr. of threads TensorFlow uses.
+    Adding operations to the graph is not thread-safe. The first .fit() of a
+    model adds its train function (and the first .evaluate() its test
+    function) to the graph, hence the first call of map() runs the models
+    one after another, holding graph_lock. Later calls run in parallel,
+    unless sequential=True (e.g. after recompiling or after changing
+    settings that make .fit() add operations, such as class_weight).
+
+    nr_models: int; nr. of models in the collection
+    threads: int; nr. of models that are fitted at the same time. 0: one per
+    CPU core, but at least 2 (to overlap the Python overhead); 1: one after another
+    sess: tf.compat.v1.Session of the models (graph mode, as in the fitting
+    routine). Default: the default session of the calling thread (None in eager mode)
+    """
+    def __init__(self,nr_models,threads=0,sess=None):
+        self.nr_models = int(nr_models)
+        threads = int(threads)
+        if threads<=0:
+            threads = max(2,os.cpu_count() or 1)
+        self.threads = max(1,min(threads,self.nr_models))
+        self.sess = sess if sess is not None else tf.compat.v1.get_default_session()
+        self.built = False #True after the models were fitted once (their functions are in the graph)
+        self.pool = None
+        if self.threads>1:
+            self.pool = ThreadPoolExecutor(max_workers=self.threads,thread_name_prefix="CollectionFitter")
+
+    def map(self,fit_fn,sequential=False):
+        """
+        Call fit_fn(i) for each model index i (in parallel).
+        Returns the results in the order of the models. An exception of any
+        fit_fn is raised after all running calls finished
+        sequential: bool; if True, the models are fitted one after another
+        on the calling thread (see above)
+        """
+        if self.pool is None or sequential or not self.built:
+            with graph_lock:#operations may be added to the graph
+                results = [fit_fn(i) for i in range(self.nr_models)]
+            self.built = True
+            return results
+        futures = [self.pool.submit(self.fit_model,fit_fn,i) for i in range(self.nr_models)]
+        wait(futures)
+        return [future.result() for future in futures]
+
+    def fit_model(self,fit_fn,i):
+        #Runs on a thread of the pool
+        if self.sess is None:
+            return fit_fn(i)
+        with self.sess.graph.as_default(),self.sess.as_default():
+            return fit_fn(i)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=True)
+
+
 def get_config(cpu_nr,gpu_nr,deviceSelected,gpu_memory):
     #No GPU available, CPU selected:
     if gpu_nr==0: #and deviceSelected=="Default CPU":
@@ -4,12 +4,45 @@ Created on Tue Feb 22 16:19:48 2022
 
 @author: nana
 """
+import multiprocessing
+import os
+from multiprocessing import resource_tracker, shared_memory
+
 import cv2
 import numpy as np
 import pandas as pd
+from numpy.lib.stride_tricks import sliding_window_view
 from PyQt5 import QtWidgets
 
-rand_state = np.random.RandomState(117)
+class RngContext(np.random.Generator):
+    """
+    Random numbers for sampling and augmentation (np.random.Generator).
+    All functions of aid_img that draw random numbers accept an RngContext
+    as argument rng. Parallel workers (threads or processes) get independent
+    streams using spawn(), so that a run can be reproduced from a single seed
+    (saved in the meta file of the model).
+    seed: int; None: draw a random seed (stored in .seed)
+    seed_seq: np.random.SeedSequence; used instead of seed (see spawn)
+    """
+    def __init__(self,seed=None,seed_seq=None):
+        if seed_seq is None:
+            if seed is None:
+                seed = int(np.random.SeedSequence().generate_state(1)[0])
+            seed_seq = np.random.SeedSequence(int(seed))
+        super().__init__(np.random.PCG64(seed_seq))
+        self.seed_seq = seed_seq
+        self.seed = seed_seq.entropy
+
+    def spawn(self,n):
+        #n independent child streams
+        return [RngContext(seed_seq=seed_seq) for seed_seq in self.seed_seq.spawn(n)]
+
+rng_context = RngContext(117) #used by all functions if no rng is given
+
+def get_rng(rng=None):
+    if rng is None:
+        return rng_context
+    return rng
 
 from . import aid_bin
 
@@ -185,7 +218,7 @@ def pad_arguments_np2cv(padding_mode):
     if padding_mode=="wrap":
         return "cv2.BORDER_WRAP"
 
-def image_crop_pad_cv2(images,pos_x,pos_y,pix,final_h,final_w,padding_mode="cv2.BORDER_CONSTANT"):
+def image_crop_pad_cv2(images,pos_x,pos_y,pix,final_h,final_w,padding_mode="cv2.BORDER_CONSTANT",rng=None):
     """
     Function takes a list images (list of numpy arrays) an resizes them to
     equal size by center cropping and/or padding.
@@ -228,6 +261,7 @@ def image_crop_pad_cv2(images,pos_x,pos_y,pix,final_h,final_w,padding_mode="cv2.
     (final_h,final_w,channels)
 
     """
+    rng = get_rng(rng)
     #Convert position of cell from "um" to "pixel index"
     #pos_x,pos_y = pos_x/pix,pos_y/pix
     padding_modes = ["cv2.BORDER_CONSTANT","cv2.BORDER_REFLECT","cv2.BORDER_REFLECT_101","cv2.BORDER_REPLICATE","cv2.BORDER_WRAP"]
@@ -270,7 +304,7 @@ def image_crop_pad_cv2(images,pos_x,pos_y,pix,final_h,final_w,padding_mode="cv2.
             else:
                 #Perform all padding operations in one go
                 if padding_mode.lower()=="alternate":
-                    ind = rand_state.randint(low=0,high=len(padding_modes))
+                    ind = rng.integers(low=0,high=len(padding_modes))
                     padding_mode = padding_modes[ind]
                     temp = cv2.copyMakeBorder(temp, pad_top, pad_bottom, pad_left, pad_right, eval(padding_modes[ind]))
                 else:
@@ -280,6 +314,197 @@ def image_crop_pad_cv2(images,pos_x,pos_y,pix,final_h,final_w,padding_mode="cv2.
 
     return images
 
+def border_interpolate(p,length,border_type):
+    """
+    Vectorized version of cv2.borderInterpolate. Computes for each coordinate
+    p (which may lie outside of [0,length)) the coordinate of the donor pixel.
+
+    Parameters
+    ----------
+    p: ndarray of int; coordinates that should be mapped
+    length: ndarray of int (broadcastable to p); length of the axis
+    border_type: str; OpenCV BorderType (see image_crop_pad_cv2)
+
+    Returns
+    ----------
+    ndarray of int; mapped coordinates. For "cv2.BORDER_CONSTANT",
+    coordinates outside of [0,length) are returned as -1
+    """
+    length = np.maximum(length,1) #prevent div. by zero for empty windows
+    if border_type=="cv2.BORDER_CONSTANT":
+        return np.where((p>=0)&(p<length),p,-1)
+    elif border_type=="cv2.BORDER_REPLICATE":
+        return np.clip(p,0,length-1)
+    elif border_type=="cv2.BORDER_WRAP":
+        return np.mod(p,length)
+    elif border_type=="cv2.BORDER_REFLECT":#fedcba|abcdefgh|hgfedcb
+        p = np.mod(p,2*length)
+        return np.where(p<length,p,2*length-1-p)
+    elif border_type in ["cv2.BORDER_REFLECT_101","cv2.BORDER_DEFAULT"]:#gfedcb|abcdefgh|gfedcba
+        period = np.maximum(2*length-2,1)
+        p = np.mod(p,period)
+        return np.where(p<length,p,period-p)
+    else:
+        raise ValueError("Border type not supported: "+str(border_type))
+
+def image_crop_pad_batch(images,pos_x,pos_y,final_h,final_w,padding_mode="cv2.BORDER_CONSTANT",out=None,rng=None):
+    """
+    Batch version of image_crop_pad_cv2. Instead of looping over the images
+    and calling cv2.copyMakeBorder for each of them, an index map is computed
+    for all images at once and the cropped (and padded) images are gathered
+    from the input array in one go.
+
+    Parameters
+    ----------
+    images: ndarray of shape (N,H,W) or (N,H,W,C)
+    pos_x: ndarray of length N
+        The x coordinate(s) of the centroid of the event(s) [pixels]
+    pos_y: ndarray of length N
+        The y coordinate(s) of the centroid of the event(s) [pixels]
+    final_h: int
+        target image height [pixels]
+    final_w: int
+        target image width [pixels]
+    padding_mode: str; OpenCV BorderType, "delete" or "alternate".
+        See image_crop_pad_cv2. As in image_crop_pad_cv2, "alternate" draws
+        one border type per call, which is then used for all images that
+        need padding. "delete" returns all-zero images of shape
+        (final_h,final_w) for events that are too close to the border
+    out: ndarray of shape (N,final_h,final_w) or (N,final_h,final_w,C), optional
+        Preallocated output array (same dtype as images)
+
+    Returns
+    ----------
+    out: ndarray of shape (N,final_h,final_w) or (N,final_h,final_w,C)
+    """
+    rng = get_rng(rng)
+    images = np.ascontiguousarray(images)
+    padding_modes = ["cv2.BORDER_CONSTANT","cv2.BORDER_REFLECT","cv2.BORDER_REFLECT_101","cv2.BORDER_REPLICATE","cv2.BORDER_WRAP"]
+    final_h,final_w = int(final_h),int(final_w)
+    N,H,W = images.shape[:3]
+    channels = images.shape[3:]
+    if out is None:
+        out = np.empty((N,final_h,final_w)+channels,dtype=images.dtype)
+    if N==0:
+        return out
+
+    #Compute the edge-coordinates that define the cropped image (see image_crop_pad_cv2)
+    y1 = np.around(np.asarray(pos_y,dtype=float)-final_h/2.0).astype(np.int64)
+    x1 = np.around(np.asarray(pos_x,dtype=float)-final_w/2.0).astype(np.int64)
+    padded = (y1<0)|(x1<0)|(y1+final_h>H)|(x1+final_w>W)
+    inside,border = np.where(~padded)[0],np.where(padded)[0]
+
+    #Events that are far enough from the border: no padding needed, gather
+    #the windows from a strided view of the images
+    if len(inside)>0:
+        windows = sliding_window_view(images,(final_h,final_w),axis=(1,2))
+        windows = windows[inside,y1[inside],x1[inside]] #(n,final_h,final_w) or (n,C,final_h,final_w)
+        if len(channels)>0:
+            windows = np.moveaxis(windows,1,-1)
+        if len(inside)==N:
+            out[...] = windows
+        else:
+            out[inside] = windows
+
+    if len(border)==0:
+        return out
+    if padding_mode.lower()=="delete":
+        out[border] = 0
+        return out
+    if padding_mode.lower()=="alternate":#one draw per call, same as image_crop_pad_cv2
+        padding_mode = padding_modes[rng.integers(low=0,high=len(padding_modes))]
+
+    #Events at the border: compute for each output pixel the donor pixel
+    #(index map) and gather all pixels with a single np.take
+    y1,x1 = y1[border],x1[border]
+    y1_c,x1_c = np.maximum(y1,0),np.maximum(x1,0) #window after clipping to the image
+    y2_c,x2_c = np.minimum(y1+final_h,H),np.minimum(x1+final_w,W)
+    rows = np.arange(final_h)[np.newaxis,:] + (y1-y1_c)[:,np.newaxis]
+    cols = np.arange(final_w)[np.newaxis,:] + (x1-x1_c)[:,np.newaxis]
+    rows = border_interpolate(rows,(y2_c-y1_c)[:,np.newaxis],padding_mode)
+    cols = border_interpolate(cols,(x2_c-x1_c)[:,np.newaxis],padding_mode)
+    invalid_r,invalid_c = rows<0,cols<0 #only used for cv2.BORDER_CONSTANT
+    rows = (y1_c[:,np.newaxis]+np.maximum(rows,0))*W
+    cols = x1_c[:,np.newaxis]+np.maximum(cols,0)
+
+    #View all channels of a pixel as one item, such that np.take copies whole pixels
+    pixel = np.dtype((np.void,images.dtype.itemsize*int(np.prod(channels))))
+    pixels = images.reshape(N*H*W,-1).view(pixel).ravel()
+    chunk = 256 #keep the index arrays small
+    for s in range(0,len(border),chunk):
+        e = min(s+chunk,len(border))
+        flat = (border[s:e]*(H*W))[:,np.newaxis,np.newaxis] + rows[s:e,:,np.newaxis] + cols[s:e,np.newaxis,:]
+        crops = np.take(pixels,flat).view(images.dtype).reshape((e-s,final_h,final_w)+channels)
+        if padding_mode=="cv2.BORDER_CONSTANT":#set the padded rows and columns to zero
+            crops[invalid_r[s:e]] = 0
+            crops.swapaxes(1,2)[invalid_c[s:e]] = 0
+        out[border[s:e]] = crops
+    return out
+
+def read_crop_windows(dataset,indices,pos_x,pos_y,final_h,final_w,padding_mode="cv2.BORDER_CONSTANT",max_chunks=20,rng=None):
+    """
+    Read only the window around each event from an HDF5 image dataset
+    (instead of the full frames) and crop/pad the events to the final size.
+    Events are read chunk-wise (see aid_bin.read_events). For each block
+    of chunks, only the region that covers the windows of the requested
+    events of that block is read. Padding is applied afterwards, with the
+    same result as reading the full frames and using image_crop_pad_batch.
+
+    Parameters
+    ----------
+    dataset: h5py dataset (or ndarray) of shape (N,H,W) or (N,H,W,C)
+    indices: ndarray of int; indices of the events
+    pos_x: ndarray of length len(indices)
+        The x coordinate(s) of the centroid of the event(s) [pixels]
+    pos_y: ndarray of length len(indices)
+        The y coordinate(s) of the centroid of the event(s) [pixels]
+    final_h: int; target image height [pixels]
+    final_w: int; target image width [pixels]
+    padding_mode: str; OpenCV BorderType, "delete" or "alternate"
+    max_chunks: int; maximum number of chunks that are read at once
+
+    Returns
+    ----------
+    ndarray of shape (len(indices),final_h,final_w) or (len(indices),final_h,final_w,C)
+    """
+    rng = get_rng(rng)
+    indices = np.asarray(indices,dtype=np.int64)
+    if isinstance(dataset,np.ndarray):
+        return image_crop_pad_batch(dataset[indices],pos_x,pos_y,final_h,final_w,padding_mode=padding_mode,rng=rng)
+
+    padding_modes = ["cv2.BORDER_CONSTANT","cv2.BORDER_REFLECT","cv2.BORDER_REFLECT_101","cv2.BORDER_REPLICATE","cv2.BORDER_WRAP"]
+    final_h,final_w = int(final_h),int(final_w)
+    H,W = dataset.shape[1:3]
+    out = np.empty((len(indices),final_h,final_w)+dataset.shape[3:],dtype=dataset.dtype)
+    if len(indices)==0:
+        return out
+
+    #Window of each event in the full frame (see image_crop_pad_cv2)
+    y1 = np.around(np.asarray(pos_y,dtype=float)-final_h/2.0).astype(np.int64)
+    x1 = np.around(np.asarray(pos_x,dtype=float)-final_w/2.0).astype(np.int64)
+    y1_c,x1_c = np.clip(y1,0,H-1),np.clip(x1,0,W-1)
+    y2_c,x2_c = np.clip(y1+final_h,1,H),np.clip(x1+final_w,1,W)
+    padded = (y1<0)|(x1<0)|(y1+final_h>H)|(x1+final_w>W)
+    if padding_mode.lower()=="alternate" and np.any(padded):#one draw per batch, same as image_crop_pad_batch
+        padding_mode = padding_modes[rng.integers(low=0,high=len(padding_modes))]
+
+    order = np.argsort(indices,kind="stable")
+    indices_sorted = indices[order]
+    for start,stop,lo,hi in aid_bin.get_chunk_blocks(dataset,indices_sorted,max_chunks):
+        sel = order[lo:hi]
+        start,stop = indices_sorted[lo],indices_sorted[hi-1]+1 #no need to read events before/after
+        #Region that covers the (clipped) windows of all events in this block.
+        #Its edges are image edges wherever a window needs padding
+        r1,r2 = y1_c[sel].min(),y2_c[sel].max()
+        c1,c2 = x1_c[sel].min(),x2_c[sel].max()
+        region = dataset[start:stop,r1:r2,c1:c2]
+        region = region[indices_sorted[lo:hi]-start]
+        #positions relative to the region, such that np.around gives back y1-r1 and x1-c1
+        pos_y_region = (y1[sel]-r1)+final_h/2.0
+        pos_x_region = (x1[sel]-c1)+final_w/2.0
+        out[sel] = image_crop_pad_batch(region,pos_x_region,pos_y_region,final_h,final_w,padding_mode=padding_mode,rng=rng)
+    return out
+
 def check_squared(images):
     if images.shape[1]==images.shape[2]:
         return images #everything is fine
@@ -293,9 +518,36 @@ def check_squared(images):
         print("Final size after correcting: "+str(images.shape))
     return images
 
-def gen_crop_img(cropsize,rtdc_path,nr_events=100,replace=True,random_images=True,zoom_factor=1,zoom_order="cv2.INTER_LINEAR",color_mode='Grayscale',padding_mode='constant',xtra_in=False):
+def crop_events(images,indices,pos_x,pos_y,cropsize,zoom_factor=1,zoom_order="cv2.INTER_LINEAR",channels=1,padding_mode="cv2.BORDER_CONSTANT",roi_read=False,rng=None):
+    """
+    Load, zoom and crop a selection of events of an .rtdc file
+    images: h5py dataset or array. Images of all events ("events/image")
+    indices: array. Unique, sorted indices of the events to be returned
+    pos_x,pos_y: arrays. Position (pixels, already multiplied by zoom_factor) of the events in indices
+    cropsize: int. Final height and width of the images
+    padding_mode: str. cv2 border type (see pad_arguments_np2cv)
+    roi_read: bool. Only read the window around each event from disk (only possible if zoom_factor==1)
+    rng: RngContext or None (default random numbers); used for padding_mode "alternate"
+    """
+    roi_read = roi_read and zoom_factor==1
+    if roi_read:
+        images = read_crop_windows(images,indices,pos_x,pos_y,cropsize,cropsize,padding_mode=padding_mode,rng=rng)
+    else:
+        images = aid_bin.read_events(images,indices)
+    images = image_adjust_channels(images,target_channels=channels) #Adjust number of channels
+
+    if zoom_factor!=1.0:
+        zoom_interpol_method = zoom_arguments_scipy2cv(zoom_factor,zoom_order)
+        images = np.array([cv2.resize(image, dsize=None,fx=zoom_factor, fy=zoom_factor, interpolation=eval(zoom_interpol_method)) for image in images])
+
+    if not roi_read:
+        images = image_crop_pad_batch(images=images,pos_x=pos_x,pos_y=pos_y,final_h=cropsize,final_w=cropsize,padding_mode=padding_mode,rng=rng)
+    return images
+
+def gen_crop_img(cropsize,rtdc_path,nr_events=100,replace=True,random_images=True,zoom_factor=1,zoom_order="cv2.INTER_LINEAR",color_mode='Grayscale',padding_mode='constant',xtra_in=False,roi_read=False,rng=None):
+    rng = get_rng(rng)
 
-    failed,rtdc_ds = aid_bin.load_rtdc(rtdc_path)
+    failed,rtdc_ds = aid_bin.load_rtdc(rtdc_path,pin=True) #pinned: gen_crop_img can run in a background thread
     if failed:
         msg = QtWidgets.QMessageBox()
         msg.setIcon(QtWidgets.QMessageBox.Information)
@@ -316,6 +568,7 @@ def gen_crop_img(cropsize,rtdc_path,nr_events=100,replace=True,random_images=Tru
         msg.setWindowTitle("Empty dataset!")
         msg.setStandardButtons(QtWidgets.QMessageBox.Ok)
         msg.exec_()
+        aid_bin.release_rtdc(rtdc_ds)
         return
 
     if color_mode=='RGB': #User wants RGB images
@@ -323,15 +576,12 @@ def gen_crop_img(cropsize,rtdc_path,nr_events=100,replace=True,random_images=Tru
     if color_mode=='Grayscale': # User want to have Grayscale
         channels = 1
 
-    #Adjust number of channels
-    images = image_adjust_channels(images,target_channels=channels)
-
     pos_x,pos_y = rtdc_ds["events"]["pos_x"][:]/pix,rtdc_ds["events"]["pos_y"][:]/pix #/pix converts to pixel index
     #If there is a zooming to be applied, adjust pos_x and pos_y accordingly
     if zoom_factor != 1:
         pos_x,pos_y = zoom_factor*pos_x,zoom_factor*pos_y
 
-    index = list(range(len(pos_x))) #define an index to track, which cells are used from the file
+    index = np.arange(len(pos_x)) #define an index to track, which cells are used from the file
     ind = range(len(images))
 
     if xtra_in==True:
@@ -339,183 +589,236 @@ def gen_crop_img(cropsize,rtdc_path,nr_events=100,replace=True,random_images=Tru
     if xtra_in==False:
         xtra_data = []#in case xtra_in==None, this empty list will be returned
 
+    padding_mode = pad_arguments_np2cv(padding_mode)
+
     if random_images==True:
         print("I'm loading random images (from disk)")
         #select a random amount of those cells
-        random_ind = rand_state.choice(ind, size=nr_events, replace=replace) #get random indexes, either unique (replace=False) or not unique (replace=True)
+        random_ind = rng.choice(ind, size=nr_events, replace=replace) #get random indexes, either unique (replace=False) or not unique (replace=True)
         random_ind_unique = np.unique(random_ind,return_counts=True)
 
-        images_required = images[random_ind_unique[0],:,:] #now we have one copy of each image,but some images are required several times
         pos_x,pos_y = pos_x[random_ind_unique[0]],pos_y[random_ind_unique[0]]
-        index = np.array(index)[random_ind_unique[0]]
-
+        #now we have one copy of each image,but some images are required several times
+        images = crop_events(images,random_ind_unique[0],pos_x,pos_y,cropsize,zoom_factor,zoom_order,channels,padding_mode,roi_read,rng=rng)
+        index = index[random_ind_unique[0]]
         if xtra_in==True:
             xtra_data = xtra_data[random_ind_unique[0]]
 
-        images,Pos_x,Pos_y,indices,Xtra_data = [],[],[],[],[] #overwrite images by defining the list 'images'
-        zoom_interpol_method = zoom_arguments_scipy2cv(zoom_factor,zoom_order)
-
-        for i in range(len(random_ind_unique[1])):
-            for j in range(random_ind_unique[1][i]):#when shuffle=True it can happend that some images occure multiple times. This look makes sure this is possible
-                images.append(cv2.resize(images_required[i], dsize=None,fx=zoom_factor, fy=zoom_factor, interpolation=eval(zoom_interpol_method)))
-                Pos_x.append(pos_x[i])
-                Pos_y.append(pos_y[i])
-                indices.append(index[i])
-                if xtra_in==True:
-                    Xtra_data.append(xtra_data[i])
-
-
-        images = np.array(images)
-        pos_x = np.array(Pos_x)
-        pos_y = np.array(Pos_y)
-        index = np.array(indices)
-        if xtra_in==True:
-            xtra_data = np.array(Xtra_data)
-
-        permut = np.random.permutation(images.shape[0])
-        images = np.take(images,permut,axis=0,out=images) #Shuffle the images
-        images = list(images)
-        pos_x = np.take(pos_x,permut,axis=0,out=pos_x) #Shuffle pos_x
-        pos_y = np.take(pos_y,permut,axis=0,out=pos_y) #Shuffle pos_y
-        index = np.take(index,permut,axis=0,out=index) #Shuffle index
-        if xtra_in==True:
-            xtra_data = np.take(xtra_data,permut,axis=0,out=xtra_data) #Shuffle xtra_data
+        #when shuffle=True it can happend that some images occure multiple times.
+        #Each image is zoomed and cropped only once; the batch is assembled afterwards
+        sample_ind = np.repeat(np.arange(len(random_ind_unique[0])),random_ind_unique[1])
+        permut = rng.permutation(sample_ind.shape[0])
+        sample_ind = sample_ind[permut] #Shuffle
 
     if random_images==False:
         print("I'm loading all images (from disk)")
         #simply take all available cells
-        random_ind = ind #Here it is NOT a random index, but the index of all cells that are not too close to the image border
-        #images = list(np.array(images)[random_ind])
-        images = images[:]
-        images = list(images)
-        zoom_interpol_method = zoom_arguments_scipy2cv(zoom_factor,zoom_order)
-
-        if zoom_factor!=1.0:
-            for i in range(len(images)):
-                images[i] = cv2.resize(images[i], dsize=None,fx=zoom_factor, fy=zoom_factor, interpolation=eval(zoom_interpol_method))
-                #images[i] = cv2.resize(images[i], dsize=None,fx=zoom_factor, fy=zoom_factor, interpolation=zoom_interpol_method)
-
-        pos_x,pos_y = pos_x[random_ind],pos_y[random_ind]
-        index = np.array(index)[random_ind] #this is the original index of all used cells
+        images = crop_events(images,index,pos_x,pos_y,cropsize,zoom_factor,zoom_order,channels,padding_mode,roi_read,rng=rng)
         if xtra_in==True:
-            xtra_data = np.array(xtra_data)[random_ind] #this is the original index of all used cells
+            xtra_data = np.array(xtra_data)
 
-    #Cropping and padding operation to obtain images of desired size
-    padding_mode = pad_arguments_np2cv(padding_mode)
-    images = image_crop_pad_cv2(images=images,pos_x=pos_x,pos_y=pos_y,pix=pix,final_h=cropsize,final_w=cropsize,padding_mode=padding_mode)
+    if random_images==True:#gather the batch
+        images = np.take(images,sample_ind,axis=0)
+        index = np.take(index,sample_ind,axis=0)
+        if xtra_in==True:
+            xtra_data = np.take(xtra_data,sample_ind,axis=0)
 
-    images = np.r_[images]
+    aid_bin.release_rtdc(rtdc_ds)
     print("Final size:"+str(images.shape)+","+str(np.array(index).shape))
     #terminate the function by yielding the result
     yield check_squared(images),np.array(index).astype(int),np.array(xtra_data)
 
-def gen_crop_img_ram(dic,rtdc_path,nr_events=100,replace=True,random_images=True,xtra_in=False):
-    Rtdc_path = dic["rtdc_path"]
-    ind = np.where(np.array(Rtdc_path)==rtdc_path)[0]
-    images = np.array(dic["Cropped_Images"])[ind][0]
-    indices = np.array(dic["Indices"])[ind][0]
-    xtra_data = np.array(dic["Xtra_In"])[ind][0]
+def gen_crop_img_ram(ram,rtdc_path,nr_events=100,replace=True,random_images=True,xtra_in=False,rng=None):
+    #ram: RamCache (see crop_imgs_to_ram); arrays are views into the cache
+    #rng: RngContext or None (default random numbers)
+    rng = get_rng(rng)
+    entry = ram[rtdc_path]
+    images = entry["images"]
+    indices = entry["indices"]
+    xtra_data = entry["xtra_in"]
 
-    ind = range(len(images))
     if random_images==True:
         #select a random amount of those cells
-        random_ind = rand_state.choice(ind, size=nr_events, replace=replace) #get random indexes, either unique (replace=False) or not unique (replace=True)
+        random_ind = rng.choice(len(images), size=nr_events, replace=replace) #get random indexes, either unique (replace=False) or not unique (replace=True)
         random_ind_unique = np.unique(random_ind,return_counts=True)
 
-        images_required = images[random_ind_unique[0],:,:] #now we have one copy of each image,but some images are required several times
-        indices_required = indices[random_ind_unique[0]]
-        if xtra_in:
-            xtra_data_required = xtra_data[random_ind_unique[0]]
-
-        images,indices,xtra_data = [],[],[]
-        for i in range(len(random_ind_unique[1])):
-            for j in range(random_ind_unique[1][i]):
-                images.append(images_required[i,:,:])
-                indices.append(indices_required[i])
-                if xtra_in:
-                    xtra_data.append(xtra_data_required[i])
-
-        images = np.array(images)
-        indices = np.array(indices)
-        if xtra_in:
-            xtra_data = np.array(xtra_data)
+        #some images are required several times. Assemble the batch using
+        #a single gather instead of copying image by image
+        sample_ind = np.repeat(random_ind_unique[0],random_ind_unique[1])
+        permut = rng.permutation(sample_ind.shape[0])
+        sample_ind = sample_ind[permut] #Shuffle
 
-        permut = np.random.permutation(images.shape[0])
-        images = np.take(images,permut,axis=0,out=images) #Shuffle the images
-        indices = np.take(indices,permut,axis=0,out=indices) #Shuffle the images
+        images = np.take(images,sample_ind,axis=0)
+        indices = np.take(indices,sample_ind,axis=0)
         if xtra_in:
-            xtra_data = np.take(xtra_data,permut,axis=0,out=xtra_data) #Shuffle the images
+            xtra_data = np.take(xtra_data,sample_ind,axis=0)
 
-    if random_images==False:
-        #simply take all available cells
-        random_ind = ind
-        images = images
-        indices = indices
-        xtra_data = xtra_data
+    yield images,np.asarray(indices,dtype=int),xtra_data
 
-    yield images,np.array(indices).astype(int),xtra_data
+#Pixel statistics of .rtdc files (see image_stats). Key: aid_bin.crop_cache_key
+image_stats_cache = dict()
 
-def affine_augm(images,v_flip,h_flip,rot,width_shift,height_shift,zoom,shear):
-    """Affine augmentation (replacement for affine augm. for which I previously (AID <=0.0.4) used Keras ImageDataGenerator)
-    -Function augments images
-    images: array. array of shape (nr.images,image_height,image_width,channels)
-    v_flip: bool. If True, 50% of the images are vertically flipped
-    h_flip: bool. If True, 50% of the images are horizontally flipped
-    rot: integer or float. Range of rotation in degrees
-    width_shift: float. If >=1 or <=-1:number of pixels to shift the image left or right, if between 0 and 1: fraction of total width of image
-    height_shift: float. If >=1 or <=-1:number of pixels to shift the image up or down, if between 0 and 1: fraction of total height of image
-    zoom: float. zoom=0.1 means image is randomly scaled up/down by up to 10%. zoom=10 means, images are randomly scaled up to 10x initial size or down to 10% of initial size
-    shear: float. Shear Intensity (Shear angle in degrees)
+def combine_stats(stats_a,stats_b):
+    """
+    Combine the statistics (nr. of values, mean, sum of squared deviations
+    from the mean) of two sets of values (parallel variant of Welford's
+    algorithm; Chan et al.)
+    """
+    n_a,mean_a,m2_a = stats_a
+    n_b,mean_b,m2_b = stats_b
+    n = n_a+n_b
+    if n==0:
+        return (0,0.0,0.0)
+    delta = mean_b-mean_a
+    mean = mean_a+delta*n_b/float(n)
+    m2 = m2_a+m2_b+delta**2*n_a*n_b/float(n)
+    return (n,mean,m2)
+
+def array_stats(images,chunk_size=1000):
+    """
+    Statistics (nr. of pixels, mean, sum of squared deviations) of an array
+    of images. Only chunk_size images are converted to float at a time
+    """
+    stats = (0,0.0,0.0)
+    for start in range(0,len(images),chunk_size):
+        chunk = np.asarray(images[start:start+chunk_size],dtype=np.float64)
+        if chunk.size==0:
+            continue
+        mean = chunk.mean()
+        stats = combine_stats(stats,(chunk.size,mean,np.sum((chunk-mean)**2)))
+    return stats
+
+def image_stats(rtdc_path,crop,zoom_factor=1,zoom_order="cv2.INTER_LINEAR",color_mode="Grayscale",padding_mode="constant",roi_read=False,chunk_size=1000):
+    """
+    Statistics (nr. of pixels, mean, sum of squared deviations) of all
+    images of an .rtdc file, cropped like gen_crop_img(random_images=False).
+    Images are loaded and cropped chunk-wise (chunk_size images at a time).
+    Results are cached in image_stats_cache using the hash of the file and
+    the cropping parameters
+    """
+    key = aid_bin.crop_cache_key(rtdc_path,crop,zoom_factor,zoom_order,color_mode,padding_mode,False)
+    if key in image_stats_cache:
+        return image_stats_cache[key]
 
-    this functions performs very similar augmentation operations that are also
-    possbile using Keras ImageDataGenerator or Imgaug, but this function is
-    7x faster than ImageDataGenerator and
-    4.5x faster than Imgaug
+    failed,rtdc_ds = aid_bin.load_rtdc(rtdc_path,pin=True)
+    if failed:
+        raise IOError("Error occurred during loading file "+str(rtdc_path)+": "+str(rtdc_ds))
+    try:
+        pix = rtdc_ds.attrs["imaging:pixel size"] #get pixelation (um/pix)
+        images = rtdc_ds["events"]["image"]
+        pos_x = zoom_factor*rtdc_ds["events"]["pos_x"][:]/pix
+        pos_y = zoom_factor*rtdc_ds["events"]["pos_y"][:]/pix
+        channels = 3 if color_mode=="RGB" else 1
+        padding_mode = pad_arguments_np2cv(padding_mode)
+        stats = (0,0.0,0.0)
+        for start in range(0,len(images),chunk_size):
+            ind = np.arange(start,min(start+chunk_size,len(images)))
+            chunk = crop_events(images,ind,pos_x[ind],pos_y[ind],crop,zoom_factor,zoom_order,channels,padding_mode,roi_read)
+            stats = combine_stats(stats,array_stats(chunk,chunk_size))
+    finally:
+        aid_bin.release_rtdc(rtdc_ds)
+
+    image_stats_cache[key] = stats
+    return stats
+
+def pooled_mean_std(stats_list):
     """
-    images = np.copy(images)
+    Mean and standard deviation of all values of several sets, given their
+    statistics (see image_stats)
+    """
+    stats = (0,0.0,0.0)
+    for stats_ in stats_list:
+        stats = combine_stats(stats,stats_)
+    n,mean,m2 = stats
+    if n==0:
+        return 0.0,0.0
+    return mean,np.sqrt(m2/n)
+
+def affine_augm_rnd(nr_images,rows,cols,rot,width_shift,height_shift,zoom,shear,rng=None):
+    """
+    Random numbers for affine_augm and affine_augm_crop (see affine_augm for
+    the arguments)
+    Returns fx,fy,deg_rnd,height_shift_rnd,width_shift_rnd,shear_rnd; fx and fy
+    are None if zoom is 0
+    """
+    rng = get_rng(rng)
     rot,width_shift,height_shift,shear = abs(rot),abs(width_shift),abs(height_shift) ,abs(shear)
-    rows,cols = images.shape[1],images.shape[2]
     if height_shift<1 and height_shift>-1:
         height_shift = height_shift*rows
     if width_shift<1 and width_shift>-1:
         width_shift = width_shift*cols
 
+    fx,fy = None,None
     if zoom!=0: #get the random numbers for zooming
         zoom = abs(zoom)
         if zoom>0 and zoom<1:
-            fx = rand_state.uniform(low=1-zoom,high=1+zoom,size=images.shape[0])
-            fy = rand_state.uniform(low=1-zoom,high=1+zoom,size=images.shape[0])
+            fx = rng.uniform(low=1-zoom,high=1+zoom,size=nr_images)
+            fy = rng.uniform(low=1-zoom,high=1+zoom,size=nr_images)
         else:
-            fx = rand_state.uniform(low=1.0/np.float(zoom),high=zoom,size=images.shape[0])
-            fy = rand_state.uniform(low=1.0/np.float(zoom),high=zoom,size=images.shape[0])
+            fx = rng.uniform(low=1.0/float(zoom),high=zoom,size=nr_images)
+            fy = rng.uniform(low=1.0/float(zoom),high=zoom,size=nr_images)
     if rot!=0:
-        deg_rnd = rand_state.uniform(-rot,rot,size=images.shape[0])
+        deg_rnd = rng.uniform(-rot,rot,size=nr_images)
     else:
-        deg_rnd = np.repeat(0,repeats=images.shape[0])
+        deg_rnd = np.repeat(0,repeats=nr_images)
     if height_shift!=0:
-        height_shift_rnd = rand_state.uniform(-height_shift,height_shift,size=images.shape[0])
+        height_shift_rnd = rng.uniform(-height_shift,height_shift,size=nr_images)
     else:
-        height_shift_rnd = np.repeat(0,repeats=images.shape[0])
+        height_shift_rnd = np.repeat(0,repeats=nr_images)
     if width_shift!=0:
-        width_shift_rnd = rand_state.uniform(-width_shift,width_shift,size=images.shape[0])
+        width_shift_rnd = rng.uniform(-width_shift,width_shift,size=nr_images)
     else:
-        width_shift_rnd = np.repeat(0,repeats=images.shape[0])
+        width_shift_rnd = np.repeat(0,repeats=nr_images)
     if shear!=0:
         shear = np.deg2rad(shear)
-        shear_rnd = rand_state.uniform(-shear,shear,size=images.shape[0])
+        shear_rnd = rng.uniform(-shear,shear,size=nr_images)
     else:
-        shear_rnd = np.repeat(0,repeats=images.shape[0])
+        shear_rnd = np.repeat(0,repeats=nr_images)
+    return fx,fy,deg_rnd,height_shift_rnd,width_shift_rnd,shear_rnd
+
+def flip_code_rnd(v_flip,h_flip,rng=None):
+    """
+    Random flipping code for cv2.flip (0,1 or -1) as used by affine_augm or
+    None if the image is not flipped
+    """
+    rng = get_rng(rng)
+    if v_flip==True and h_flip==False and rng.integers(low=0,high=2)>0:
+        return 0
+    elif v_flip==False and h_flip==True and rng.integers(low=0,high=2)>0:
+        return 1
+    elif v_flip==True and h_flip==True:
+        return rng.integers(low=-1,high=2) #get a random flipping axis: 1=vertical,0=horizontal,-1=both
+    return None
+
+def affine_augm(images,v_flip,h_flip,rot,width_shift,height_shift,zoom,shear,rng=None):
+    """Affine augmentation (replacement for affine augm. for which I previously (AID <=0.0.4) used Keras ImageDataGenerator)
+    -Function augments images
+    images: array. array of shape (nr.images,image_height,image_width,channels)
+    v_flip: bool. If True, 50% of the images are vertically flipped
+    h_flip: bool. If True, 50% of the images are horizontally flipped
+    rot: integer or float. Range of rotation in degrees
+    width_shift: float. If >=1 or <=-1:number of pixels to shift the image left or right, if between 0 and 1: fraction of total width of image
+    height_shift: float. If >=1 or <=-1:number of pixels to shift the image up or down, if between 0 and 1: fraction of total height of image
+    zoom: float. zoom=0.1 means image is randomly scaled up/down by up to 10%. zoom=10 means, images are randomly scaled up to 10x initial size or down to 10% of initial size
+    shear: float. Shear Intensity (Shear angle in degrees)
+    rng: RngContext or None (default random numbers)
+
+    this functions performs very similar augmentation operations that are also
+    possbile using Keras ImageDataGenerator or Imgaug, but this function is
+    7x faster than ImageDataGenerator and
+    4.5x faster than Imgaug
+    """
+    rng = get_rng(rng)
+    images = np.copy(images)
+    rows,cols = images.shape[1],images.shape[2]
+    fx,fy,deg_rnd,height_shift_rnd,width_shift_rnd,shear_rnd = affine_augm_rnd(images.shape[0],rows,cols,rot,width_shift,height_shift,zoom,shear,rng)
 
     for i in range(images.shape[0]):
         img = images[i]
         #1. Flipping:
-        if v_flip==True and h_flip==False and rand_state.randint(low=0,high=2)>0:
-            img = cv2.flip( img, 0 )
-        elif v_flip==False and h_flip==True and rand_state.randint(low=0,high=2)>0:
-            img = cv2.flip( img, 1 )
-        elif v_flip==True and h_flip==True:
-            rnd = rand_state.randint(low=-1,high=2) #get a random flipping axis: 1=vertical,0=horizontal,-1=both
-            img = cv2.flip( img, rnd )
+        code = flip_code_rnd(v_flip,h_flip,rng)
+        if code is not None:
+            img = cv2.flip( img, code )
 
         #2.zooming
         if zoom!=0:
@@ -555,28 +858,108 @@ def affine_augm(images,v_flip,h_flip,rot,width_shift,height_shift,zoom,shear):
         images[i] = np.atleast_3d(cv2.warpAffine(img,M_transf,(cols,rows))) #Rotation, translation and shear in a single call of cv2.warpAffine!
     return images
 
-def contrast_augm_cv2(images,fmin,fmax):
+def zoom_offset(length,f):
+    """
+    Offset of the image center after zooming an axis of the given length by f
+    (cv2.resize) and cropping or padding back to length (see affine_augm)
+    length: int
+    f: array; zoom factors
+    """
+    length_zoom = np.rint(length*f).astype(int)
+    diff = length_zoom-length
+    crop = -(length_zoom//2-length//2)
+    pad = np.abs(diff)//2
+    return np.where(diff>0,crop,np.where(diff<0,pad,0))
+
+def affine_augm_crop(images,v_flip,h_flip,rot,width_shift,height_shift,zoom,shear,final_h,final_w,out=None,rng=None):
+    """
+    Single-warp version of affine_augm followed by cropping the center
+    final_h x final_w pixels (the final cropping done in action_fit_model_worker).
+    Flipping, zooming, rotation, shear and translation are composed into one
+    matrix and each image is transformed by a single call of cv2.warpAffine
+    directly to the final size. Same arguments and random numbers as
+    affine_augm. The results differ slightly: zoomed images are interpolated
+    once instead of twice, and pixels that affine_augm cuts off after zooming
+    can be rotated back into the image.
+    final_h, final_w: int; size of the returned images
+    out: array of shape (nr.images,final_h,final_w,channels) to write the
+    result to, or None
+    """
+    rng = get_rng(rng)
+    images = np.asarray(images)
+    nr_images,rows,cols = images.shape[0],images.shape[1],images.shape[2]
+    fx,fy,deg_rnd,height_shift_rnd,width_shift_rnd,shear_rnd = affine_augm_rnd(nr_images,rows,cols,rot,width_shift,height_shift,zoom,shear,rng)
+    codes = [flip_code_rnd(v_flip,h_flip,rng) for i in range(nr_images)]
+
+    #Matrices of all images; pixel coordinates are transformed by
+    #crop @ translation/rotation/shear @ zoom @ flip
+    M = np.tile(np.eye(3),(nr_images,1,1))
+    #1. Flipping:
+    flip_y = np.array([code in [0,-1] for code in codes],dtype=bool)
+    flip_x = np.array([code in [1,-1] for code in codes],dtype=bool)
+    M[flip_x,0,0],M[flip_x,0,2] = -1,cols-1
+    M[flip_y,1,1],M[flip_y,1,2] = -1,rows-1
+    #2.zooming (pixel centers are scaled like in cv2.resize)
+    if zoom!=0:
+        M_zoom = np.tile(np.eye(3),(nr_images,1,1))
+        M_zoom[:,0,0],M_zoom[:,0,2] = fx,0.5*fx-0.5+zoom_offset(cols,fx)
+        M_zoom[:,1,1],M_zoom[:,1,2] = fy,0.5*fy-0.5+zoom_offset(rows,fy)
+        M = M_zoom @ M
+    #3.Translation, Rotation, Shear (as cv2.getRotationMatrix2D in affine_augm)
+    alpha,beta = np.cos(np.deg2rad(deg_rnd)),np.sin(np.deg2rad(deg_rnd))
+    center_x,center_y = cols/2,rows/2
+    M_transf = np.tile(np.eye(3),(nr_images,1,1))
+    M_transf[:,0,0],M_transf[:,0,1] = alpha,beta+shear_rnd
+    M_transf[:,0,2] = (1-alpha)*center_x-beta*center_y + width_shift_rnd-(shear_rnd*cols)/2
+    M_transf[:,1,0],M_transf[:,1,1] = -beta+shear_rnd,alpha
+    M_transf[:,1,2] = beta*center_x+(1-alpha)*center_y + height_shift_rnd-(shear_rnd*rows)/2
+    #4.final cropping (translation by the removed pixels)
+    M_transf[:,0,2] -= int(cols/2.0-final_w/2.0)
+    M_transf[:,1,2] -= int(rows/2.0-final_h/2.0)
+    M = M_transf @ M
+
+    if out is None or out.shape!=(nr_images,final_h,final_w)+images.shape[3:]:
+        out = np.empty((nr_images,final_h,final_w)+images.shape[3:],dtype=images.dtype)
+    for i in range(nr_images):
+        cv2.warpAffine(images[i],M[i,:2],(final_w,final_h),dst=out[i])
+    return out
+
+def affine_augm_paras(images,affine_paras,rng=None):
+    """
+    Affine augmentation with the arguments given as dict (v_flip,h_flip,
+    rotation,width_shift,height_shift,zoom,shear). If the dict contains
+    "crop" (int), the images are transformed by affine_augm_crop directly to
+    crop x crop pixels, otherwise by affine_augm (same size as the input).
+    """
+    p = affine_paras
+    if p.get("crop") is not None:
+        return affine_augm_crop(images,p["v_flip"],p["h_flip"],p["rotation"],p["width_shift"],p["height_shift"],p["zoom"],p["shear"],p["crop"],p["crop"],rng=rng)
+    return affine_augm(images,p["v_flip"],p["h_flip"],p["rotation"],p["width_shift"],p["height_shift"],p["zoom"],p["shear"],rng=rng)
+
+def contrast_augm_cv2(images,fmin,fmax,rng=None):
     """
     this function is equivalent to the numpy version, but 2.8x faster
     """
+    rng = get_rng(rng)
     images = np.copy(images)
-    contr_rnd = rand_state.uniform(low=fmin,high=fmax,size=images.shape[0])
+    contr_rnd = rng.uniform(low=fmin,high=fmax,size=images.shape[0])
     for i in range(images.shape[0]):
         fac = contr_rnd[i]
         images[i] = np.atleast_3d(cv2.addWeighted(images[i], fac , 0, 0, 128-fac*128))
     return images
 
-def satur_hue_augm_cv2(X_batch,saturation_on,saturation_lower,saturation_higher,hue_on,hue_delta):
+def satur_hue_augm_cv2(X_batch,saturation_on,saturation_lower,saturation_higher,hue_on,hue_delta,rng=None):
     """
     Replacement for the tf version for changing saturation and hue.
     This version is 4.5x faster than saturation_hue_augm_tf
     """
+    rng = get_rng(rng)
     if saturation_on or hue_on:
         X_batch = np.copy(X_batch)
         hue_delta = abs(hue_delta)
         #get random numbers
-        sat_rnd = rand_state.uniform(low=saturation_lower,high=saturation_higher,size=X_batch.shape[0])
-        hue_rnd = rand_state.uniform(low=1-hue_delta,high=1+hue_delta,size=X_batch.shape[0])
+        sat_rnd = rng.uniform(low=saturation_lower,high=saturation_higher,size=X_batch.shape[0])
+        hue_rnd = rng.uniform(low=1-hue_delta,high=1+hue_delta,size=X_batch.shape[0])
         for i in range(X_batch.shape[0]):
             hsv = cv2.cvtColor(X_batch[i], cv2.COLOR_RGB2HSV)
             hsv[...,1] = hsv[...,1]*sat_rnd[i] #change the saturation
@@ -584,13 +967,14 @@ def satur_hue_augm_cv2(X_batch,saturation_on,saturation_lower,saturation_higher,
             X_batch[i] = cv2.cvtColor(hsv,cv2.COLOR_HSV2RGB)
     return X_batch.astype(np.uint8)
 
-def avg_blur_cv2(images,k1,k2):
+def avg_blur_cv2(images,k1,k2,rng=None):
+    rng = get_rng(rng)
     if k1==k2:
         k = np.zeros(shape=images.shape[0])+k2
     elif k1>k2:
-        k = rand_state.randint(low=k2,high=k1,size=images.shape[0])
+        k = rng.integers(low=k2,high=k1,size=images.shape[0])
     else:
-        k = rand_state.randint(low=k1,high=k2,size=images.shape[0])
+        k = rng.integers(low=k1,high=k2,size=images.shape[0])
 
     buffer = np.zeros(shape=images.shape,dtype=np.uint8)
     for i in range(images.shape[0]):
@@ -600,14 +984,15 @@ def avg_blur_cv2(images,k1,k2):
             buffer[i] = images[i].astype(np.uint8)
     return buffer
 
-def gauss_blur_cv(images,minkernelsize,maxkernelsize):
+def gauss_blur_cv(images,minkernelsize,maxkernelsize,rng=None):
+    rng = get_rng(rng)
     #images = np.copy(images)
     if minkernelsize==maxkernelsize:
         k = np.zeros(shape=images.shape[0])+maxkernelsize
     elif minkernelsize>maxkernelsize:
-        k = rand_state.randint(low=maxkernelsize,high=minkernelsize,size=images.shape[0])
+        k = rng.integers(low=maxkernelsize,high=minkernelsize,size=images.shape[0])
     else:
-        k = rand_state.randint(low=minkernelsize,high=maxkernelsize,size=images.shape[0])
+        k = rng.integers(low=minkernelsize,high=maxkernelsize,size=images.shape[0])
     k = 2*(k//2)+1 #make k odd
     buffer = np.zeros(shape=images.shape,dtype=np.uint8)
     for i in range(images.shape[0]):
@@ -617,18 +1002,19 @@ def gauss_blur_cv(images,minkernelsize,maxkernelsize):
             buffer[i] = images[i].astype(np.uint8)
     return buffer
 
-def motion_blur_cv(images,kernel_size,angle):
+def motion_blur_cv(images,kernel_size,angle,rng=None):
     """
     kernel_size: int or tuple; if int: random kernel sizes from 0 to int are used; if tuple: it has the be (k_min,k_max) which is the minimum and maximum kernel sizes between which random kernel sizes are generated
     angle: int or tuple; if int: only this angle will be used; if tuple: it has to be (angle_min,angle_max) which is the minimum and maximum angle for the direction of motion blur. In RTDC, cells go horizontal-therefore angle=0 makes most sense.
     """
+    rng = get_rng(rng)
     if type(kernel_size)==int or type(angle)==float:
-        k_rnd = rand_state.randint(low=0,high=kernel_size,size=images.shape[0])
+        k_rnd = rng.integers(low=0,high=kernel_size,size=images.shape[0])
     elif type(kernel_size)==tuple or type(kernel_size)==list or type(kernel_size)==np.ndarray: #and len(kernel_size)==2:
         if np.min(kernel_size)==np.max(kernel_size):
-            k_rnd = rand_state.randint(low=0,high=np.min(kernel_size),size=images.shape[0])
+            k_rnd = rng.integers(low=0,high=np.min(kernel_size),size=images.shape[0])
         else:
-            k_rnd = rand_state.randint(low=np.min(kernel_size),high=np.max(kernel_size),size=images.shape[0])
+            k_rnd = rng.integers(low=np.min(kernel_size),high=np.max(kernel_size),size=images.shape[0])
     else:
         msg = "Range of kernel sizes for motion blurring are wrongly defined"
         raise ValueError(msg)
@@ -639,7 +1025,7 @@ def motion_blur_cv(images,kernel_size,angle):
         if np.min(angle)==np.max(angle):
             angle_rnd = np.zeros(shape=images.shape[0])+np.min(angle)
         else:
-            angle_rnd = rand_state.randint(low=np.min(angle),high=np.max(angle),size=images.shape[0])
+            angle_rnd = rng.integers(low=np.min(angle),high=np.max(angle),size=images.shape[0])
     else:
         msg = "Range of angles for motion blurring are wrongly defined"
         raise ValueError(msg)
@@ -658,23 +1044,170 @@ def motion_blur_cv(images,kernel_size,angle):
             buffer[i] = images[i]
     return buffer
 
-def brightn_noise_augm_cv2(images,add_low,add_high,mult_low,mult_high,noise_mean,noise_std):
+def brightn_noise_augm_cv2(images,add_low,add_high,mult_low,mult_high,noise_mean,noise_std,out=None,rng=None):
     """
     this function is equivalent to brightness_noise_augm, but 2x faster
+    out: see contrast_brightn_noise_augm_cv2
     """
-    images = np.copy(images)
-    m = rand_state.uniform(low=mult_low,high=mult_high,size=images.shape[0]) #plus minus 15%
-    n = rand_state.uniform(low=add_low,high=add_high,size=images.shape[0]) #plus minus 10 Grayscale values
-    noise = rand_state.normal(loc=noise_mean,scale=noise_std,size=images.shape[1:])
+    return contrast_brightn_noise_augm_cv2(images,False,None,None,add_low,add_high,mult_low,mult_high,noise_mean,noise_std,out=out,rng=rng)
+
+def contrast_brightn_noise_augm_cv2(images,contrast_on,fmin,fmax,add_low,add_high,mult_low,mult_high,noise_mean,noise_std,out=None,rng=None):
+    """
+    Fused version of contrast_augm_cv2 followed by brightn_noise_augm_cv2:
+    same parameters and same random numbers, but each image is transformed by
+    a single call of cv2.addWeighted:
+    m*(c*img+128-c*128)+n+noise = (m*c)*img+noise+(m*(128-c*128)+n)
+    Only the final result is rounded and clipped to uint8 (previously, also
+    the result of the contrast augmentation was).
+    images: array of shape (nr.images,image_height,image_width,channels)
+    contrast_on: bool; if False, only brightness and noise are changed
+    out: uint8 array of the same shape as images to write the result to, or
+    None. Can be images itself.
+    rng: RngContext or None (default random numbers). The noise is shuffled by
+    cv2.randShuffle, whose (per thread) random number generator is seeded from rng
+    Returns the augmented images (uint8)
+    """
+    rng = get_rng(rng)
+    images = np.asarray(images,dtype=np.uint8)
+    if contrast_on:
+        c = rng.uniform(low=fmin,high=fmax,size=images.shape[0])
+    else:
+        c = np.ones(images.shape[0])
+    m = rng.uniform(low=mult_low,high=mult_high,size=images.shape[0]) #plus minus 15%
+    n = rng.uniform(low=add_low,high=add_high,size=images.shape[0]) #plus minus 10 Grayscale values
+    noise = rng.normal(loc=noise_mean,scale=noise_std,size=images.shape[1:])
     noise = noise.astype(np.int16)
-    images = images.astype(np.int16)
-    buffer = np.zeros(shape=images.shape,dtype=np.uint8)
+    alpha = m*c
+    beta = m*(128-c*128)+n
+    if out is None or out.shape!=images.shape or out.dtype!=np.uint8:
+        out = np.empty(images.shape,dtype=np.uint8)
+    cv2.setRNGSeed(int(rng.integers(2**31-1)))
     for i in range(len(images)):
         cv2.randShuffle(noise) #Even faster than numpy shuffle (actually a LOT!. More than 2x faster!)
-        cv2.addWeighted(images[i], m[i] , noise, 1, n[i],dst=buffer[i],dtype=0)
-    return buffer
+        cv2.addWeighted(images[i], alpha[i], noise, 1, beta[i],dst=out[i],dtype=0)
+    return out
 
-def image_normalization(images,normalization_method,mean_trainingdata=None,std_trainingdata=None):
+def photometric_augm(images,aug_paras,out=None,rng=None):
+    """
+    Contrast, saturation/hue, blurring and brightness/noise augmentation in the
+    order used during training
+    images: array of shape (nr.images,image_height,image_width,channels)
+    aug_paras: dict. Keys are the names of the arguments of contrast_augm_cv2,
+    satur_hue_augm_cv2, avg_blur_cv2, gauss_blur_cv, motion_blur_cv and
+    brightn_noise_augm_cv2 as used in action_fit_model_worker (contrast_on,
+    contrast_lower,...,gaussnoise_scale)
+    out: uint8 array to write the result to (reused if the shape fits) or None
+    rng: RngContext or None (default random numbers)
+    """
+    p = aug_paras
+    images = np.asarray(images,dtype=np.uint8)
+    #without saturation/hue and blurring in between, contrast, brightness and noise are done in one pass
+    between = p["saturation_on"] or p["hue_on"] or p["avgBlur_on"] or p["gaussBlur_on"] or p["motionBlur_on"]
+    if p["contrast_on"] and between:
+        images = contrast_augm_cv2(images,p["contrast_lower"],p["contrast_higher"],rng=rng)
+    if p["saturation_on"] or p["hue_on"]:
+        images = satur_hue_augm_cv2(images,p["saturation_on"],p["saturation_lower"],p["saturation_higher"],p["hue_on"],p["hue_delta"],rng=rng) #Gray and RGB; both values >0!
+    if p["avgBlur_on"]:
+        images = avg_blur_cv2(images,p["avgBlur_min"],p["avgBlur_max"],rng=rng)
+    if p["gaussBlur_on"]:
+        images = gauss_blur_cv(images,p["gaussBlur_min"],p["gaussBlur_max"],rng=rng)
+    if p["motionBlur_on"]:
+        images = motion_blur_cv(images,p["motionBlur_kernel"],p["motionBlur_angle"],rng=rng)
+    if p["contrast_on"] and not between:
+        contrast = (True,p["contrast_lower"],p["contrast_higher"])
+    else:
+        contrast = (False,None,None)
+    images = contrast_brightn_noise_augm_cv2(images,*contrast,p["brightness_add_lower"],p["brightness_add_upper"],p["brightness_mult_lower"],p["brightness_mult_upper"],p["gaussnoise_mean"],p["gaussnoise_scale"],out=out,rng=rng)
+    return images
+
+def augm_shard(task):
+    """
+    Worker function of AugmentationPool: augment the images lo:hi of the
+    shared input batch and write them to the same position of the shared
+    output batch
+    """
+    name_in,name_out,shape_in,shape_out,lo,hi,seed_seq,affine_paras,photometric_paras = task
+    shm_in = shared_memory.SharedMemory(name=name_in)
+    shm_out = shared_memory.SharedMemory(name=name_out)
+    try:
+        X_in = np.ndarray(shape_in,dtype=np.uint8,buffer=shm_in.buf)
+        X_out = np.ndarray(shape_out,dtype=np.uint8,buffer=shm_out.buf)
+        rng = RngContext(seed_seq=seed_seq) #each shard has its own stream of random numbers
+        images = X_in[lo:hi]
+        if affine_paras is not None:
+            images = affine_augm_paras(images,affine_paras,rng=rng)
+        if photometric_paras is not None:
+            images = photometric_augm(images,photometric_paras,rng=rng)
+        X_out[lo:hi] = images
+        del X_in,X_out,images #release the buffers before closing
+    finally:
+        shm_in.close()
+        shm_out.close()
+
+class AugmentationPool():
+    """
+    Persistent process pool for image augmentation (affine_augm and
+    photometric_augm). The batch is copied once into shared memory; each
+    process augments one shard of it and writes the result in place into a
+    shared output buffer. The buffers are reused as long as they are large
+    enough.
+    nr_processes: int; nr. of processes (default: os.cpu_count())
+    """
+    def __init__(self,nr_processes=None):
+        self.nr_processes = int(nr_processes or os.cpu_count())
+        #start the resource tracker before the processes are created. Otherwise,
+        #each process starts its own tracker which removes the shared memory when the process ends
+        resource_tracker.ensure_running()
+        self.pool = multiprocessing.Pool(self.nr_processes)
+        self.shm_in,self.shm_out = None,None
+
+    def get_buffers(self,nbytes_in,nbytes_out):
+        if self.shm_in is None or self.shm_in.size<nbytes_in or self.shm_out.size<nbytes_out:
+            self.free_buffers()
+            self.shm_in = shared_memory.SharedMemory(create=True,size=max(1,nbytes_in))
+            self.shm_out = shared_memory.SharedMemory(create=True,size=max(1,nbytes_out))
+
+    def free_buffers(self):
+        for shm in [self.shm_in,self.shm_out]:
+            if shm is not None:
+                shm.close()
+                shm.unlink()
+        self.shm_in,self.shm_out = None,None
+
+    def augment(self,images,affine_paras=None,photometric_paras=None,rng=None):
+        """
+        images: array of shape (nr.images,image_height,image_width,channels), uint8
+        affine_paras: dict; see affine_augm_paras, or None
+        photometric_paras: dict; see photometric_augm, or None
+        rng: RngContext or None (default random numbers); each shard gets a
+        child stream (RngContext.spawn)
+        Returns the augmented images (uint8)
+        """
+        images = np.ascontiguousarray(images,dtype=np.uint8)
+        shape_out = images.shape
+        if affine_paras is not None and affine_paras.get("crop") is not None:
+            shape_out = (images.shape[0],affine_paras["crop"],affine_paras["crop"])+images.shape[3:]
+        self.get_buffers(images.nbytes,int(np.prod(shape_out)))
+        X_in = np.ndarray(images.shape,dtype=np.uint8,buffer=self.shm_in.buf)
+        X_in[:] = images
+
+        nr_shards = max(1,min(self.nr_processes,len(images)))
+        bounds = np.linspace(0,len(images),nr_shards+1).astype(int)
+        seed_seqs = [child.seed_seq for child in get_rng(rng).spawn(nr_shards)]
+        tasks = [(self.shm_in.name,self.shm_out.name,images.shape,shape_out,bounds[i],bounds[i+1],seed_seqs[i],affine_paras,photometric_paras) for i in range(nr_shards)]
+        self.pool.map(augm_shard,tasks)
+
+        X_out = np.ndarray(shape_out,dtype=np.uint8,buffer=self.shm_out.buf)
+        images = np.array(X_out) #copy, since the buffer is reused by the next call
+        del X_in,X_out
+        return images
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        self.free_buffers()
+
+def image_normalization(images,normalization_method,mean_trainingdata=None,std_trainingdata=None,out=None,dtype=np.float32,chunk_size=256,rng=None):
     """
     Perform a normalization of the pixel values.
 
@@ -697,12 +1230,18 @@ def image_normalization(images,normalization_method,mean_trainingdata=None,std_t
         subtracting the mean and then dividing by the standard deviation
     mean_trainingdata: float; the mean pixel value obtained from the training dataset
     std_trainingdata: float; the std of the pixel values obtained from the training dataset
+    out: ndarray; buffer for the result (e.g. returned by a previous call).
+        It is used if shape and dtype match, otherwise a new array is created
+    dtype: dtype of the result, e.g. np.float16 for inference
+    chunk_size: int; nr. of images that are processed at once (size of temporary arrays)
+    rng: RngContext or None (default random numbers); used to replace nan values
 
     Returns
     ----------
     ndarray of images
 
     """
+    rng = get_rng(rng)
     if normalization_method == "StdScaling using mean and std of all training data":
         #make sure pandas series is converted to numpy array
         if type(mean_trainingdata)==pd.core.series.Series:
@@ -715,55 +1254,173 @@ def image_normalization(images,normalization_method,mean_trainingdata=None,std_t
     if len(images.shape)==3: #single channel Grayscale rtdc data
         #Add the "channels" dimension
         images = np.expand_dims(images,3)
-    images = images.astype(np.float32)
+    if out is None or out.shape!=images.shape or out.dtype!=np.dtype(dtype):
+        out = np.empty(images.shape,dtype=dtype)
 
-    for k in range(images.shape[0]):
-        line = images[k,:,:,:]
+    #All images of a chunk are normalized at once, using per-image
+    #statistics along axes (1,2,3) for the individual scaling
+    for start in range(0,images.shape[0],chunk_size):
+        line = images[start:start+chunk_size].astype(np.float32)
         ###########Scaling############
         if normalization_method == "None":
             pass #dont do anything
         elif normalization_method == "Div. by 255":
             line = line/255.0
         elif normalization_method == "StdScaling using mean and std of each image individually":
-            mean = np.mean(line)
-            std = np.std(line)
-            if np.allclose(std,0):
-                std = 0.0001
+            mean = np.mean(line,axis=(1,2,3),keepdims=True)
+            std = np.std(line,axis=(1,2,3),keepdims=True)
+            zero = np.isclose(std,0)
+            if np.any(zero):
+                std[zero] = 0.0001
                 print("Set the standard deviation to 0.0001 because otherwise div. by 0 would have happend!")
-            line = (line-mean)/std
+            line -= mean
+            line /= std
         elif normalization_method == "StdScaling using mean and std of all training data":
             line = (line-mean_trainingdata)/std_trainingdata
 
         #Under NO circumstances, training data should contain nan values
+        #replace nan with random values (one value per image). This is better than nan, since .fit will collapse and never get back
+        fill = rng.random(line.shape[0])
         ind = np.isnan(line)
-        line[ind] = np.random.random() #replace nan with random values. This is better than nan, since .fit will collapse and never get back
-        images[k,:,:,:] = line
-    return images
+        if np.any(ind):
+            ind = np.nonzero(ind)
+            line[ind] = fill[ind[0]]
+        out[start:start+chunk_size] = line
+    return out
 
-def crop_imgs_to_ram(SelectedFiles,crop,zoom_factors=None,zoom_order=0,color_mode='Grayscale'):
+class RamCache():
+    """
+    Cropped images (and indices, xtra_in data) of .rtdc files in RAM, see
+    crop_imgs_to_ram. Each file is stored as one contiguous uint8 array.
+    Entries are looked up by rtdc_path and returned without copying.
+    Each entry remembers the cropping parameters and the key
+    (aid_bin.crop_cache_key) it was loaded with, which allows to reload only
+    the files that changed (see diff).
+    """
+    def __init__(self):
+        self.entries = dict() #rtdc_path: {"images":..,"indices":..,"xtra_in":..,"params":..,"key":..}
+        self.last_refresh = {"kept":[],"loaded":[],"removed":[]}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self,rtdc_path):
+        return rtdc_path in self.entries
+
+    def __getitem__(self,rtdc_path):
+        return self.entries[rtdc_path]
+
+    @property
+    def rtdc_paths(self):
+        return list(self.entries.keys())
+
+    @property
+    def nbytes(self):
+        return sum([entry["images"].nbytes for entry in self.entries.values()])
+
+    def add(self,rtdc_path,images,indices,xtra_in_data,params=None,key=None):
+        #memory maps of the crop cache are kept as they are (no copy)
+        if not isinstance(images,np.memmap):
+            images = np.ascontiguousarray(images,dtype=np.uint8)
+        self.entries[str(rtdc_path)] = {"images":images,"indices":np.asarray(indices).astype(int),"xtra_in":np.asarray(xtra_in_data),
+                                        "params":params,"key":key}
+
+    def remove(self,rtdc_path):
+        self.entries.pop(rtdc_path,None)
+
+    def copy(self):
+        """
+        Shallow copy (arrays are shared). Entries that are added or removed
+        later on do not affect the copy
+        """
+        ram = RamCache()
+        ram.entries = dict(self.entries)
+        return ram
+
+    def diff(self,keys):
+        """
+        Compare the cache to the required files
+        keys: dict; rtdc_path: key (aid_bin.crop_cache_key) of the required files
+        Returns three lists of rtdc_paths:
+        keep: entries that are up to date
+        load: files that are missing or were loaded with other parameters
+        remove: entries that are not required anymore or are outdated
+        """
+        keep = [rtdc_path for rtdc_path in keys if rtdc_path in self.entries and self.entries[rtdc_path]["key"]==keys[rtdc_path]]
+        load = [rtdc_path for rtdc_path in keys if rtdc_path not in keep]
+        remove = [rtdc_path for rtdc_path in self.entries if rtdc_path not in keep]
+        return keep,load,remove
+
+    def status(self,rtdc_path,params):
+        """
+        Status of a file for the data overview without reading the file:
+        "RAM": in RAM and cropped using params
+        "outdated": in RAM, but cropped using other parameters
+        "disk": not in RAM
+        """
+        if rtdc_path not in self.entries:
+            return "disk"
+        if self.entries[rtdc_path]["params"]!=params:
+            return "outdated"
+        return "RAM"
+
+def ram_params(crop,zoom_factor,zoom_order,color_mode,padding_mode,xtra_in):
+    """Cropping parameters of an entry of RamCache"""
+    return (int(crop),float(zoom_factor),str(zoom_order),str(color_mode),str(padding_mode),bool(xtra_in))
+
+def crop_imgs_to_ram(SelectedFiles,crop,zoom_factors=None,zoom_order=0,color_mode='Grayscale',padding_mode='constant',cache_dir=None,cache_size_GB=10,roi_read=False,max_bytes=None,ram=None):
     #This function transfers the entire data to ram which allows to access it from there
     #quickly. This makes lots of sense for most data sets, because the cropped images with uint8 take very little space.
     #Compute estimate of required disk space using the function print_ram_example if you like
+    #If cache_dir is given, cropped images are stored on disk (see aid_bin.crop_cache_save)
+    #and are reused in later sessions, as long as file and cropping parameters are the same
+    #If max_bytes is given, only the files that fit into max_bytes are loaded
+    #(see aid_bin.ram_cache_plan). The other files are read from .rtdc during training
+    #If ram (RamCache) is given, it is updated: entries that are up to date are kept,
+    #only new or changed files are loaded and files that are not selected anymore are removed
 
     Rtdc_paths = [selectedfile["rtdc_path"] for selectedfile in SelectedFiles] #get rtdc paths
-    Rtdc_paths_uni = np.unique(np.array(Rtdc_paths)) #get unique Rtdc_paths
+    in_ram,from_disk = aid_bin.ram_cache_plan(SelectedFiles,crop,color_mode,max_bytes)
+    for rtdc_path in from_disk:
+        print("Not enough RAM, data will be read from .rtdc: "+rtdc_path)
+    Rtdc_paths_uni = np.unique(np.array(in_ram)) #get unique Rtdc_paths
     xtra_in = {selectedfile["xtra_in"] for selectedfile in SelectedFiles}
     if len(xtra_in)>1:# False and True is present. Not supported
         print("Xtra data is used only for some files. Xtra data needs to be used either by all or by none!")
         return
     xtra_in = list(xtra_in)[0]#this is either True or False
-
-    X_train,Indices,Xtra_in_data = [],[],[]
-    for i in range(len(Rtdc_paths_uni)): #Move all images to RAM (Not only some random images!)->random_images=False
-        if zoom_factors!=None:
-            gen_train = gen_crop_img(crop,Rtdc_paths_uni[i],random_images=False,zoom_factor=zoom_factors[i],zoom_order=zoom_order,color_mode=color_mode,xtra_in=xtra_in) #Replace=true means that individual cells could occur several times
-        else:
-            gen_train = gen_crop_img(crop,Rtdc_paths_uni[i],random_images=False,color_mode=color_mode,xtra_in=xtra_in) #Replace=true means that individual cells could occur several times
-
+    if zoom_factors!=None:#zoom_factors are given in the order of SelectedFiles
+        zoom_factors = dict(zip(Rtdc_paths,zoom_factors))
+
+    if ram==None:
+        ram = RamCache()
+    params,keys = {},{}
+    for rtdc_path in Rtdc_paths_uni:
+        rtdc_path = str(rtdc_path)
+        zoom_factor = zoom_factors[rtdc_path] if zoom_factors!=None else 1
+        params[rtdc_path] = ram_params(crop,zoom_factor,zoom_order,color_mode,padding_mode,xtra_in)
+        keys[rtdc_path] = aid_bin.crop_cache_key(rtdc_path,crop,zoom_factor,zoom_order,color_mode,padding_mode,xtra_in)
+    keep,load,remove = ram.diff(keys)
+    for rtdc_path in remove: #free the memory before loading new data
+        ram.remove(rtdc_path)
+
+    for rtdc_path in load: #Move all images to RAM (Not only some random images!)->random_images=False
+        zoom_factor = params[rtdc_path][1]
+        key = keys[rtdc_path]
+        if cache_dir!=None:
+            cached = aid_bin.crop_cache_load(cache_dir,key)
+            if cached!=None:
+                print("Loaded cropped images from cache: "+rtdc_path)
+                ram.add(rtdc_path,*cached,params=params[rtdc_path],key=key)
+                continue
+
+        gen_train = gen_crop_img(crop,rtdc_path,random_images=False,zoom_factor=zoom_factor,zoom_order=zoom_order,color_mode=color_mode,padding_mode=padding_mode,xtra_in=xtra_in,roi_read=roi_read)
         x_train,index,xtra_in_data = next(gen_train)
-        X_train.append(x_train)
-        Indices.append(index)
-        Xtra_in_data.append(xtra_in_data)
-
-    dic = {"rtdc_path":Rtdc_paths_uni,"Cropped_Images":X_train,"Indices":Indices,"Xtra_In":Xtra_in_data}
-    return dic
+        if cache_dir!=None:
+            aid_bin.crop_cache_save(cache_dir,key,x_train,index,xtra_in_data,max_size_GB=cache_size_GB)
+        ram.add(rtdc_path,x_train,index,xtra_in_data,params=params[rtdc_path],key=key)
+
+    removed = [rtdc_path for rtdc_path in remove if rtdc_path not in load]
+    ram.last_refresh = {"kept":keep,"loaded":load,"removed":removed}
+    print("Data in RAM: kept "+str(len(keep))+", loaded "+str(len(load))+", removed "+str(len(removed))+" file(s)")
+    return ram
@@ -76,6 +76,41 @@ def get_default_dict(dir_settings):
             Default_dict["doubleSpinBox_learningRate_Adamax"] = 0.002
         if "doubleSpinBox_learningRate_Nadam" not in Default_dict.keys():
             Default_dict["doubleSpinBox_learningRate_Nadam"] = 0.002
+        if "Crop cache On" not in Default_dict.keys():
+            Default_dict["Crop cache On"] = True
+            Default_dict["Crop cache directory"] = "" #empty: use ~/.aideveloper/crop_cache
+            Default_dict["Crop cache max. size (GB)"] = 10
+        if "ROI read" not in Default_dict.keys():
+            Default_dict["ROI read"] = True #only read the window around each event from .rtdc
+        if "Streaming pipeline" not in Default_dict.keys():
+            Default_dict["Streaming pipeline"] = False #load and augment training data batch-wise (aid_dl.EpochSequence)
+        if "Prefetch queue depth" not in Default_dict.keys():
+            Default_dict["Prefetch queue depth"] = 1 #nr. of epochs prepared in the background during fitting; 0: off
+        if "Augmentation processes" not in Default_dict.keys():
+            Default_dict["Augmentation processes"] = 1 #1: augment in the training thread; 0: use all CPUs
+        if "rtdc max. open files" not in Default_dict.keys():
+            Default_dict["rtdc max. open files"] = 32 #.rtdc files are kept open (aid_bin.rtdc_handles)
+            Default_dict["rtdc chunk cache (MB)"] = 16 #HDF5 chunk cache of each open file
+        if "Scan threads" not in Default_dict.keys():
+            Default_dict["Scan threads"] = 4 #Max. nr. of dropped files that are scanned at the same time
+        if "RAM cache budget" not in Default_dict.keys():
+            Default_dict["RAM cache budget"] = 0.5 #Data to RAM: <=1: fraction of available memory, >1: GB
+        if "Memory plan auto-shrink" not in Default_dict.keys():
+            Default_dict["Memory plan auto-shrink"] = False #reduce Events/Epoch if training needs more memory than available
+        if "Single-warp affine augm." not in Default_dict.keys():
+            Default_dict["Single-warp affine augm."] = True #affine augmentation and final cropping in one cv2.warpAffine (aid_img.affine_augm_crop)
+        if "Random seed" not in Default_dict.keys():
+            Default_dict["Random seed"] = None #None: new seed for each training run; int: reproduce a run (seed is saved in the meta file)
+        if "Augmentation backend" not in Default_dict.keys():
+            Default_dict["Augmentation backend"] = "cv2" #"cv2": OpenCV loops (aid_img); "tf": TensorFlow graph on the CPU (aid_dl.TFAugmenter)
+        if "Validation every nr. epochs" not in Default_dict.keys():
+            Default_dict["Validation every nr. epochs"] = 1 #metrics of epochs without validation are NaN
+        if "Validation subsample" not in Default_dict.keys():
+            Default_dict["Validation subsample"] = 0.0 #fraction of the validation data (stratified) used in most validations; 0: always full validation data
+        if "Full validation every nr. epochs" not in Default_dict.keys():
+            Default_dict["Full validation every nr. epochs"] = 10 #only used if "Validation subsample">0
+        if "Collection parallel fits" not in Default_dict.keys():
+            Default_dict["Collection parallel fits"] = 0 #nr. of models of a collection that are fitted at the same time; 0: nr. of CPU cores (at least 2)
 
 
 
@@ -119,7 +154,15 @@ def save_default_dict(dir_settings):
     "doubleSpinBox_learningRate_Adagrad":0.01,\
     "doubleSpinBox_learningRate_Adadelta":1.0,\
     "doubleSpinBox_learningRate_Adamax":0.002,\
-    "doubleSpinBox_learningRate_Nadam":0.002}
+    "doubleSpinBox_learningRate_Nadam":0.002,\
+
+    "Crop cache On":True,"Crop cache directory":"","Crop cache max. size (GB)":10,\
+    "ROI read":True,"Streaming pipeline":False,"Prefetch queue depth":1,"Augmentation processes":1,\
+    "rtdc max. open files":32,"rtdc chunk cache (MB)":16,\
+    "Scan threads":4,"RAM cache budget":0.5,"Memory plan auto-shrink":False,\
+    "Single-warp affine augm.":True,"Random seed":None,\
+    "Augmentation backend":"cv2","Validation every nr. epochs":1,"Validation subsample":0.0,\
+    "Full validation every nr. epochs":10,"Collection parallel fits":0}
 
     with open(dir_settings, 'w') as f:
         json.dump(Default_dict,f)
@@ -362,6 +405,7 @@ def get_tooltips():
     tooltips["pushButton_clearTextWindow_pop"] = "Clear the text window (fitting info)."
     tooltips["checkBox_ApplyNextEpoch"] = "Changes made in this window will be applied at the next epoch."
     tooltips["checkBox_saveEpoch_pop"] = "Save the model, when the current epoch is done"
+    tooltips["checkBox_saveMeta_pop"] = "Write the training history so far to the 'History' sheet of the meta.xlsx file, when the current epoch is done"
     tooltips["pushButton_Pause_pop"] = "Pause fitting, push this button again to continue."
     tooltips["pushButton_Stop_pop"] = "Stop fitting entirely, Close this window manually, after the progressbar shows 100%."
     tooltips["actioncpu_merge"] = "Identify whether to force merging model weights under the scope of the CPU or not. Source: https://www.tensorflow.org/api_docs/python/tf/keras/utils/multi_gpu_model"
@@ -411,7 +455,7 @@ def get_tooltips():
     #tooltips["msg_loadSession"] = "This function does only refurbish the window 'Drag and drop .rtdc files here'. To load the corresponding model please use 'Load and continue' in the 'Define Model' -tab. Image augmentation parameters have to be adjusted manually."
     tooltips["msg_loadSession"] = "Should only be the box 'Drag and drop .rtdc files here' be loaded, or the full set of hyper-parameters (model type, image augmentation parameters, learning rate,...)?"
 
-    tooltips["label_saveMetaEvery"] = "Determine after every how many seconds the meta.xlsx file should be saved. For training procedures with more than 10k epochs saving of the meta.xlsx file might take long and you want to reduce the saving frequency. Also, saving the meta.xlsx file is only important for safety (keep progress also in case of power outage) and if you want to regularly check the excel file (e.g. using the 'History'-Tab)."
+    tooltips["label_saveMetaEvery"] = "The training history is appended to the _history.csv file (next to the meta.xlsx file) after each epoch. Determine after every how many seconds this file should be forced to be written to the disk. This is only important for safety (keep progress also in case of power outage). The 'History' sheet of the meta.xlsx file is written at the end of the training and upon request ('Save meta')."
 
 
 